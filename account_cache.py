@@ -0,0 +1,306 @@
+import hashlib
+import json
+import logging
+import os
+import tempfile
+import threading
+import time
+from collections import OrderedDict
+from typing import Awaitable, Callable, List
+
+import metrics
+
+
+logger = logging.getLogger(__name__)
+
+
+# Accounts kept in memory per warm container, and on disk when ACCOUNT_CACHE_DIR is set
+ACCOUNT_CACHE_SIZE = 256
+ACCOUNT_CACHE_DISK_ENTRIES = 2048
+
+# Seconds an account is served as cached before it is refreshed, with a delta
+# query where the CRM supports one
+DEFAULT_REFRESH_INTERVAL = 60
+
+# Seconds before an account is dropped and fetched in full again. Delta queries
+# cannot see deleted records, so this bounds how long those linger.
+DEFAULT_TTL = 3600
+
+
+class AccountCache:
+    """
+    Cache of the records fetched for an account, keyed by tenant and account.
+
+    Entries younger than the refresh interval are served as they are. Older ones
+    are refreshed, either by fetching only the records changed since the entry's
+    sync marker and merging them in, or by fetching the account again. Entries
+    are dropped entirely once older than the TTL. If a refresh fails the stale
+    entry is served rather than nothing.
+
+    Entries live in an LRU in memory and, with disk_dir set (e.g. under /tmp),
+    as JSON files that survive for the life of the container.
+    """
+
+    def __init__(
+        self,
+        max_size: int = ACCOUNT_CACHE_SIZE,
+        disk_dir: str | None = None,
+        max_disk_entries: int = ACCOUNT_CACHE_DISK_ENTRIES
+    ):
+        self.max_size = max_size
+        self.disk_dir = disk_dir
+        self.max_disk_entries = max_disk_entries
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self._disk_writes = 0
+        self.hits = 0
+        self.delta_refreshes = 0
+        self.full_refreshes = 0
+        self.stale_hits = 0
+        self.misses = 0
+
+        if self.disk_dir:
+            os.makedirs(self.disk_dir, exist_ok=True)
+
+    @staticmethod
+    def make_key(*parts) -> str:
+        return hashlib.sha256(json.dumps(parts, default=str).encode('utf-8')).hexdigest()
+
+    def _disk_path(self, key: str) -> str:
+        return os.path.join(self.disk_dir, f"{key}.json")
+
+    def _read_disk(self, key: str) -> dict | None:
+        try:
+            with open(self._disk_path(key), 'r', encoding='utf-8') as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+
+    def _write_disk(self, key: str, entry: dict) -> None:
+        try:
+            fd, tmp_path = tempfile.mkstemp(dir=self.disk_dir, suffix='.tmp')
+            with os.fdopen(fd, 'w', encoding='utf-8') as f:
+                json.dump(entry, f)
+            os.replace(tmp_path, self._disk_path(key))
+        except (OSError, TypeError, ValueError) as e:
+            logger.debug("Failed to write account cache entry: %s", e)
+            return
+
+        self._disk_writes += 1
+        if self._disk_writes % 64 == 0:
+            self._prune_disk()
+
+    def _prune_disk(self) -> None:
+        """Drop the least recently written files beyond max_disk_entries"""
+        try:
+            paths = [
+                os.path.join(self.disk_dir, name)
+                for name in os.listdir(self.disk_dir)
+                if name.endswith('.json')
+            ]
+            paths.sort(key=os.path.getmtime, reverse=True)
+            for path in paths[self.max_disk_entries:]:
+                os.remove(path)
+        except OSError as e:
+            logger.debug("Failed to prune account cache: %s", e)
+
+    def lookup(self, key: str, ttl: float = DEFAULT_TTL) -> dict | None:
+        """Get an entry from memory or disk, or None if there is none younger than ttl"""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                self._entries.move_to_end(key)
+
+        if entry is None and self.disk_dir:
+            entry = self._read_disk(key)
+            if entry is not None:
+                with self._lock:
+                    self._remember(key, entry)
+
+        if entry is not None and time.time() - entry['full_fetched_at'] >= ttl:
+            return None
+        return entry
+
+    def _remember(self, key: str, entry: dict) -> None:
+        self._entries[key] = entry
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
+
+    def store(self, key: str, records: List[dict], sync_marker=None, full_fetched_at: float | None = None) -> dict:
+        """Cache an account's records, with full_fetched_at left unset for a complete fetch"""
+        now = time.time()
+        entry = {
+            'records': records,
+            'sync_marker': sync_marker,
+            'synced_at': now,
+            'full_fetched_at': full_fetched_at or now
+        }
+        with self._lock:
+            self._remember(key, entry)
+        if self.disk_dir:
+            self._write_disk(key, entry)
+        return entry
+
+    def _record(self, status: str, entry: dict | None) -> None:
+        with self._lock:
+            if status == 'hit':
+                self.hits += 1
+            elif status == 'delta':
+                self.delta_refreshes += 1
+            elif status == 'refresh':
+                self.full_refreshes += 1
+            elif status == 'stale':
+                self.stale_hits += 1
+            else:
+                self.misses += 1
+
+        metrics.count(f"account_cache_{status}")
+        if entry is not None:
+            metrics.observe('account_cache_staleness_s', round(time.time() - entry['synced_at'], 1))
+
+    def _serve_fresh(self, entry: dict | None, refresh_interval: float) -> List[dict] | None:
+        if entry is not None and time.time() - entry['synced_at'] < refresh_interval:
+            self._record('hit', entry)
+            return entry['records']
+        return None
+
+    def _merge(self, key: str, entry: dict, fetched: tuple, sort_key: Callable[[dict], object] | None) -> List[dict]:
+        """Merge the records changed since the entry's sync marker into it"""
+        changed, sync_marker = fetched
+        changed_by_id = {record.get('Id'): record for record in changed}
+        records = [changed_by_id.pop(record.get('Id'), record) for record in entry['records']]
+        records.extend(changed_by_id.values())
+        if sort_key is not None:
+            records.sort(key=sort_key, reverse=True)
+
+        self._record('delta', self.store(key, records, sync_marker or entry['sync_marker'], entry['full_fetched_at']))
+        return records
+
+    def _replace(self, key: str, entry: dict | None, fetched: tuple) -> List[dict]:
+        records, sync_marker = fetched
+        status = 'refresh' if entry is not None else 'miss'
+        self._record(status, self.store(key, records, sync_marker))
+        return records
+
+    def _serve_stale(self, entry: dict | None) -> List[dict] | None:
+        if entry is not None:
+            self._record('stale', entry)
+            return entry['records']
+
+        self._record('miss', None)
+        return None
+
+    def fetch(
+        self,
+        key: str,
+        fetch_full: Callable[[], tuple | None],
+        fetch_delta: Callable[[object], tuple | None] | None = None,
+        refresh_interval: float = DEFAULT_REFRESH_INTERVAL,
+        ttl: float = DEFAULT_TTL,
+        sort_key: Callable[[dict], object] | None = None
+    ) -> List[dict] | None:
+        """
+        Get an account's records through the cache.
+
+        Args:
+            key: Key from make_key, identifying the tenant, account and query
+            fetch_full: Fetches every record, returning (records, sync marker) or None on failure
+            fetch_delta: Fetches the records changed since a sync marker, returning
+                (records, sync marker) or None on failure. Without it, entries are
+                refreshed by fetch_full.
+            refresh_interval: Seconds an entry is served before being refreshed
+            ttl: Seconds after the last full fetch before an entry is dropped
+            sort_key: Restores the query's order after changed records are merged in,
+                sorting in descending order
+
+        Returns:
+            The account's records, or None if there were none cached and the fetch failed
+        """
+        entry = self.lookup(key, ttl)
+        records = self._serve_fresh(entry, refresh_interval)
+        if records is not None:
+            return records
+
+        if entry is not None and fetch_delta is not None:
+            fetched = fetch_delta(entry['sync_marker'])
+            if fetched is not None:
+                return self._merge(key, entry, fetched, sort_key)
+        else:
+            fetched = fetch_full()
+            if fetched is not None:
+                return self._replace(key, entry, fetched)
+
+        return self._serve_stale(entry)
+
+    async def afetch(
+        self,
+        key: str,
+        fetch_full: Callable[[], Awaitable[tuple | None]],
+        fetch_delta: Callable[[object], Awaitable[tuple | None]] | None = None,
+        refresh_interval: float = DEFAULT_REFRESH_INTERVAL,
+        ttl: float = DEFAULT_TTL,
+        sort_key: Callable[[dict], object] | None = None
+    ) -> List[dict] | None:
+        """Async version of fetch, for fetch_full and fetch_delta coroutine functions"""
+        entry = self.lookup(key, ttl)
+        records = self._serve_fresh(entry, refresh_interval)
+        if records is not None:
+            return records
+
+        if entry is not None and fetch_delta is not None:
+            fetched = await fetch_delta(entry['sync_marker'])
+            if fetched is not None:
+                return self._merge(key, entry, fetched, sort_key)
+        else:
+            fetched = await fetch_full()
+            if fetched is not None:
+                return self._replace(key, entry, fetched)
+
+        return self._serve_stale(entry)
+
+    def get_fresh(self, key: str, refresh_interval: float = DEFAULT_REFRESH_INTERVAL, ttl: float = DEFAULT_TTL) -> List[dict] | None:
+        """
+        Get an account's records if cached within the refresh interval, counting
+        the hit, or None so the caller can fetch it (e.g. with other accounts)
+        and pass the result to update.
+        """
+        return self._serve_fresh(self.lookup(key, ttl), refresh_interval)
+
+    def update(self, key: str, records: List[dict] | None, ttl: float = DEFAULT_TTL) -> List[dict] | None:
+        """
+        Store records fetched for an account after get_fresh missed, or with
+        records None because the fetch failed, fall back to any stale entry.
+        """
+        entry = self.lookup(key, ttl)
+        if records is not None:
+            return self._replace(key, entry, (records, None))
+        return self._serve_stale(entry)
+
+    def stats(self) -> dict:
+        with self._lock:
+            lookups = self.hits + self.delta_refreshes + self.full_refreshes + self.stale_hits + self.misses
+            served_from_cache = self.hits + self.delta_refreshes + self.stale_hits
+            return {
+                'hits': self.hits,
+                'delta_refreshes': self.delta_refreshes,
+                'full_refreshes': self.full_refreshes,
+                'stale_hits': self.stale_hits,
+                'misses': self.misses,
+                'hit_ratio': round(served_from_cache / lookups, 3) if lookups else 0.0,
+                'size': len(self._entries)
+            }
+
+
+_cache = None
+_cache_lock = threading.Lock()
+
+
+def get_cache() -> AccountCache:
+    """Get the container-wide account cache, with a disk tier under ACCOUNT_CACHE_DIR if set"""
+    global _cache
+    if _cache is None:
+        with _cache_lock:
+            if _cache is None:
+                _cache = AccountCache(disk_dir=os.environ.get('ACCOUNT_CACHE_DIR'))
+    return _cache
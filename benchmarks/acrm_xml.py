@@ -0,0 +1,110 @@
+"""
+Compare ACRM opportunity parsing: the buffered ElementTree parser against the
+incremental pull parser used for streamed responses.
+
+Payloads are rendered by the CRM stand-in with product names from
+data/products.csv, then parsed three ways:
+
+    buffered          decode the body and _parse_xml_opportunities, as without stream
+    stream            _iter_xml_opportunities over 64 KiB chunks, records consumed one by one
+    stream+list       the same, but collecting every record into a list
+
+Time is the best of --repeat runs, and peak memory the tracemalloc peak of a
+separate run, excluding the payload itself. The stream row is what a consumer
+that does not hold on to records pays; stream+list isolates the tree overhead
+the buffered parser adds on top of the records themselves.
+
+Usage:
+    python benchmarks/acrm_xml.py [--sizes 1000,10000,100000] [--padding 0] [--repeat 3]
+"""
+import argparse
+import os
+import random
+import sys
+import time
+import tracemalloc
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO_ROOT)
+
+from crm_services import ACRM_STREAM_CHUNK_SIZE, ACRMService  # noqa: E402
+from crm_stubs import acrm_response_xml  # noqa: E402
+from ranking import STAGES, SyntheticData  # noqa: E402
+
+
+def build_payload(data: SyntheticData, size: int, padding: int, seed: int) -> bytes:
+    rng = random.Random(seed)
+    opportunities = [{
+        'Id': str(4294967297 + i),
+        'Name': f"{rng.choice(data.products)[1]} renewal {i}",
+        'StageName': rng.choice(STAGES['acrm'])
+    } for i in range(size)]
+    return acrm_response_xml([('4294967297', opportunities, None)], padding)
+
+
+def chunked(payload: bytes):
+    for start in range(0, len(payload), ACRM_STREAM_CHUNK_SIZE):
+        yield payload[start:start + ACRM_STREAM_CHUNK_SIZE]
+
+
+def consume(records) -> int:
+    count = 0
+    for _ in records:
+        count += 1
+    return count
+
+
+def parsers(service: ACRMService, payload: bytes) -> dict:
+    return {
+        'buffered': lambda: service._parse_xml_opportunities(payload.decode('utf-8')),
+        'stream': lambda: consume(service._iter_xml_opportunities(chunked(payload))),
+        'stream+list': lambda: list(service._iter_xml_opportunities(chunked(payload)))
+    }
+
+
+def measure(run, repeat: int) -> dict:
+    durations = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        run()
+        durations.append(time.perf_counter() - start)
+
+    tracemalloc.start()
+    try:
+        run()
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+
+    return {'seconds': min(durations), 'peak_bytes': peak}
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark buffered against streaming ACRM XML parsing')
+    parser.add_argument('--sizes', default='1000,10000,100000', help='Comma separated opportunity counts (default 1000,10000,100000)')
+    parser.add_argument('--padding', type=int, default=0, help='Extra bytes of Description per opportunity (default 0)')
+    parser.add_argument('--repeat', type=int, default=3, help='Timed runs per case (default 3)')
+    parser.add_argument('--seed', type=int, default=7, help='Seed for the synthetic payloads (default 7)')
+    args = parser.parse_args()
+
+    data = SyntheticData()
+    service = ACRMService({})
+
+    print(f"{'opportunities':>13} {'payload MiB':>11}  {'parser':<12} {'ms':>9} {'records/s':>12} {'peak MiB':>9}")
+    for size in (int(size) for size in args.sizes.split(',') if size):
+        payload = build_payload(data, size, args.padding, args.seed)
+
+        runs = parsers(service, payload)
+        if runs['buffered']() != runs['stream+list']():
+            raise SystemExit(f"Parsers disagree on {size} opportunities")
+
+        for name, run in runs.items():
+            measured = measure(run, args.repeat)
+            print(
+                f"{size:>13,} {len(payload) / 2**20:>11.1f}  {name:<12} {measured['seconds'] * 1000:>9.1f} "
+                f"{size / measured['seconds']:>12,.0f} {measured['peak_bytes'] / 2**20:>9.2f}"
+            )
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,122 @@
+"""
+Measure the cold-start cost of the Lambda handler module.
+
+Each run imports the module in a fresh interpreter under `python -X importtime`,
+so the numbers match what a new Lambda container pays before the first request.
+Reports the median import and init time, the slowest imports, and whether the
+LLM stack was loaded.
+
+Usage:
+    python benchmarks/cold_start.py [--runs 5] [--top 15] [--record]
+
+With --record the result is appended to benchmarks/baselines/cold_start.csv
+along with the git revision, so handler init time can be tracked over releases.
+"""
+import argparse
+import csv
+import os
+import statistics
+import subprocess
+import sys
+from datetime import datetime, timezone
+
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+BASELINE_PATH = os.path.join(REPO_ROOT, 'benchmarks', 'baselines', 'cold_start.csv')
+
+# Modules that should only load on first use of the LLM ranker
+LLM_MODULES = ('langchain', 'langchain_openai', 'langchain_core', 'openai', 'tiktoken', 'dotenv')
+
+INIT_SCRIPT = """
+import sys, time
+start = time.perf_counter()
+import {module}
+elapsed = time.perf_counter() - start
+llm_loaded = sorted(m for m in {llm_modules!r} if m in sys.modules)
+print(elapsed, ','.join(llm_loaded))
+"""
+
+
+def parse_importtime(stderr: str) -> dict:
+    """Map each imported module to its cumulative import time in microseconds"""
+    timings = {}
+    for line in stderr.splitlines():
+        if not line.startswith('import time:') or 'cumulative' in line:
+            continue
+        _, cumulative_us, name = line.split('|')
+        timings[name.strip()] = int(cumulative_us)
+    return timings
+
+
+def measure_once(module: str) -> tuple:
+    result = subprocess.run(
+        [sys.executable, '-X', 'importtime', '-c', INIT_SCRIPT.format(module=module, llm_modules=LLM_MODULES)],
+        cwd=REPO_ROOT,
+        capture_output=True,
+        text=True,
+        check=True
+    )
+    elapsed, _, llm_loaded = result.stdout.strip().splitlines()[-1].partition(' ')
+    return float(elapsed), parse_importtime(result.stderr), llm_loaded
+
+
+def git_revision() -> str:
+    try:
+        return subprocess.run(
+            ['git', 'rev-parse', '--short', 'HEAD'], cwd=REPO_ROOT, capture_output=True, text=True, check=True
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return 'unknown'
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Measure handler cold-start import time')
+    parser.add_argument('--module', default='lambda_function', help='Module to import (default lambda_function)')
+    parser.add_argument('--runs', type=int, default=5, help='Fresh interpreters to measure (default 5)')
+    parser.add_argument('--top', type=int, default=15, help='Slowest imports to list (default 15)')
+    parser.add_argument('--record', action='store_true', help='Append the result to the baseline history')
+    args = parser.parse_args()
+
+    init_times = []
+    import_times = []
+    module_timings = {}
+    llm_loaded = ''
+    for _ in range(args.runs):
+        elapsed, timings, llm_loaded = measure_once(args.module)
+        init_times.append(elapsed * 1000)
+        import_times.append(timings.get(args.module, 0) / 1000)
+        for name, cumulative_us in timings.items():
+            module_timings.setdefault(name, []).append(cumulative_us / 1000)
+
+    init_ms = statistics.median(init_times)
+    import_ms = statistics.median(import_times)
+
+    print(f"{args.module}: init {init_ms:.1f} ms, import {import_ms:.1f} ms (median of {args.runs} runs)")
+    print(f"LLM stack loaded at import: {llm_loaded or 'no'}")
+    print("\nSlowest imports (cumulative ms):")
+    slowest = sorted(module_timings.items(), key=lambda item: statistics.median(item[1]), reverse=True)
+    for name, timings in slowest[:args.top]:
+        print(f"  {statistics.median(timings):9.1f}  {name}")
+
+    if args.record:
+        os.makedirs(os.path.dirname(BASELINE_PATH), exist_ok=True)
+        is_new = not os.path.exists(BASELINE_PATH)
+        with open(BASELINE_PATH, 'a', newline='', encoding='utf-8') as f:
+            writer = csv.writer(f)
+            if is_new:
+                writer.writerow(['recorded_at', 'revision', 'python', 'module', 'runs', 'init_ms', 'import_ms', 'llm_loaded'])
+            writer.writerow([
+                datetime.now(timezone.utc).isoformat(timespec='seconds'),
+                git_revision(),
+                '.'.join(map(str, sys.version_info[:3])),
+                args.module,
+                args.runs,
+                f"{init_ms:.1f}",
+                f"{import_ms:.1f}",
+                llm_loaded
+            ])
+        print(f"\nRecorded to {os.path.relpath(BASELINE_PATH, REPO_ROOT)}")
+
+
+if __name__ == '__main__':
+    main()
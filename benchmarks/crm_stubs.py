@@ -0,0 +1,471 @@
+"""
+Local stand-ins for the CRM APIs the services talk to, for load testing without
+touching live CRMs or their API limits.
+
+One HTTP server answers all three platforms:
+
+    GET  /services/data/v62.0/query?q=...                  Salesforce SOQL query REST
+    GET  /services/data/v62.0/query/<cursor>               Salesforce nextRecordsUrl pages
+    POST /PivotalUx/rest/forms/formData/actions/retrieve   Pivotal form record retrieve
+    POST /CRMinterface/xml                                 ACRM XML interface
+
+Accounts are generated deterministically from the account id with the same
+synthetic data as benchmarks/ranking.py, so every request for an account sees
+the same opportunities, products and matching transcript. Every response waits
+latency_ms +/- jitter_ms first, or tail_ms at tail_rate to model the slow
+requests hedging cuts off, and fails with a 503 at error_rate.
+
+Usage:
+    python benchmarks/crm_stubs.py [--port 8765] [--latency-ms 50] [--jitter-ms 20]
+        [--tail-rate 0.02] [--tail-ms 1000] [--error-rate 0.01] [--opportunities 50] [--line-items 5] [--page-size 2000]
+"""
+import argparse
+import itertools
+import json
+import random
+import re
+import threading
+import time
+import zlib
+from collections import OrderedDict
+from datetime import datetime, timedelta, timezone
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import List
+from urllib.parse import parse_qs, urlsplit
+from xml.etree import ElementTree as ET
+from xml.sax.saxutils import escape, quoteattr
+
+from ranking import SyntheticData
+from crm_services import ACRM_PRODUCT_ELEMENT
+
+
+QUERY_PATH = '/services/data/v62.0/query'
+PIVOTAL_PATH = '/PivotalUx/rest/forms/formData/actions/retrieve'
+ACRM_PATH = '/CRMinterface/xml'
+
+# Salesforce query cursors kept for nextRecordsUrl, oldest dropped first
+MAX_QUERY_CURSORS = 256
+
+# Opportunity i, and its line items, were last modified i minutes after this
+MODSTAMP_EPOCH = datetime(2025, 1, 1, tzinfo=timezone.utc)
+
+
+class StubSettings:
+    """How the stand-in CRMs behave and how large the accounts they serve are"""
+
+    def __init__(
+        self,
+        latency_ms: float = 0.0,
+        jitter_ms: float = 0.0,
+        error_rate: float = 0.0,
+        tail_rate: float = 0.0,
+        tail_ms: float = 0.0,
+        opportunities: int = 50,
+        line_items: int = 5,
+        page_size: int = 2000,
+        padding: int = 0,
+        transcript_words: int = 500,
+        seed: int = 7
+    ):
+        self.latency_ms = latency_ms
+        self.jitter_ms = jitter_ms
+        self.error_rate = error_rate
+        self.tail_rate = tail_rate
+        self.tail_ms = tail_ms
+        self.opportunities = opportunities
+        self.line_items = line_items
+        self.page_size = page_size
+        self.padding = padding
+        self.transcript_words = transcript_words
+        self.seed = seed
+
+
+class AccountStore:
+    """Generates each platform's account on first request and keeps it"""
+
+    def __init__(self, settings: StubSettings, data: SyntheticData | None = None):
+        self.settings = settings
+        self.data = data or SyntheticData()
+        self._accounts = {}
+        self._lock = threading.Lock()
+
+    def account(self, platform: str, account_id: str) -> dict:
+        key = (platform, account_id)
+        with self._lock:
+            account = self._accounts.get(key)
+        if account is None:
+            settings = self.settings
+            account = self.data.account(
+                platform,
+                settings.opportunities,
+                settings.line_items,
+                settings.transcript_words,
+                settings.seed ^ zlib.crc32(account_id.encode('utf-8'))
+            )
+            with self._lock:
+                account = self._accounts.setdefault(key, account)
+        return account
+
+
+def _quoted_ids(query: str, field: str) -> List[str] | None:
+    match = re.search(rf"{re.escape(field)} IN \(([^)]*)\)", query)
+    if not match:
+        return None
+    return re.findall(r"'([^']*)'", match.group(1))
+
+
+def _modstamp(opportunity_id: str) -> datetime:
+    return MODSTAMP_EPOCH + timedelta(minutes=int(re.sub(r'\D', '', opportunity_id) or 0))
+
+
+def _salesforce_datetime(value: datetime) -> str:
+    return value.strftime('%Y-%m-%dT%H:%M:%S.000+0000')
+
+
+def acrm_response_xml(accounts: List[tuple], padding: int = 0) -> bytes:
+    """
+    Render (record id, opportunities, products or None) per account the way
+    ACRMService expects the XML interface to return them, with product rows
+    nested in their opportunity when given.
+    """
+    parts = ['<?xml version="1.0" encoding="UTF-8"?><response>']
+    for record_id, opportunities, opportunity_products in accounts:
+        parts.append(f'<table table="FI" recId={quoteattr(record_id)}>')
+        for index, opportunity in enumerate(opportunities):
+            parts.append(
+                f"<Opportunity id={quoteattr(opportunity['Id'])}>"
+                f"<Opportunity>{escape(opportunity['Name'])}</Opportunity>"
+                f"<Status>{escape(opportunity['StageName'])}</Status>"
+            )
+            if padding:
+                parts.append(f"<Description>{'x' * padding}</Description>")
+            for product in (opportunity_products[index] if opportunity_products else ()):
+                parts.append(
+                    f"<{ACRM_PRODUCT_ELEMENT} id={quoteattr(product['id'])}>"
+                    f"<Product>{escape(product['product_name'])}</Product>"
+                    f"<ProductNo>{escape(product['product_id'])}</ProductNo>"
+                    f"</{ACRM_PRODUCT_ELEMENT}>"
+                )
+            parts.append('</Opportunity>')
+        parts.append('</table>')
+    parts.append('</response>')
+    return ''.join(parts).encode('utf-8')
+
+
+class CRMStubServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, address, settings: StubSettings, store: AccountStore | None = None):
+        super().__init__(address, CRMStubHandler)
+        self.settings = settings
+        self.store = store or AccountStore(settings)
+        self.cursors = OrderedDict()
+        self._cursor_ids = itertools.count(1)
+        self._lock = threading.Lock()
+        self._rng = random.Random(settings.seed)
+        self._stats = {'requests': 0, 'error_responses': 0, 'injected_errors': 0, 'bytes_sent': 0}
+
+    @property
+    def base_url(self) -> str:
+        host, port = self.server_address[:2]
+        return f"http://{host}:{port}/"
+
+    def record(self, status: int, size: int, injected: bool = False) -> None:
+        with self._lock:
+            self._stats['requests'] += 1
+            self._stats['bytes_sent'] += size
+            if status >= 400:
+                self._stats['error_responses'] += 1
+            if injected:
+                self._stats['injected_errors'] += 1
+
+    def stats(self) -> dict:
+        with self._lock:
+            return dict(self._stats)
+
+    def draw(self) -> tuple:
+        """Pick this request's delay in seconds and whether it fails"""
+        settings = self.settings
+        with self._lock:
+            jitter = self._rng.uniform(-settings.jitter_ms, settings.jitter_ms) if settings.jitter_ms else 0.0
+            failed = self._rng.random() < settings.error_rate
+            if self._rng.random() < settings.tail_rate:
+                return settings.tail_ms / 1000, failed
+        return max(0.0, settings.latency_ms + jitter) / 1000, failed
+
+    def save_cursor(self, records: list) -> str:
+        with self._lock:
+            cursor = f"01gSTUB{next(self._cursor_ids):012d}"
+            self.cursors[cursor] = records
+            while len(self.cursors) > MAX_QUERY_CURSORS:
+                self.cursors.popitem(last=False)
+        return cursor
+
+    def load_cursor(self, cursor: str) -> list | None:
+        with self._lock:
+            return self.cursors.get(cursor)
+
+
+class CRMStubHandler(BaseHTTPRequestHandler):
+    # Keep-alive, so the services' pooled sessions behave as against a real CRM
+    protocol_version = 'HTTP/1.1'
+
+    # Headers and body go out as separate writes, which Nagle would hold for the client's delayed ACK
+    disable_nagle_algorithm = True
+
+    def log_message(self, format, *args):
+        pass
+
+    def _read_body(self) -> bytes:
+        length = int(self.headers.get('Content-Length') or 0)
+        return self.rfile.read(length) if length else b''
+
+    def _send(self, status: int, body: bytes, content_type: str, injected: bool = False) -> None:
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+        self.server.record(status, len(body), injected)
+
+    def _send_json(self, status: int, payload) -> None:
+        self._send(status, json.dumps(payload).encode('utf-8'), 'application/json')
+
+    def _handle(self, method: str) -> None:
+        body = self._read_body() if method == 'POST' else b''
+        delay, failed = self.server.draw()
+        if delay:
+            time.sleep(delay)
+
+        if failed:
+            self._send(503, b'{"message": "Injected failure"}', 'application/json', injected=True)
+            return
+
+        url = urlsplit(self.path)
+        params = parse_qs(url.query)
+        try:
+            if method == 'GET' and url.path == QUERY_PATH:
+                self._salesforce_query(params.get('q', [''])[0])
+            elif method == 'GET' and url.path.startswith(QUERY_PATH + '/'):
+                self._salesforce_next_page(url.path.rsplit('/', 1)[-1])
+            elif method == 'POST' and url.path == PIVOTAL_PATH:
+                self._pivotal_retrieve(params.get('recordId', [''])[0])
+            elif method == 'POST' and url.path == ACRM_PATH:
+                self._acrm_query(body)
+            else:
+                self._send_json(404, {'message': f"No stand-in for {method} {url.path}"})
+        except ConnectionError:
+            # The client gave up on the request, e.g. a hedged duplicate that lost
+            return
+        except Exception as e:
+            self._send_json(500, {'message': str(e)})
+
+    def do_GET(self):
+        self._handle('GET')
+
+    def do_POST(self):
+        self._handle('POST')
+
+    # Salesforce
+
+    def _line_item(self, product: dict, with_name: bool) -> dict:
+        record = {
+            'attributes': {'type': 'OpportunityLineItem'},
+            'Id': f"00k{product['id']}",
+            'OpportunityId': product['opportunity_id'],
+            'Product2Id': product['product_id'],
+            'Quantity': 1.0,
+            'SystemModstamp': _salesforce_datetime(_modstamp(product['opportunity_id']))
+        }
+        if with_name:
+            record['Product2'] = {'attributes': {'type': 'Product2'}, 'Name': product['product_name']}
+        return record
+
+    def _opportunity(self, opportunity: dict, account_id: str) -> dict:
+        record = {
+            'attributes': {'type': 'Opportunity'},
+            'Id': opportunity['Id'],
+            'OwnerId': opportunity['OwnerId'],
+            'Name': opportunity['Name'],
+            'StageName': opportunity['StageName'],
+            'AccountId': account_id,
+            'Account': {'attributes': {'type': 'Account'}, 'Name': f"Account {account_id}"},
+            'CreatedDate': '2025-01-01T00:00:00.000+0000',
+            'SystemModstamp': _salesforce_datetime(_modstamp(opportunity['Id']))
+        }
+        if self.server.settings.padding:
+            record['Description'] = 'x' * self.server.settings.padding
+        return record
+
+    def _salesforce_records(self, query: str) -> list:
+        store = self.server.store
+        with_name = 'Product2.Name' in query
+        product_ids = _quoted_ids(query, 'Product2Id')
+
+        if re.search(r'FROM\s+Product2\b', query):
+            lookup_ids = _quoted_ids(query, 'Id')
+            return [
+                {'attributes': {'type': 'Product2'}, 'Id': product_id, 'Name': name, 'LastModifiedDate': '2025-01-01T00:00:00.000+0000'}
+                for product_id, name in store.data.products
+                if lookup_ids is None or product_id in lookup_ids
+            ]
+
+        match = re.search(r"AccountId = '([^']*)'", query)
+        account_id = match.group(1) if match else ''
+        account = store.account('salesforce', account_id)
+        pairs = zip(account['opportunities'], account['opportunity_products'])
+
+        # Delta queries: opportunities or their line items changed since a SystemModstamp,
+        # which line items here share with their opportunity
+        since = re.search(r'SystemModstamp >= (\S+?)\)?\s', query + ' ')
+        if since:
+            since = datetime.fromisoformat(since.group(1))
+            pairs = [(opportunity, products) for opportunity, products in pairs if _modstamp(opportunity['Id']) >= since]
+
+        if re.search(r'^\s*SELECT\s[^(]*FROM\s+OpportunityLineItem\b', query):
+            owner_ids = _quoted_ids(query, 'Opportunity.OwnerId')
+            return [
+                self._line_item(product, with_name)
+                for opportunity, products in pairs
+                if owner_ids is None or opportunity['OwnerId'] in owner_ids
+                for product in products
+                if product_ids is None or product['product_id'] in product_ids
+            ]
+
+        records = []
+        nested = 'FROM OpportunityLineItems' in query
+        for opportunity, products in pairs:
+            record = self._opportunity(opportunity, account_id)
+            if nested:
+                line_items = [
+                    self._line_item(product, with_name) for product in products
+                    if product_ids is None or product['product_id'] in product_ids
+                ]
+                record['OpportunityLineItems'] = {
+                    'totalSize': len(line_items), 'done': True, 'records': line_items
+                } if line_items else None
+            records.append(record)
+        return records
+
+    def _salesforce_page(self, records: list, offset: int, cursor: str | None) -> None:
+        page_size = self.server.settings.page_size
+        end = offset + page_size
+        page = {'totalSize': len(records), 'done': end >= len(records), 'records': records[offset:end]}
+        if not page['done']:
+            cursor = cursor or self.server.save_cursor(records)
+            page['nextRecordsUrl'] = f"{QUERY_PATH}/{cursor}-{end}"
+        self._send_json(200, page)
+
+    def _salesforce_query(self, query: str) -> None:
+        if not query:
+            self._send_json(400, [{'errorCode': 'MALFORMED_QUERY', 'message': 'Missing q'}])
+            return
+        self._salesforce_page(self._salesforce_records(query), 0, None)
+
+    def _salesforce_next_page(self, locator: str) -> None:
+        cursor, _, offset = locator.rpartition('-')
+        records = self.server.load_cursor(cursor)
+        if records is None or not offset.isdigit():
+            self._send_json(400, [{'errorCode': 'INVALID_QUERY_LOCATOR', 'message': 'invalid query locator'}])
+            return
+        self._salesforce_page(records, int(offset), cursor)
+
+    # Pivotal
+
+    def _pivotal_retrieve(self, record_id: str) -> None:
+        account = self.server.store.account('pivotal', record_id)
+        secondary = []
+        for opportunity in account['opportunities']:
+            record = {
+                'SFA_Opportunity_Id': opportunity['Id'],
+                'Opportunity_Name': opportunity['Name'],
+                'Status': opportunity['StageName']
+            }
+            if self.server.settings.padding:
+                record['Description'] = 'x' * self.server.settings.padding
+            secondary.append(record)
+
+        self._send_json(200, {
+            'success': True,
+            'payload': {'data': {'primary': {'Id': record_id, 'Opportunities__Secondary': secondary}}}
+        })
+
+    # ACRM
+
+    def _acrm_query(self, body: bytes) -> None:
+        try:
+            request = ET.fromstring(body)
+        except ET.ParseError as e:
+            self._send(400, f"<error>{escape(str(e))}</error>".encode('utf-8'), 'application/xml')
+            return
+
+        accounts = []
+        for account_table in request.iterfind('.//table[@table="FI"]'):
+            record_id = account_table.get('recId', '')
+            account = self.server.store.account('acrm', record_id)
+            # A table nested in Y1 asks for the opportunities' products
+            with_products = account_table.find('table[@table="Y1"]/table') is not None
+            accounts.append((record_id, account['opportunities'], account['opportunity_products'] if with_products else None))
+
+        self._send(200, acrm_response_xml(accounts, self.server.settings.padding), 'application/xml')
+
+
+def start_server(settings: StubSettings, host: str = '127.0.0.1', port: int = 0) -> CRMStubServer:
+    """Start the stand-in server on a background thread; port 0 picks a free port"""
+    server = CRMStubServer((host, port), settings)
+    thread = threading.Thread(target=server.serve_forever, name='crm-stubs', daemon=True)
+    thread.start()
+    return server
+
+
+def add_settings_arguments(parser: argparse.ArgumentParser) -> None:
+    parser.add_argument('--latency-ms', type=float, default=50.0, help='Base response latency (default 50)')
+    parser.add_argument('--jitter-ms', type=float, default=20.0, help='Uniform +/- jitter on the latency (default 20)')
+    parser.add_argument('--tail-rate', type=float, default=0.0, help='Share of requests answered after --tail-ms instead (default 0)')
+    parser.add_argument('--tail-ms', type=float, default=1000.0, help='Latency of tail requests (default 1000)')
+    parser.add_argument('--error-rate', type=float, default=0.0, help='Share of requests failing with a 503 (default 0)')
+    parser.add_argument('--opportunities', type=int, default=50, help='Opportunities per account (default 50)')
+    parser.add_argument('--line-items', type=int, default=5, help='Line items per opportunity (default 5)')
+    parser.add_argument('--page-size', type=int, default=2000, help='Salesforce records per query page (default 2000)')
+    parser.add_argument('--padding', type=int, default=0, help='Extra bytes of Description per record (default 0)')
+    parser.add_argument('--transcript-words', type=int, default=500, help='Words in each account transcript (default 500)')
+    parser.add_argument('--seed', type=int, default=7, help='Seed for the generated accounts (default 7)')
+
+
+def settings_from_args(args: argparse.Namespace) -> StubSettings:
+    return StubSettings(
+        latency_ms=args.latency_ms,
+        jitter_ms=args.jitter_ms,
+        error_rate=args.error_rate,
+        tail_rate=args.tail_rate,
+        tail_ms=args.tail_ms,
+        opportunities=args.opportunities,
+        line_items=args.line_items,
+        page_size=args.page_size,
+        padding=args.padding,
+        transcript_words=args.transcript_words,
+        seed=args.seed
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Serve stand-ins for the Salesforce, Pivotal and ACRM APIs')
+    parser.add_argument('--host', default='127.0.0.1', help='Interface to listen on (default 127.0.0.1)')
+    parser.add_argument('--port', type=int, default=8765, help='Port to listen on (default 8765)')
+    add_settings_arguments(parser)
+    args = parser.parse_args()
+
+    server = CRMStubServer((args.host, args.port), settings_from_args(args))
+    print(f"Salesforce and Pivotal url_domain: {server.base_url}")
+    print(f"ACRM url_domain: {server.base_url.rstrip('/')}{ACRM_PATH}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        print(json.dumps(server.stats()))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,207 @@
+"""
+Replay concurrent lambda_handler events against the local CRM stand-ins.
+
+Starts benchmarks/crm_stubs.py in-process (or targets one already running with
+--url), builds one event per synthetic account with that account's transcript,
+and calls lambda_handler from --concurrency threads until --requests calls have
+completed. Reports p50/p95/p99 handler latency, throughput, failures and what
+the stand-in CRM served. Responses that rank nothing, or rank opportunities
+without ids, are reported as their own outcomes rather than as ok.
+
+Usage:
+    python benchmarks/load_test.py [--platform salesforce] [--requests 200]
+        [--concurrency 8] [--accounts 20] [--latency-ms 50] [--jitter-ms 20]
+        [--tail-rate 0.02] [--tail-ms 1000] [--error-rate 0.01]
+        [--opportunities 50] [--line-items 5]
+
+Every call runs on the process's one handler event loop and scoring pool, so
+CPU-bound phases share the GIL and throughput is a lower bound on what separate
+Lambda containers would reach. Run the stand-ins as their own process and pass
+--url to keep their response encoding off the handler's GIL.
+"""
+import argparse
+import json
+import os
+import statistics
+import sys
+import time
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO_ROOT)
+
+# Injected CRM failures would otherwise log an error per request
+os.environ.setdefault('LOG_LEVEL', 'CRITICAL')
+
+import crm_services  # noqa: E402
+import lambda_function  # noqa: E402
+from crm_stubs import ACRM_PATH, AccountStore, add_settings_arguments, settings_from_args, start_server  # noqa: E402
+
+
+def tenant_config(platform: str, base_url: str, extra: dict) -> dict:
+    config = {
+        'crm_platform': platform,
+        'url_domain': base_url,
+        'access_token': 'stub-token',
+        'emit_metrics': False
+    }
+    if platform == 'pivotal':
+        config['form_name'] = 'Company'
+        config['pivotal_environment_name'] = 'stub'
+    elif platform == 'acrm':
+        config['url_domain'] = base_url.rstrip('/') + ACRM_PATH
+        config['access_token'] = 'stub:secret'
+        # The stub answers products for whichever table is nested under Y1
+        config['acrm_product_table'] = 'Y3'
+    config.update(extra)
+    return config
+
+
+def build_events(platform: str, base_url: str, accounts: int, store, extra_config: dict) -> list:
+    events = []
+    for index in range(accounts):
+        account_id = f"001STUB{index:08d}"
+        account = store.account(platform, account_id)
+        events.append({
+            'body': json.dumps({
+                'data': {
+                    'account_id': account_id,
+                    'user_ids': account['user_ids'],
+                    'product_ids': [],
+                    'transcript': account['transcript']
+                },
+                'config': tenant_config(platform, base_url, extra_config)
+            })
+        })
+    return events
+
+
+def percentile(sorted_values: list, fraction: float) -> float:
+    """Linearly interpolated percentile of an already sorted list"""
+    if not sorted_values:
+        return 0.0
+    position = (len(sorted_values) - 1) * fraction
+    lower = int(position)
+    upper = min(lower + 1, len(sorted_values) - 1)
+    return sorted_values[lower] + (sorted_values[upper] - sorted_values[lower]) * (position - lower)
+
+
+def invoke(event: dict) -> tuple:
+    start = time.perf_counter()
+    crm_calls = {}
+    try:
+        response = lambda_function.lambda_handler(event, None)
+        outcome = 'ok' if response.get('statusCode') == 200 else f"status {response.get('statusCode')}"
+        if outcome == 'ok':
+            body = json.loads(response['body'])
+            crm_health = body['metadata']['crm_health']
+            crm_calls = crm_health['request']
+            # A 200 that ranks nothing, or ranks records without ids, is not a success
+            if not body['result']:
+                outcome = 'empty result'
+            elif not all(opportunity.get('id') for opportunity in body['result']):
+                outcome = 'missing ids'
+            elif crm_health['degraded']:
+                outcome = 'degraded'
+    except Exception as e:
+        outcome = type(e).__name__
+    return time.perf_counter() - start, outcome, crm_calls
+
+
+def run(events: list, requests: int, concurrency: int) -> dict:
+    with ThreadPoolExecutor(max_workers=concurrency, thread_name_prefix='load') as executor:
+        start = time.perf_counter()
+        results = list(executor.map(invoke, (events[i % len(events)] for i in range(requests))))
+        elapsed = time.perf_counter() - start
+
+    latencies_ms = sorted(duration * 1000 for duration, _, _ in results)
+    outcomes = Counter(outcome for _, outcome, _ in results)
+    crm_calls = Counter()
+    for _, _, calls in results:
+        crm_calls.update(calls)
+    return {
+        'requests': requests,
+        'concurrency': concurrency,
+        'elapsed_s': round(elapsed, 3),
+        'throughput_rps': round(requests / elapsed, 1) if elapsed else 0.0,
+        'latency_ms': {
+            'p50': round(percentile(latencies_ms, 0.50), 1),
+            'p95': round(percentile(latencies_ms, 0.95), 1),
+            'p99': round(percentile(latencies_ms, 0.99), 1),
+            'mean': round(statistics.fmean(latencies_ms), 1) if latencies_ms else 0.0,
+            'max': round(latencies_ms[-1], 1) if latencies_ms else 0.0
+        },
+        'outcomes': dict(outcomes),
+        'crm_calls': dict(crm_calls)
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Load test lambda_handler against local CRM stand-ins')
+    parser.add_argument('--platform', default='salesforce', choices=['salesforce', 'pivotal', 'acrm'], help='CRM to simulate (default salesforce)')
+    parser.add_argument('--requests', type=int, default=200, help='Handler invocations to make (default 200)')
+    parser.add_argument('--concurrency', type=int, default=8, help='Invocations in flight at once (default 8)')
+    parser.add_argument('--accounts', type=int, default=20, help='Distinct accounts the events cycle through (default 20)')
+    parser.add_argument('--warmup', type=int, default=5, help='Untimed invocations made first (default 5)')
+    parser.add_argument('--url', help='Base URL of a stand-in server already running, instead of starting one')
+    parser.add_argument('--config', default='{}', help='JSON merged into every tenant config, e.g. {"fetch_mode": "split"}')
+    parser.add_argument('--json', action='store_true', help='Print the report as JSON')
+    add_settings_arguments(parser)
+    args = parser.parse_args()
+
+    settings = settings_from_args(args)
+    server = None
+    if args.url:
+        # Only used to rebuild the transcripts the external server's accounts match
+        store = AccountStore(settings)
+        base_url = args.url.rstrip('/') + '/'
+    else:
+        server = start_server(settings)
+        store = server.store
+        base_url = server.base_url
+
+    try:
+        events = build_events(args.platform, base_url, args.accounts, store, json.loads(args.config))
+        for event in events[:args.warmup]:
+            invoke(event)
+        crm_before = server.stats() if server else None
+
+        report = run(events, args.requests, args.concurrency)
+        report['platform'] = args.platform
+        if server:
+            crm_after = server.stats()
+            report['crm'] = {key: crm_after[key] - crm_before[key] for key in crm_after}
+        report['service_registry'] = crm_services.registry.stats()
+    finally:
+        if server:
+            server.shutdown()
+            server.server_close()
+
+    if args.json:
+        print(json.dumps(report, indent=2))
+        return
+
+    latency = report['latency_ms']
+    print(f"{args.platform}: {report['requests']} requests, concurrency {report['concurrency']}, {report['elapsed_s']} s")
+    print(f"  throughput  {report['throughput_rps']} req/s")
+    print(f"  latency ms  p50 {latency['p50']}  p95 {latency['p95']}  p99 {latency['p99']}  mean {latency['mean']}  max {latency['max']}")
+    print(f"  outcomes    {', '.join(f'{outcome}: {count}' for outcome, count in sorted(report['outcomes'].items()))}")
+    if 'crm' in report:
+        crm = report['crm']
+        print(f"  CRM         {crm['requests']} requests, {crm['injected_errors']} injected failures, {crm['bytes_sent'] / 1024:.0f} KiB sent")
+    calls = report['crm_calls']
+    print(
+        f"  resilience  {calls.get('retries', 0)} retries, {calls.get('hedges', 0)} hedges "
+        f"({calls.get('hedge_wins', 0)} won), {calls.get('circuit_open', 0)} calls refused by an open circuit, "
+        f"{calls.get('coalesced', 0)} fetches shared with a concurrent call"
+    )
+    registry = report['service_registry']
+    print(
+        f"  pooling     {registry['requests_sent']} requests over {registry['connections_opened']} connections, "
+        f"{registry['async_clients']} async clients"
+    )
+
+
+if __name__ == '__main__':
+    main()
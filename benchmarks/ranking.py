@@ -0,0 +1,331 @@
+"""
+Micro-benchmark the ranking functions on synthetic accounts.
+
+Accounts are built from the shipped data: opportunities are owned by users from
+data/users.csv, their line items are products those users sell according to
+data/users_products.csv (topped up from data/products.csv), and transcripts mix
+words from some of the account's product names with filler. Every ranking
+function each rank class implements is timed across growing account sizes:
+
+    calculate_product_match, calculate_name_match, rank_opportunity_score,
+    normalize_scores, determine_suggestion, and score_opportunities_batch
+
+Throughput is reported in opportunities per second (best of --repeat samples),
+and allocation as the tracemalloc peak of one separate, untimed run, so tracing
+overhead never skews the timings. Transcript features are rebuilt for each run
+so memoized matches from one run do not carry over to the next, as in a request.
+
+Usage:
+    python benchmarks/ranking.py [--sizes 10,100,1000] [--line-items 5]
+        [--transcript-words 2000] [--repeat 5] [--record] [--tolerance 0.3]
+
+Results are compared against benchmarks/baselines/ranking.json when it exists;
+the script exits with status 1 if any case lost more than --tolerance of its
+baseline throughput. With --record the current results become the baseline.
+"""
+import argparse
+import csv
+import gc
+import json
+import os
+import random
+import subprocess
+import sys
+import time
+import tracemalloc
+from datetime import datetime, timezone
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO_ROOT)
+
+from rank_services import ACRMRank, PivotalRank, SalesforceRank  # noqa: E402
+from records import OpportunityRecord  # noqa: E402
+from transcript_matching import TranscriptFeatures  # noqa: E402
+from user_affinity import UserProductAffinity  # noqa: E402
+
+
+BASELINE_PATH = os.path.join(REPO_ROOT, 'benchmarks', 'baselines', 'ranking.json')
+DATA_DIR = os.path.join(REPO_ROOT, 'data')
+
+# Shortest timed sample; faster operations are run several times per sample
+MIN_SAMPLE_SECONDS = 0.05
+
+# Stage values each CRM sends, as the rank classes look them up
+STAGES = {
+    'acrm': ['In Progress (BASE)', 'Won (BASE)', 'Verbal Agreement (BASE)', 'Rests (BASE)', 'Lost (BASE)', 'Cancelled (BASE)'],
+    'pivotal': [0, 1, 2, 3, 4],
+    'salesforce': ['Engaged', 'Proposal', 'Quote Follow-Up', 'Outreach', 'Review', 'Co-Term', 'Closed Won', 'Closed Lost']
+}
+
+RANK_CLASSES = {
+    'acrm': ACRMRank,
+    'pivotal': PivotalRank,
+    'salesforce': SalesforceRank
+}
+
+OPERATIONS = (
+    'calculate_product_match',
+    'calculate_name_match',
+    'rank_opportunity_score',
+    'normalize_scores',
+    'determine_suggestion',
+    'score_opportunities_batch'
+)
+
+FILLER_WORDS = (
+    'the', 'we', 'can', 'renewal', 'pricing', 'next', 'quarter', 'team', 'support', 'contract',
+    'license', 'seats', 'budget', 'timeline', 'follow', 'up', 'call', 'thanks', 'sounds', 'good'
+)
+
+
+class SyntheticData:
+    """Products, users and who sells what, loaded once from data/*.csv"""
+
+    def __init__(self):
+        with open(os.path.join(DATA_DIR, 'products.csv'), newline='', encoding='utf-8') as f:
+            self.products = [(row['Id'], row['Name']) for row in csv.DictReader(f) if row.get('Id') and row.get('Name')]
+        with open(os.path.join(DATA_DIR, 'users.csv'), newline='', encoding='utf-8') as f:
+            self.user_ids = [row['Id'] for row in csv.DictReader(f) if row.get('Id')]
+
+        self.product_names = dict(self.products)
+        self.affinity = UserProductAffinity.from_csv(os.path.join(DATA_DIR, 'users_products.csv'))
+
+    def account(self, platform: str, opportunities: int, line_items: int, transcript_words: int, seed: int) -> dict:
+        """Build one account's opportunities, their products and a call transcript"""
+        rng = random.Random(seed)
+        call_users = rng.sample(self.user_ids, min(3, len(self.user_ids)))
+
+        raw_opportunities = []
+        opportunity_products = []
+        for i in range(opportunities):
+            owner_id = rng.choice(call_users) if rng.random() < 0.3 else rng.choice(self.user_ids)
+
+            # Products the owner sells first, then anything from the catalog
+            owned = sorted(product_id for product_id in self.affinity.products_for([owner_id]) if product_id in self.product_names)
+            picked = rng.sample(owned, min(line_items, len(owned)))
+            while len(picked) < line_items:
+                picked.append(rng.choice(self.products)[0])
+
+            products = [{
+                'id': f"{i:06d}-{j}",
+                'opportunity_id': f"OPP{i:06d}",
+                'product_id': product_id,
+                'product_name': self.product_names[product_id]
+            } for j, product_id in enumerate(picked)]
+
+            raw_opportunities.append({
+                'Id': f"OPP{i:06d}",
+                'Name': f"{self.product_names[picked[0]] if picked else 'New'} renewal {i}",
+                'StageName': rng.choice(STAGES[platform]),
+                'OwnerId': owner_id
+            })
+            opportunity_products.append(products)
+
+        # Mention about a tenth of the account's products among the filler
+        mentioned = [product['product_name'] for products in opportunity_products for product in products if rng.random() < 0.1]
+        words = []
+        for name in mentioned:
+            words.extend(name.split())
+        words = words[:transcript_words // 2]
+        words.extend(rng.choice(FILLER_WORDS) for _ in range(transcript_words - len(words)))
+        rng.shuffle(words)
+
+        return {
+            'opportunities': raw_opportunities,
+            'opportunity_products': opportunity_products,
+            'transcript': ' '.join(words),
+            'user_ids': call_users
+        }
+
+
+def make_runner(rank_service, operation: str, account: dict):
+    """
+    Get a function that prepares one run of an operation over the whole account
+    and returns the callable to time, or None if the class does not implement it.
+    """
+    if not hasattr(rank_service, operation):
+        return None
+
+    opportunities = account['opportunities']
+    opportunity_products = account['opportunity_products']
+    transcript = account['transcript']
+    user_ids = account['user_ids']
+
+    if operation == 'calculate_product_match':
+        def prepare():
+            features = TranscriptFeatures(transcript)
+            return lambda: [rank_service.calculate_product_match(products, transcript, features) for products in opportunity_products]
+    elif operation == 'calculate_name_match':
+        def prepare():
+            features = TranscriptFeatures(transcript)
+            return lambda: [rank_service.calculate_name_match(opportunity['Name'], transcript, features) for opportunity in opportunities]
+    elif operation == 'rank_opportunity_score':
+        def prepare():
+            features = TranscriptFeatures(transcript)
+            return lambda: [
+                rank_service.rank_opportunity_score(opportunity, products, transcript, user_ids, features)
+                for opportunity, products in zip(opportunities, opportunity_products)
+            ]
+    elif operation == 'score_opportunities_batch':
+        # The handler scores records built once per request from the CRM records
+        opportunity_records = [
+            OpportunityRecord(
+                opportunity['Id'],
+                opportunity['Name'],
+                opportunity['StageName'],
+                opportunity['OwnerId'],
+                tuple(product['product_id'] for product in products),
+                tuple(product['product_name'] for product in products)
+            )
+            for opportunity, products in zip(opportunities, opportunity_products)
+        ]
+
+        def prepare():
+            features = TranscriptFeatures(transcript)
+            return lambda: rank_service.score_opportunities_batch(opportunity_records, transcript, user_ids, features=features)
+    else:
+        # normalize_scores and determine_suggestion work on scored records and
+        # modify them, so each run gets fresh copies
+        ranks = [random.Random(index).random() for index in range(len(opportunities))]
+
+        def prepare():
+            scored = [{'id': opportunity['Id'], 'rank': rank} for opportunity, rank in zip(opportunities, ranks)]
+            method = getattr(rank_service, operation)
+            return lambda: method(scored)
+
+    return prepare
+
+
+def measure(prepare, repeat: int) -> dict:
+    """
+    Time an operation like timeit: each sample runs enough freshly prepared runs
+    to last MIN_SAMPLE_SECONDS with the garbage collector off, and the fastest
+    sample is kept since slower ones only add scheduler and cache noise.
+    """
+    number = 1
+    while True:
+        runs = [prepare() for _ in range(number)]
+        start = time.perf_counter()
+        for run in runs:
+            run()
+        if time.perf_counter() - start >= MIN_SAMPLE_SECONDS or number >= 10000:
+            break
+        number *= 2
+
+    samples = []
+    gc_enabled = gc.isenabled()
+    gc.disable()
+    try:
+        for _ in range(repeat):
+            runs = [prepare() for _ in range(number)]
+            start = time.perf_counter()
+            for run in runs:
+                run()
+            samples.append((time.perf_counter() - start) / number)
+    finally:
+        if gc_enabled:
+            gc.enable()
+
+    run = prepare()
+    tracemalloc.start()
+    try:
+        run()
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+
+    return {'seconds': min(samples), 'peak_bytes': peak}
+
+
+def git_revision() -> str:
+    try:
+        return subprocess.run(
+            ['git', 'rev-parse', '--short', 'HEAD'], cwd=REPO_ROOT, capture_output=True, text=True, check=True
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return 'unknown'
+
+
+def load_baseline() -> dict:
+    if not os.path.exists(BASELINE_PATH):
+        return {}
+    with open(BASELINE_PATH, encoding='utf-8') as f:
+        return json.load(f)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the ranking functions on synthetic accounts')
+    parser.add_argument('--sizes', default='10,100,1000', help='Comma separated opportunity counts (default 10,100,1000)')
+    parser.add_argument('--line-items', type=int, default=5, help='Line items per opportunity (default 5)')
+    parser.add_argument('--transcript-words', type=int, default=2000, help='Transcript length in words (default 2000)')
+    parser.add_argument('--repeat', type=int, default=5, help='Timed runs per case (default 5)')
+    parser.add_argument('--platform', action='append', choices=sorted(RANK_CLASSES), help='Only benchmark these rank classes')
+    parser.add_argument('--seed', type=int, default=7, help='Seed for the synthetic accounts (default 7)')
+    parser.add_argument('--tolerance', type=float, default=0.3, help='Allowed throughput loss against the baseline (default 0.3)')
+    parser.add_argument('--record', action='store_true', help='Store the results as the new baseline')
+    args = parser.parse_args()
+
+    sizes = [int(size) for size in args.sizes.split(',') if size]
+    platforms = args.platform or sorted(RANK_CLASSES)
+    data = SyntheticData()
+    baseline = load_baseline().get('results', {})
+
+    results = {}
+    regressions = []
+    print(f"{'case':<60} {'opps/s':>12} {'peak KiB':>10} {'vs baseline':>12}")
+    for platform in platforms:
+        rank_service = RANK_CLASSES[platform]()
+        for size in sizes:
+            account = data.account(platform, size, args.line_items, args.transcript_words, args.seed)
+            for operation in OPERATIONS:
+                prepare = make_runner(rank_service, operation, account)
+                if prepare is None:
+                    continue
+
+                measured = measure(prepare, args.repeat)
+                key = f"{platform}/{operation}/{size}"
+                throughput = size / measured['seconds'] if measured['seconds'] else float('inf')
+                results[key] = {
+                    'ops_per_sec': round(throughput, 1),
+                    'peak_kib': round(measured['peak_bytes'] / 1024, 1)
+                }
+
+                comparison = ''
+                previous = baseline.get(key)
+                if previous and previous.get('ops_per_sec'):
+                    change = throughput / previous['ops_per_sec'] - 1
+                    comparison = f"{change:+.0%}"
+                    if change < -args.tolerance:
+                        regressions.append(key)
+                        comparison += ' !'
+
+                print(f"{key:<60} {throughput:>12,.0f} {results[key]['peak_kib']:>10,.1f} {comparison:>12}")
+
+    if regressions:
+        print(f"\n{len(regressions)} case(s) slower than the baseline by more than {args.tolerance:.0%}:")
+        for key in regressions:
+            print(f"  {key}")
+
+    if args.record:
+        os.makedirs(os.path.dirname(BASELINE_PATH), exist_ok=True)
+        with open(BASELINE_PATH, 'w', encoding='utf-8') as f:
+            json.dump({
+                'recorded_at': datetime.now(timezone.utc).isoformat(timespec='seconds'),
+                'revision': git_revision(),
+                'python': '.'.join(map(str, sys.version_info[:3])),
+                'settings': {
+                    'line_items': args.line_items,
+                    'transcript_words': args.transcript_words,
+                    'repeat': args.repeat,
+                    'seed': args.seed
+                },
+                'results': results
+            }, f, indent=2, sort_keys=True)
+            f.write('\n')
+        print(f"\nRecorded to {os.path.relpath(BASELINE_PATH, REPO_ROOT)}")
+
+    sys.exit(1 if regressions and not args.record else 0)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,174 @@
+"""
+Measure what the handler holds per opportunity and what serializing its
+requests and responses costs, on large synthetic accounts.
+
+A stand-in Salesforce service returns the account's combined-query records.
+Timed runs get the same decoded records every call, as from the account cache,
+so only the handler's own work is timed. The memory run gets a freshly decoded
+copy, as from the uncached service, so nothing outlives the fetch unless the
+handler keeps it. For each account size the benchmark reports:
+
+    fetch        fetch_account: pairing opportunities with their products, and
+                 the memory its result retains per opportunity
+    score        score_account over the fetched account
+    handler      a whole lambda_handler call, including request parsing and
+                 response serialization
+    json/orjson  decoding a batch request body and encoding a response body of
+                 the account's ranking with each library
+
+Times are the best of --repeat runs; memory is the tracemalloc size of the
+fetched account while it is held, and the peak while it was built.
+
+Usage:
+    python benchmarks/record_memory.py [--sizes 1000,10000,50000] [--line-items 5] [--repeat 5]
+"""
+import argparse
+import asyncio
+import json
+import os
+import sys
+import time
+import tracemalloc
+
+import orjson
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO_ROOT)
+os.environ.setdefault('LOG_LEVEL', 'CRITICAL')
+
+import crm_services  # noqa: E402
+import lambda_function  # noqa: E402
+import resilience  # noqa: E402
+from rank_services import SalesforceRank  # noqa: E402
+from ranking import SyntheticData  # noqa: E402
+from transcript_matching import get_transcript_features  # noqa: E402
+
+
+def salesforce_payload(account: dict) -> bytes:
+    """The account as the combined Salesforce query returns it, encoded"""
+    records = []
+    for opportunity, products in zip(account['opportunities'], account['opportunity_products']):
+        records.append({
+            'attributes': {'type': 'Opportunity', 'url': f"/services/data/v62.0/sobjects/Opportunity/{opportunity['Id']}"},
+            'Id': opportunity['Id'],
+            'Name': opportunity['Name'],
+            'StageName': opportunity['StageName'],
+            'OwnerId': opportunity['OwnerId'],
+            'CreatedDate': '2024-01-01T00:00:00.000+0000',
+            'OpportunityLineItems': [{
+                'attributes': {'type': 'OpportunityLineItem'},
+                'Id': product['id'],
+                'OpportunityId': opportunity['Id'],
+                'Product2Id': product['product_id'],
+                'Product2': {'attributes': {'type': 'Product2'}, 'Name': product['product_name']},
+                'Quantity': 1.0
+            } for product in products]
+        })
+    return json.dumps(records).encode('utf-8')
+
+
+class StandInService:
+    """Returns the account's records, decoded once or, with fresh set, on every call"""
+
+    def __init__(self, payload: bytes):
+        self.payload = payload
+        self.records = json.loads(payload)
+        self.fresh = False
+        self.policy = resilience.CallPolicy(('benchmark', None), {})
+
+    async def aget_opportunities_with_products(self, user_ids, account_id, product_ids = []):
+        return json.loads(self.payload) if self.fresh else self.records
+
+
+def best_of(run, repeat: int) -> float:
+    durations = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        run()
+        durations.append(time.perf_counter() - start)
+    return min(durations)
+
+
+def fetch(service, account: dict):
+    return asyncio.run(lambda_function.fetch_account(service, {}, account['user_ids'], 'ACCOUNT', []))
+
+
+def retained_memory(service, account: dict) -> tuple:
+    service.fresh = True
+    tracemalloc.start()
+    try:
+        fetched = fetch(service, account)
+        current, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+        service.fresh = False
+    del fetched
+    return current, peak
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark record memory and request/response serialization')
+    parser.add_argument('--sizes', default='1000,10000,50000', help='Comma separated opportunity counts (default 1000,10000,50000)')
+    parser.add_argument('--line-items', type=int, default=5, help='Line items per opportunity (default 5)')
+    parser.add_argument('--transcript-words', type=int, default=2000, help='Words in the transcript (default 2000)')
+    parser.add_argument('--repeat', type=int, default=5, help='Timed runs per case (default 5)')
+    parser.add_argument('--seed', type=int, default=7, help='Seed for the synthetic accounts (default 7)')
+    args = parser.parse_args()
+
+    data = SyntheticData()
+    rank_service = SalesforceRank()
+
+    print(
+        f"{'opportunities':>13}  {'fetch ms':>9} {'B/opp':>7} {'peak B/opp':>10}  {'score ms':>9}  {'handler ms':>10}  "
+        f"{'json in/out ms':>15}  {'orjson in/out ms':>16}"
+    )
+    for size in (int(size) for size in args.sizes.split(',') if size):
+        account = data.account('salesforce', size, args.line_items, args.transcript_words, args.seed)
+        service = StandInService(salesforce_payload(account))
+        crm_services.get_service = lambda crm_platform, config: service
+
+        fetch_seconds = best_of(lambda: fetch(service, account), args.repeat)
+        retained, peak = retained_memory(service, account)
+
+        opportunity_records = fetch(service, account)
+        features = get_transcript_features(account['transcript'])
+        config = {'crm_platform': 'salesforce', 'access_token': 'token', 'emit_metrics': False}
+        score_seconds = best_of(lambda: lambda_function.score_account(
+            rank_service, config, opportunity_records, account['transcript'], features, account['user_ids']
+        ), args.repeat)
+
+        event = {'body': json.dumps({
+            'data': {'transcript': account['transcript'], 'account_id': 'ACCOUNT', 'user_ids': account['user_ids']},
+            'config': config
+        })}
+        handler_seconds = best_of(lambda: lambda_function.lambda_handler(event, None), args.repeat)
+
+        # Every opportunity ranked, the largest response the handler can build
+        result = [{
+            'id': opportunity['Id'],
+            'name': opportunity['Name'],
+            'stage_name': opportunity['StageName'],
+            'owner_id': opportunity['OwnerId'],
+            'rank': round(1 / size, 2),
+            'suggested': False
+        } for opportunity in account['opportunities']]
+        response = {'result': result, 'error': None, 'metadata': {}}
+        request = json.dumps({'items': [
+            {'transcript': account['transcript'], 'account_id': f"ACCOUNT{i}", 'user_ids': account['user_ids']}
+            for i in range(max(1, size // 100))
+        ], 'config': config})
+
+        json_in = best_of(lambda: json.loads(request), args.repeat)
+        json_out = best_of(lambda: json.dumps(response), args.repeat)
+        orjson_in = best_of(lambda: orjson.loads(request), args.repeat)
+        orjson_out = best_of(lambda: orjson.dumps(response).decode('utf-8'), args.repeat)
+
+        print(
+            f"{size:>13,}  {fetch_seconds * 1000:>9.1f} {retained / size:>7.0f} {peak / size:>10.0f}  "
+            f"{score_seconds * 1000:>9.1f}  {handler_seconds * 1000:>10.1f}  "
+            f"{json_in * 1000:>7.2f}/{json_out * 1000:<7.2f}  {orjson_in * 1000:>8.2f}/{orjson_out * 1000:<7.2f}"
+        )
+
+
+if __name__ == '__main__':
+    main()
@@ -1,64 +1,442 @@
+import asyncio
+import hashlib
+import itertools
+import json
+import logging
+import threading
+from collections import OrderedDict
+from datetime import datetime, timezone
+import httpx
 import requests
+from requests.adapters import HTTPAdapter
 from urllib.parse import urljoin
 from typing import Dict
 import xml.etree.ElementTree as ET
 
+import account_cache
+import metrics
+import resilience
+import single_flight
+from resilience import CircuitOpenError
+
+
+logger = logging.getLogger(__name__)
+
+
+# Connection pool sizing for each service session. A request makes a couple of
+# concurrent calls to one host, so a few pools with room for bursts is plenty.
+POOL_CONNECTIONS = 4
+POOL_MAXSIZE = 16
+
+# Seconds an async client waits to connect. Each call's read timeout comes from
+# its tenant's CallPolicy, and the handler bounds the whole fetch with its deadline.
+ASYNC_CONNECT_TIMEOUT = 10
+
+# Maximum number of tenant service instances kept alive in a warm container
+MAX_REGISTERED_SERVICES = 32
+
+# Config fields that identify a tenant's CRM endpoint and credentials
+TENANT_IDENTITY_FIELDS = ('url_domain', 'username', 'password', 'access_token', 'form_name', 'pivotal_environment_name')
+
+# Every config field a service or its CallPolicy reads. Services are registered
+# by all of them, so the config of a service never changes under the requests
+# using it; a tenant whose settings change gets a new service.
+SERVICE_CONFIG_FIELDS = TENANT_IDENTITY_FIELDS + (
+    'acrm_product_table', 'acrm_product_fields', 'acrm_batch_size',
+    'account_cache', 'account_cache_refresh_interval', 'account_cache_ttl', 'product_catalog',
+    'crm_timeout', 'crm_max_attempts', 'crm_hedging'
+)
+
+# Product ids per Product2 lookup query, keeping the SOQL well under its length limit
+PRODUCT_LOOKUP_BATCH_SIZE = 200
+
+# Bytes read from a streamed ACRM response per parser feed
+ACRM_STREAM_CHUNK_SIZE = 64 * 1024
+
+# Default fields of an ACRM opportunity's product table. The table itself
+# differs between schemas, so products are only queried, nested under Y1, for
+# tenants that name it with config 'acrm_product_table'; 'acrm_product_fields'
+# overrides the fields.
+ACRM_PRODUCT_FIELDS = '2,3,4,5'
+
+# Element the XML interface returns each product row as, inside its opportunity
+ACRM_PRODUCT_ELEMENT = 'OpportunityItem'
+
+# Accounts queried per batched ACRM request
+ACRM_BATCH_SIZE = 20
+
+
+class IncompleteResultError(Exception):
+    """Raised when a later page of a query could not be fetched, so its records would be incomplete"""
+
+
+def create_session() -> requests.Session:
+    """Create a keep-alive session with a tuned connection pool"""
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=POOL_CONNECTIONS, pool_maxsize=POOL_MAXSIZE)
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+    return session
+
+
+class AsyncClientStats:
+    """
+    Requests a service's async clients sent and the connections they opened,
+    counted through httpx event hooks and httpcore's trace extension, since
+    its connection pool keeps no totals of its own
+    """
+
+    def __init__(self):
+        self.requests_sent = 0
+        self.connections_opened = 0
+
+    async def _trace(self, event_name: str, info: dict) -> None:
+        if event_name == 'connection.connect_tcp.complete':
+            self.connections_opened += 1
+
+    async def on_request(self, request: httpx.Request) -> None:
+        self.requests_sent += 1
+        request.extensions['trace'] = self._trace
+
+
+def create_async_client(stats: AsyncClientStats = None) -> httpx.AsyncClient:
+    """Create a keep-alive async client with the same pool size as the sessions, counting its requests in stats"""
+    return httpx.AsyncClient(
+        limits=httpx.Limits(max_connections=POOL_MAXSIZE, max_keepalive_connections=POOL_MAXSIZE),
+        timeout=httpx.Timeout(None, connect=ASYNC_CONNECT_TIMEOUT),
+        event_hooks={'request': [stats.on_request]} if stats is not None else None
+    )
+
+
+def get_async_client(service) -> httpx.AsyncClient:
+    """
+    Get a service's async client for the running event loop. Clients are bound
+    to the loop they were created on, so a new one replaces it on another loop.
+    """
+    loop = asyncio.get_running_loop()
+    if service.async_client is None or service.async_client_loop is not loop:
+        service.async_client = create_async_client(service.async_stats)
+        service.async_client_loop = loop
+    return service.async_client
+
+
+def close_service(service) -> None:
+    """Close a service's session, and its async client on the loop it belongs to"""
+    service.session.close()
+    loop = service.async_client_loop
+    if service.async_client is not None and loop is not None and loop.is_running():
+        asyncio.run_coroutine_threadsafe(service.async_client.aclose(), loop)
+
+
+def config_fingerprint(config, fields) -> str:
+    """Hash of the given config fields, so keys built from credentials do not hold them"""
+    values = {field: config.get(field) for field in fields}
+    return hashlib.sha256(json.dumps(values, sort_keys=True, default=str).encode('utf-8')).hexdigest()
+
+
+def account_key(config, key_parts) -> str:
+    """
+    Key of an account's records in the account cache and among fetches in
+    flight, scoped to the tenant's identity and credentials since tenants can
+    share an endpoint
+    """
+    return account_cache.AccountCache.make_key(config_fingerprint(config, TENANT_IDENTITY_FIELDS), *key_parts)
+
+
+def _fetch_through_cache(config, key, fetch_full, fetch_delta = None, sort_key = None):
+    if not config.get('account_cache'):
+        fetched = fetch_full()
+        return fetched[0] if fetched is not None else None
+
+    return account_cache.get_cache().fetch(
+        key,
+        fetch_full,
+        fetch_delta,
+        refresh_interval=config.get('account_cache_refresh_interval', account_cache.DEFAULT_REFRESH_INTERVAL),
+        ttl=config.get('account_cache_ttl', account_cache.DEFAULT_TTL),
+        sort_key=sort_key
+    )
+
+
+async def _afetch_through_cache(config, key, fetch_full, fetch_delta = None, sort_key = None):
+    if not config.get('account_cache'):
+        fetched = await fetch_full()
+        return fetched[0] if fetched is not None else None
+
+    return await account_cache.get_cache().afetch(
+        key,
+        fetch_full,
+        fetch_delta,
+        refresh_interval=config.get('account_cache_refresh_interval', account_cache.DEFAULT_REFRESH_INTERVAL),
+        ttl=config.get('account_cache_ttl', account_cache.DEFAULT_TTL),
+        sort_key=sort_key
+    )
+
+
+def cached_account_fetch(config, key_parts, fetch_full, fetch_delta = None, sort_key = None):
+    """
+    Fetch an account's records through the container's account cache if the
+    tenant enabled it with config 'account_cache', otherwise fetch them directly.
+
+    key_parts identify the platform, account and query shape, and account_key
+    scopes them to the tenant. Concurrent calls of the tenant with the same
+    key_parts share one fetch rather than each querying the CRM, so callers
+    must not modify the records returned.
+
+    Entries are refreshed after config 'account_cache_refresh_interval' seconds and
+    dropped after 'account_cache_ttl'; see AccountCache.fetch for the callbacks.
+    Returns the records, or None if they could not be fetched.
+    """
+    key = account_key(config, key_parts)
+    return single_flight.get_single_flight().do(
+        key,
+        lambda: _fetch_through_cache(config, key, fetch_full, fetch_delta, sort_key)
+    )
+
+
+async def acached_account_fetch(config, key_parts, fetch_full, fetch_delta = None, sort_key = None):
+    """Async version of cached_account_fetch, for coroutine function callbacks"""
+    key = account_key(config, key_parts)
+    return await single_flight.get_single_flight().ado(
+        key,
+        lambda: _afetch_through_cache(config, key, fetch_full, fetch_delta, sort_key)
+    )
+
 
 class ACRMService:
     def __init__(self, config: Dict[str, str]):
         self.config = config
+        # Whether opportunities can come with products, which ranking bounds scores by
+        self.fetches_products = bool(config.get('acrm_product_table'))
+        # Whether products are only those of the users' opportunities, see records.restrict_products
+        self.owner_scoped_products = False
+        self.session = create_session()
+        self.async_client = None
+        self.async_client_loop = None
+        self.async_stats = AsyncClientStats()
+        self.policy = resilience.CallPolicy(('acrm', config.get("url_domain")), config)
 
-    def _parse_xml_opportunities(self, xml_content: str) -> list:
+    def _parse_xml_opportunities(self, xml_content: str, account_id = None) -> list:
         """Parse XML response and extract opportunity data"""
         if not xml_content:
             return []
             
         try:
             root = ET.fromstring(xml_content)
-            opportunities = []
-            
             # Find all Opportunity elements in the XML that have an id attribute
-            for opp in root.findall('.//Opportunity[@id]'):
-                opportunity_data = {
-                    'id': opp.get('id'),  # Get the id attribute
-                    'name': opp.find('Opportunity').text if opp.find('Opportunity') is not None else '',
-                    'stage': opp.find('Status').text if opp.find('Status') is not None else ''
-                }
-                opportunities.append(opportunity_data)
-            
-            return opportunities
+            return [self._opportunity_record(opp, account_id) for opp in root.findall('.//Opportunity[@id]')]
             
         except ET.ParseError as e:
-            print(f"Failed to parse XML: {str(e)}")
+            logger.error("Failed to parse XML: %s", e)
             return []
 
-    def get_opportunity_products(self, user_ids, account_id, product_ids = [], format = False):
-        # TODO: Implement the logic to get the products for the opportunities
-        return []
+    def _element_text(self, element, tag):
+        child = element.find(tag)
+        return child.text if child is not None else ''
 
-    def get_opportunities_by_account_id(self, account_id, format = False):
-        query = f"""
+    def _opportunity_record(self, element, account_id, with_products = False) -> dict:
+        """
+        Build an opportunity record with the Salesforce field names the rankers
+        read, and with its product rows nested under OpportunityLineItems if requested
+        """
+        opportunity_id = element.get('id')
+        opportunity = {
+            'Id': opportunity_id,
+            'Name': self._element_text(element, 'Opportunity'),
+            'StageName': self._element_text(element, 'Status'),
+            'AccountId': account_id
+        }
+        if with_products:
+            opportunity['OpportunityLineItems'] = [
+                {
+                    'Id': item.get('id'),
+                    'OpportunityId': opportunity_id,
+                    'Product2Id': self._element_text(item, 'ProductNo'),
+                    'Product2': {'Name': self._element_text(item, 'Product')}
+                }
+                for item in element.findall(f"{ACRM_PRODUCT_ELEMENT}[@id]")
+            ]
+        return opportunity
+
+    def _read_opportunity_events(self, parser, open_elements, with_products = False) -> list:
+        """
+        Collect the opportunities whose element closed in the events read so far.
+
+        open_elements is the stack of elements started but not yet ended. Each
+        opportunity is detached from its parent once read, so the tree only ever
+        holds the record currently being parsed.
+        """
+        opportunities = []
+        for event, element in parser.read_events():
+            if event == 'start':
+                open_elements.append(element)
+                continue
+
+            open_elements.pop()
+            # Same records as findall('.//Opportunity[@id]'), which never matches the root
+            if element.tag != 'Opportunity' or element.get('id') is None or not open_elements:
+                continue
+
+            # The response nests each account's records under its FI table's recId
+            account_id = next((parent.get('recId') for parent in reversed(open_elements) if parent.get('recId')), None)
+            opportunities.append(self._opportunity_record(element, account_id, with_products))
+            open_elements[-1].remove(element)
+
+        return opportunities
+
+    def _iter_xml_opportunities(self, chunks, with_products = False):
+        """
+        Incrementally parse an XML response given as chunks of bytes, yielding
+        the same records as _parse_xml_opportunities as each one closes.
+
+        With with_products, records also carry their product rows, see
+        _opportunity_record. Records already yielded cannot be taken
+        back, so a malformed document ends the stream at the error instead of
+        producing no records at all.
+        """
+        parser = ET.XMLPullParser(events=('start', 'end'))
+        open_elements = []
+
+        try:
+            for chunk in chunks:
+                with metrics.span('parse'):
+                    parser.feed(chunk)
+                    opportunities = self._read_opportunity_events(parser, open_elements, with_products)
+                yield from opportunities
+
+            with metrics.span('parse'):
+                parser.close()
+                opportunities = self._read_opportunity_events(parser, open_elements, with_products)
+            yield from opportunities
+
+        except ET.ParseError as e:
+            logger.error("Failed to parse XML: %s", e)
+
+    def _product_schema(self) -> tuple:
+        """The tenant's product table and its fields, or (None, None) if it queries no products"""
+        if not self.fetches_products:
+            return None, None
+        return self.config.get('acrm_product_table'), self.config.get('acrm_product_fields', ACRM_PRODUCT_FIELDS)
+
+    def _build_query(self, account_ids, with_products = False) -> str:
+        """
+        Build one XML request for the opportunities of every account, with their
+        products if requested and the tenant configured its product table
+        """
+        product_table, product_fields = self._product_schema() if with_products else (None, None)
+        opportunity_table = f'<table table="Y1"><table table="{product_table}" /></table>' if product_table else '<table table="Y1" />'
+        account_tables = ''.join(
+            f'<table table="FI" recId="{account_id}">{opportunity_table}</table>'
+            for account_id in account_ids
+        )
+        product_fields = f'<fields table="{product_table}" fields="{product_fields}" />' if product_table else ''
+
+        return f"""
         <request pwd="{self.config.get('password')}" user="{self.config.get('username')}">
             <query>
                 <tables>
-                    <table table="FI" recId="{account_id}">
-                        <table table="Y1" />
-                    </table>
+                    {account_tables}
                 </tables>
                 <fields table="Y1" fields="6,7,8,15,16,17,43,51" />
+                {product_fields}
             </query>
         </request>
         """
+
+    def _post_query(self, query):
         headers = {
             'Content-Type': 'application/xml',
             'Accept': 'application/xml'
         }
 
+        # Queries only read, so they are safe to retry
+        response = self.policy.call(
+            'xml',
+            lambda timeout: self.session.post(self.config.get("url_domain"), headers=headers, data=query, timeout=timeout),
+            idempotent=True
+        )
         try:
-            response = requests.post(self.config.get("url_domain"), headers=headers, data=query)
             response.raise_for_status()
+        except Exception:
+            response.close()
+            raise
+
+        return response
 
-            opportunities = self._parse_xml_opportunities(response.text)
+    def _filter_line_items(self, opportunity, product_ids):
+        if product_ids:
+            opportunity['OpportunityLineItems'] = [
+                line_item for line_item in opportunity['OpportunityLineItems']
+                if line_item['Product2Id'] in product_ids
+            ]
+        return opportunity
+
+    def get_opportunity_products(self, user_ids, account_id, product_ids = [], format = False):
+        """
+        Fetch the product rows of the account's opportunities as line item
+        records, or none for a tenant without a product table.
+
+        ACRM opportunities carry no owner in the requested fields, so user_ids
+        does not filter the products as it does for Salesforce.
+        """
+        records = []
+        if self.fetches_products:
+            try:
+                response = self._post_query(self._build_query([account_id], with_products=True))
+                records = [
+                    line_item
+                    for opportunity in self._iter_xml_opportunities([response.content], with_products=True)
+                    for line_item in self._filter_line_items(opportunity, product_ids)['OpportunityLineItems']
+                ]
+            except Exception as e:
+                logger.error("Error fetching opportunity products: %s", e)
+
+        if format:
+            return records
+
+        return {
+            "totalSize": len(records),
+            "records": records
+        }
+
+    def _cache_key(self, account_id, product_ids) -> tuple:
+        return ('acrm', 'opportunities_with_products', str(account_id), sorted(product_ids or []), self._product_schema())
+
+    def _cached_batch_accounts(self, account_ids, product_ids) -> Dict[str, list]:
+        """
+        Key a batch's distinct account ids to their records if the account cache
+        has them within the refresh interval, or to None if they need fetching.
+        """
+        account_ids = dict.fromkeys(str(account_id) for account_id in account_ids)
+        if not self.config.get('account_cache'):
+            return account_ids
+
+        cache = account_cache.get_cache()
+        refresh_interval = self.config.get('account_cache_refresh_interval', account_cache.DEFAULT_REFRESH_INTERVAL)
+        ttl = self.config.get('account_cache_ttl', account_cache.DEFAULT_TTL)
+        return {
+            account_id: cache.get_fresh(account_key(self.config, self._cache_key(account_id, product_ids)), refresh_interval, ttl)
+            for account_id in account_ids
+        }
+
+    def _cache_batch_accounts(self, results, account_ids, product_ids) -> None:
+        """Store the fetched accounts, serving stale cached records for those that failed"""
+        if not self.config.get('account_cache'):
+            return
+
+        cache = account_cache.get_cache()
+        ttl = self.config.get('account_cache_ttl', account_cache.DEFAULT_TTL)
+        for account_id in account_ids:
+            key = account_key(self.config, self._cache_key(account_id, product_ids))
+            results[account_id] = cache.update(key, results[account_id], ttl=ttl)
+
+    def get_opportunities_by_account_id(self, account_id, format = False):
+        """Fetch the account's opportunities"""
+        try:
+            response = self._post_query(self._build_query([account_id]))
+
+            with metrics.span('parse'):
+                opportunities = self._parse_xml_opportunities(response.text, account_id)
             
             if format:
                 return opportunities
@@ -69,18 +447,182 @@ class ACRMService:
             }
 
         except Exception as e:
-            print(f"Error fetching opportunities by account ID: {e}")
+            logger.error("Error fetching opportunities by account ID: %s", e)
             return [] if format else {"totalSize": 0, "records": []}
 
+    async def _apost_query(self, query, with_products = False) -> list:
+        """
+        Post a query with the async client and parse its opportunities as the
+        body arrives, collecting them into a list. HTTP errors are raised; a
+        malformed document ends the records at the error, as with
+        _iter_xml_opportunities.
+        """
+        headers = {
+            'Content-Type': 'application/xml',
+            'Accept': 'application/xml'
+        }
+
+        parser = ET.XMLPullParser(events=('start', 'end'))
+        open_elements = []
+        opportunities = []
+
+        client = get_async_client(self)
+        response = await self.policy.acall(
+            'xml',
+            lambda timeout: client.send(
+                client.build_request('POST', self.config.get("url_domain"), headers=headers, content=query, timeout=timeout),
+                stream=True
+            ),
+            idempotent=True
+        )
+        try:
+            response.raise_for_status()
+            async for chunk in response.aiter_bytes(ACRM_STREAM_CHUNK_SIZE):
+                with metrics.span('parse'):
+                    parser.feed(chunk)
+                    opportunities.extend(self._read_opportunity_events(parser, open_elements, with_products))
+
+            with metrics.span('parse'):
+                parser.close()
+                opportunities.extend(self._read_opportunity_events(parser, open_elements, with_products))
+        except ET.ParseError as e:
+            logger.error("Failed to parse XML: %s", e)
+        finally:
+            await response.aclose()
+
+        return opportunities
+
+    async def _afetch_opportunities_with_products(self, account_id, product_ids):
+        try:
+            opportunities = await self._apost_query(self._build_query([account_id], with_products=True), with_products=True)
+        except Exception as e:
+            logger.error("Error fetching opportunities with products: %s", e)
+            return None
+
+        return [self._filter_line_items(opportunity, product_ids) for opportunity in opportunities]
+
+    async def aget_opportunities_with_products(self, user_ids, account_id, product_ids = []):
+        """
+        Fetch the account's opportunities with their products nested under
+        'OpportunityLineItems', from a single FI -> Y1 -> product table query.
+        Tenants without config 'acrm_product_table' get the opportunities query
+        alone, and their records carry no line items.
+
+        Records use the Salesforce field names the rankers read (Id, Name,
+        StageName). Returns None if the request failed so callers can fall back
+        to fetching opportunities and products separately.
+
+        The XML interface has no modified-since filter, so with the account cache
+        enabled the whole account is fetched again once its entry is due a refresh.
+        """
+        async def fetch_full():
+            opportunities = await self._afetch_opportunities_with_products(account_id, product_ids)
+            return (opportunities, None) if opportunities is not None else None
+
+        return await acached_account_fetch(self.config, self._cache_key(account_id, product_ids), fetch_full)
+
+    async def aget_opportunities_with_products_batch(self, account_ids, product_ids = [], batch_size = None) -> Dict[str, list]:
+        """
+        Fetch opportunities with products for many accounts, packing up to
+        batch_size (config 'acrm_batch_size', default ACRM_BATCH_SIZE) recIds
+        into each XML request and sending the requests concurrently. With the
+        account cache enabled, accounts cached within the refresh interval are
+        not requested at all.
+
+        Returns the records of each account keyed by account id, or None for
+        the accounts whose request failed.
+        """
+        batch_size = batch_size or self.config.get('acrm_batch_size', ACRM_BATCH_SIZE)
+        results = self._cached_batch_accounts(account_ids, product_ids)
+        account_ids = [account_id for account_id, opportunities in results.items() if opportunities is None]
+
+        async def fetch_batch(batch):
+            try:
+                opportunities = await self._apost_query(self._build_query(batch, with_products=True), with_products=True)
+            except Exception as e:
+                logger.error("Error fetching opportunities for %s accounts: %s", len(batch), e)
+                return
+
+            results.update((account_id, []) for account_id in batch)
+            for opportunity in opportunities:
+                if opportunity['AccountId'] in results:
+                    results[opportunity['AccountId']].append(self._filter_line_items(opportunity, product_ids))
+
+        await asyncio.gather(*[
+            fetch_batch(account_ids[start:start + batch_size]) for start in range(0, len(account_ids), batch_size)
+        ])
+
+        self._cache_batch_accounts(results, account_ids, product_ids)
+        return results
+
+    async def _aaccount_response(self, account_id) -> list:
+        """
+        The account's opportunities with their product rows, from one uncached
+        request shared by the split calls running at the same time. Products
+        only come nested in the opportunity query, so the opportunities and
+        products of a split fetch are both read from this one response.
+        """
+        key = account_key(self.config, ('acrm', 'account_response', str(account_id)))
+        return await single_flight.get_single_flight().ado(
+            key,
+            lambda: self._apost_query(self._build_query([account_id], with_products=True), with_products=True)
+        )
+
+    async def aget_opportunities_by_account_id(self, account_id):
+        """
+        Async version of get_opportunities_by_account_id with format, returning a
+        list. For a tenant with a product table, opportunities are read from the
+        response aget_opportunity_products shares, falling back to the query
+        without products if that request failed.
+        """
+        if self.fetches_products:
+            try:
+                return await self._aaccount_response(account_id)
+            except Exception as e:
+                logger.error("Error fetching opportunities with products by account ID: %s", e)
+
+        try:
+            return await self._apost_query(self._build_query([account_id]))
+        except Exception as e:
+            logger.error("Error fetching opportunities by account ID: %s", e)
+            return []
+
+    async def aget_opportunity_products(self, user_ids, account_id, product_ids = []):
+        """Async version of get_opportunity_products with format, returning a list"""
+        if not self.fetches_products:
+            return []
+
+        try:
+            opportunities = await self._aaccount_response(account_id)
+        except Exception as e:
+            logger.error("Error fetching opportunity products: %s", e)
+            return []
+
+        return [
+            line_item
+            for opportunity in opportunities
+            for line_item in opportunity['OpportunityLineItems']
+            if not product_ids or line_item['Product2Id'] in product_ids
+        ]
+
 
 class PivotalService:
     def __init__(self, config: Dict[str, str]):
         self.config = config
+        # The retrieve action returns no products, so ranking bounds Pivotal scores without them
+        self.fetches_products = False
+        self.owner_scoped_products = False
+        self.session = create_session()
+        self.async_client = None
+        self.async_client_loop = None
+        self.async_stats = AsyncClientStats()
+        self.policy = resilience.CallPolicy(('pivotal', config.get("url_domain")), config)
             
-    def _retrieve_form_record(self, access_token, record_id, payload):
+    def _form_record_request(self, record_id) -> tuple:
+        """URL and headers of the retrieve action for a record"""
         url = urljoin(self.config.get("url_domain"), f"/PivotalUx/rest/forms/formData/actions/retrieve?recordId={record_id}&form={self.config.get('form_name')}")
         
-        print(f"URL: {url}")
+        logger.debug("URL: %s", url)
         
         headers = {
             'Accept': 'application/json',
@@ -89,93 +631,234 @@ class PivotalService:
             'pivotalEnvironmentName': self.config.get('pivotal_environment_name')
         }
         
-        print(f"Making request to URL: {url}")
-        print(f"Headers: {headers}")
-        print(f"Payload: {payload}")
+        logger.debug("Making request to URL: %s", url)
+        logger.debug("Headers: %s", headers)
+
+        return url, headers
+
+    def _form_record_result(self, json_response) -> dict:
+        success = json_response['success']
+        total_size = 1 if json_response['success'] == True else 0
+        records = json_response['payload']['data']['primary'] if success else []
+        
+        return {
+            "success": success,
+            "totalSize": total_size,
+            "records": [records] if total_size == 1 else records
+        }
+
+    def _retrieve_form_record(self, access_token, record_id, payload):
+        url, headers = self._form_record_request(record_id)
+        logger.debug("Payload: %s", payload)
         
         try:
-            response = requests.post(url, headers=headers, json=payload)
+            # The retrieve action only reads, so it is safe to retry
+            response = self.policy.call(
+                'retrieve',
+                lambda timeout: self.session.post(url, headers=headers, json=payload, timeout=timeout),
+                idempotent=True
+            )
             
-            print(f"Response status code: {response.status_code}")
+            logger.debug("Response status code: %s", response.status_code)
 
             # Check if response is successful
             response.raise_for_status()
             
             # Check if response has content
             if not response.text:
-                print("Empty response received")
+                logger.warning("Empty response received")
                 return []
                 
-            json_response = response.json()
-            success = json_response['success']
-            total_size = 1 if json_response['success'] == True else 0
-            records = json_response['payload']['data']['primary'] if success else []
+            with metrics.span('parse'):
+                json_response = response.json()
+            return self._form_record_result(json_response)
             
-            return {
-                "success": success,
-                "totalSize": total_size,
-                "records": [records] if total_size == 1 else records
-            }
-            
-        except requests.exceptions.RequestException as e:
-            print(f"Request failed: {str(e)}")
+        except (requests.exceptions.RequestException, CircuitOpenError) as e:
+            logger.error("Request failed: %s", e)
             return []
         except ValueError as e:
-            print(f"JSON decode failed: {str(e)}")
+            logger.error("JSON decode failed: %s", e)
             return []
 
-    def get_opportunities_by_account_id(self, account_id, format = False):
-        print(f"Getting opportunities for account: {account_id}")
-        result = self._retrieve_form_record(account_id, {})        
-        parent_record = result.get('records')[0] if result.get('totalSize') == 1 else None        
+    async def _aretrieve_form_record(self, record_id, payload):
+        """Async version of _retrieve_form_record"""
+        url, headers = self._form_record_request(record_id)
+        logger.debug("Payload: %s", payload)
+
+        try:
+            client = get_async_client(self)
+            response = await self.policy.acall(
+                'retrieve',
+                lambda timeout: client.post(url, headers=headers, json=payload, timeout=timeout),
+                idempotent=True
+            )
+
+            logger.debug("Response status code: %s", response.status_code)
+            response.raise_for_status()
+
+            if not response.text:
+                logger.warning("Empty response received")
+                return []
+
+            with metrics.span('parse'):
+                json_response = response.json()
+            return self._form_record_result(json_response)
+
+        except (httpx.HTTPError, CircuitOpenError) as e:
+            logger.error("Request failed: %s", e)
+            return []
+        except ValueError as e:
+            logger.error("JSON decode failed: %s", e)
+            return []
+
+    def _format_opportunities(self, result):
+        """Pull the opportunities out of a retrieve result, or None if the request failed"""
+        # Failed requests come back as an empty list
+        if not result:
+            return None
+        parent_record = result.get('records')[0] if result.get('totalSize') == 1 else None
         raw_opportunities = parent_record.get('Opportunities__Secondary', []) if parent_record else []
-        opportunities = [
+        # Records use the Salesforce field names the rankers read
+        return [
             {
-                "id": opportunity.get('SFA_Opportunity_Id'),
-                "name": opportunity.get('Opportunity_Name'),
-                "stage": opportunity.get('Status')
+                "Id": opportunity.get('SFA_Opportunity_Id'),
+                "Name": opportunity.get('Opportunity_Name'),
+                "StageName": opportunity.get('Status')
             } for opportunity in raw_opportunities
         ]
-        
-        print(f"Opportunities: {opportunities}")
+
+    def _cache_key(self, account_id) -> tuple:
+        return ('pivotal', 'opportunities', account_id)
+
+    def get_opportunities_by_account_id(self, account_id, format = False):
+        logger.debug("Getting opportunities for account: %s", account_id)
+
+        def fetch_full():
+            opportunities = self._format_opportunities(self._retrieve_form_record(self.config.get("access_token"), account_id, {}))
+            return (opportunities, None) if opportunities is not None else None
+
+        # The retrieve action has no modified-since filter, so cached accounts are refreshed in full
+        opportunities = cached_account_fetch(self.config, self._cache_key(account_id), fetch_full) or []
+
+        logger.debug("Opportunities: %s", opportunities)
 
         return opportunities
 
+    async def aget_opportunities_by_account_id(self, account_id):
+        """Async version of get_opportunities_by_account_id"""
+        logger.debug("Getting opportunities for account: %s", account_id)
+
+        async def fetch_full():
+            opportunities = self._format_opportunities(await self._aretrieve_form_record(account_id, {}))
+            return (opportunities, None) if opportunities is not None else None
+
+        return await acached_account_fetch(self.config, self._cache_key(account_id), fetch_full) or []
+
     def get_opportunity_products(self, user_ids, account_id, product_ids = [], format = False):
         # TODO: Implement the logic to get the products for the opportunities
         return []
 
+    async def aget_opportunity_products(self, user_ids, account_id, product_ids = []):
+        return []
 
-class SalesforceService:
 
+class SalesforceService:
     def __init__(self, config: Dict[str, str]):
 
         self.config = config
+        # Whether opportunities can come with products, which ranking bounds scores by
+        self.fetches_products = True
+        # Whether products are only those of the users' opportunities, see records.restrict_products
+        self.owner_scoped_products = True
+        self.session = create_session()
+        self.async_client = None
+        self.async_client_loop = None
+        self.async_stats = AsyncClientStats()
+        self.policy = resilience.CallPolicy(('salesforce', config.get("url_domain")), config)
     
-    def _perform_query(self, query, format = False):
-        url = urljoin(self.config.get("url_domain"), f"services/data/v62.0/query")
-        headers = {
+    def _headers(self):
+        return {
             'Authorization': f'Bearer {self.config.get("access_token")}',
             'Content-Type': 'application/json'
         }
-        
-        print(f"URL: {url}")
-        print(f"Query: {query}")
-        
-        response = requests.get(url, headers=headers, params={'q': query})
-        
+
+    def _get_page(self, url, params = None):
+        """Fetch a single page of query results, returning None if the request failed"""
+        logger.debug("URL: %s", url)
+
+        response = self.policy.call(
+            'query',
+            lambda timeout: self.session.get(url, headers=self._headers(), params=params, timeout=timeout),
+            idempotent=True
+        )
+
         if response.status_code != 200:
-            print(f"Failed to fetch data: {response.status_code} - {response.text}")
-            return []
-        
-        response_json = response.json()
-        
+            logger.error("Failed to fetch data: %s - %s", response.status_code, response.text)
+            return None
+
+        with metrics.span('parse'):
+            return response.json()
+
+    def _get_first_page(self, query):
+        url = urljoin(self.config.get("url_domain"), f"services/data/v62.0/query")
+
+        logger.debug("Query: %s", query)
+
+        return self._get_page(url, params={'q': query})
+
+    def _next_page_failed(self, error = None):
+        metrics.count('crm_partial_results')
+        return IncompleteResultError(f"Failed to fetch the next page of results: {error or 'request failed'}")
+
+    def _iter_pages(self, page):
+        """
+        Yield the records of each page, following nextRecordsUrl until the result is done.
+
+        Raises:
+            IncompleteResultError: If a later page could not be fetched
+        """
+        while page:
+            next_url = None if page.get('done', True) else page.get('nextRecordsUrl')
+            if next_url:
+                next_url = urljoin(self.config.get("url_domain"), next_url)
+
+            yield page.get('records') or []
+
+            if not next_url:
+                return
+
+            try:
+                page = self._get_page(next_url)
+            except Exception as e:
+                raise self._next_page_failed(e) from e
+            if page is None:
+                raise self._next_page_failed()
+
+    def stream_query(self, query):
+        """
+        Run a SOQL query and return an iterator over all of its records.
+
+        The first page is fetched eagerly so request errors surface here; the
+        remaining pages are fetched as the iterator is consumed.
+        """
+        page = self._get_first_page(query)
+        return itertools.chain.from_iterable(self._iter_pages(page))
+
+    def _perform_query(self, query, format = False):
         if format:
-            return response_json.get('records') if response_json.get('records') else []
-        
-        return response_json
+            return list(self.stream_query(query))
+
+        response_json = self._get_first_page(query)
+
+        return response_json if response_json is not None else []
     
-    def get_opportunity_products(self, user_ids, account_id, product_ids = [], format = False):   
+    def _line_item_fields(self):
+        # With the product catalog enabled, names are resolved locally from Product2Id
+        if self.config.get('product_catalog'):
+            return "Id, OpportunityId, Product2Id, Quantity"
+        return "Id, OpportunityId, Product2Id, Product2.Name, Quantity"
+
+    def _opportunity_products_query(self, user_ids, account_id, product_ids):
         product_filter = ""
         if product_ids:
             quoted_ids = [f"'{id}'" for id in product_ids]
@@ -186,28 +869,352 @@ class SalesforceService:
             quoted_ids = [f"'{id}'" for id in user_ids]
             users_filter = f" AND Opportunity.OwnerId IN ({','.join(quoted_ids)}) "
         
-        new_query = f"""
-        SELECT Id, OpportunityId, Product2Id, Product2.Name, Quantity
+        return f"""
+        SELECT {self._line_item_fields()}
         FROM OpportunityLineItem
         WHERE Opportunity.AccountId = '{account_id}'{users_filter}{product_filter}
         ORDER BY Opportunity.CreatedDate DESC
         """
+
+    def get_opportunity_products(self, user_ids, account_id, product_ids = [], format = False):
         try:
-            return self._perform_query(new_query, format)
+            return self._perform_query(self._opportunity_products_query(user_ids, account_id, product_ids), format)
         except Exception as e:
-            print(f"Error fetching opportunity products: {e}")
+            logger.error("Error fetching opportunity products: %s", e)
             return []
     
-    
-    def get_opportunities_by_account_id(self, account_id, format = False):
-        opportunity_query = f"""
+    def _opportunities_query(self, account_id):
+        return f"""
         SELECT Id, OwnerId, Name, StageName, AccountId, Account.Name, CreatedDate
         FROM Opportunity
         WHERE AccountId = '{account_id}'
         ORDER BY CreatedDate DESC
         """
+    
+    def get_opportunities_by_account_id(self, account_id, format = False):
         try:
-            return self._perform_query(opportunity_query, format)
+            return self._perform_query(self._opportunities_query(account_id), format)
         except Exception as e:
-            print(f"Error fetching opportunities by account ID: {e}")
+            logger.error("Error fetching opportunities by account ID: %s", e)
             return []
+
+    def _restrict_line_items(self, opportunity, user_ids):
+        """
+        Match the standalone line item query, which only returns products of the
+        users' opportunities, without modifying records that may be cached.
+        """
+        if user_ids and opportunity.get('OwnerId') not in user_ids and opportunity.get('OpportunityLineItems'):
+            return {**opportunity, 'OpportunityLineItems': []}
+        return opportunity
+
+    def _opportunities_with_products_query(self, account_id, product_ids, extra_filter = ""):
+        product_filter = ""
+        if product_ids:
+            quoted_ids = [f"'{id}'" for id in product_ids]
+            product_filter = f" WHERE Product2Id IN ({','.join(quoted_ids)})"
+
+        # Cached accounts are refreshed with the records changed since the newest SystemModstamp seen
+        modstamp = ", SystemModstamp" if self.config.get('account_cache') else ""
+
+        return f"""
+        SELECT Id, OwnerId, Name, StageName, AccountId, Account.Name, CreatedDate{modstamp},
+            (SELECT {self._line_item_fields()}{modstamp} FROM OpportunityLineItems{product_filter})
+        FROM Opportunity
+        WHERE AccountId = '{account_id}'{extra_filter}
+        ORDER BY CreatedDate DESC
+        """
+
+    def _newest_modstamp(self, opportunities):
+        modstamps = [
+            record['SystemModstamp']
+            for opportunity in opportunities
+            for record in itertools.chain([opportunity], opportunity['OpportunityLineItems'])
+            if record.get('SystemModstamp')
+        ]
+        return max(modstamps, key=self._parse_datetime) if modstamps else None
+
+    def _merge_changes(self, changed, line_items_changed):
+        markers = [marker for marker in (changed[1], line_items_changed[1]) if marker]
+        return changed[0] + line_items_changed[0], max(markers, key=self._parse_datetime) if markers else None
+
+    def _cache_key(self, account_id, product_ids) -> tuple:
+        # Line items differ in shape with and without the product catalog, so they are cached apart
+        return ('salesforce', 'opportunities_with_products', account_id, sorted(product_ids or []), self._line_item_fields())
+
+    def _cache_sort_key(self, opportunity):
+        return self._parse_datetime(opportunity.get('CreatedDate'))
+
+    async def _aget_page(self, url, params = None):
+        """Async version of _get_page"""
+        logger.debug("URL: %s", url)
+
+        client = get_async_client(self)
+        response = await self.policy.acall(
+            'query',
+            lambda timeout: client.get(url, headers=self._headers(), params=params, timeout=timeout),
+            idempotent=True
+        )
+
+        if response.status_code != 200:
+            logger.error("Failed to fetch data: %s - %s", response.status_code, response.text)
+            return None
+
+        with metrics.span('parse'):
+            return response.json()
+
+    async def _acollect_pages(self, page) -> list:
+        """
+        Async version of _iter_pages, returning the records of every page.
+        Pages are fetched one after another and buffered until the last arrives.
+
+        Raises:
+            IncompleteResultError: If a later page could not be fetched
+        """
+        records = []
+        while page:
+            records.extend(page.get('records') or [])
+
+            next_url = None if page.get('done', True) else page.get('nextRecordsUrl')
+            if not next_url:
+                break
+
+            try:
+                page = await self._aget_page(urljoin(self.config.get("url_domain"), next_url))
+            except Exception as e:
+                raise self._next_page_failed(e) from e
+            if page is None:
+                raise self._next_page_failed()
+
+        return records
+
+    async def aquery(self, query):
+        """
+        Run a SOQL query with the async client, returning all of its records or
+        None if it failed. A failure after the first page raises
+        IncompleteResultError rather than returning part of the records.
+        """
+        logger.debug("Query: %s", query)
+
+        page = await self._aget_page(urljoin(self.config.get("url_domain"), "services/data/v62.0/query"), params={'q': query})
+        if page is None:
+            return None
+        return await self._acollect_pages(page)
+
+    async def aget_opportunity_products(self, user_ids, account_id, product_ids = []):
+        """Async version of get_opportunity_products with format, returning a list"""
+        try:
+            return await self.aquery(self._opportunity_products_query(user_ids, account_id, product_ids)) or []
+        except Exception as e:
+            logger.error("Error fetching opportunity products: %s", e)
+            return []
+
+    async def aget_opportunities_by_account_id(self, account_id):
+        """Async version of get_opportunities_by_account_id with format, returning a list"""
+        try:
+            return await self.aquery(self._opportunities_query(account_id)) or []
+        except Exception as e:
+            logger.error("Error fetching opportunities by account ID: %s", e)
+            return []
+
+    async def _anest_line_items(self, opportunity, user_ids):
+        """Replace the OpportunityLineItems subquery result with the full list of line items"""
+        line_items = opportunity.get('OpportunityLineItems') or {}
+        opportunity['OpportunityLineItems'] = await self._acollect_pages(line_items) if line_items else []
+        return self._restrict_line_items(opportunity, user_ids)
+
+    async def _aquery_opportunities_with_products(self, user_ids, account_id, product_ids, extra_filter = ""):
+        """Run the combined query with the async client, returning None if it failed"""
+        try:
+            opportunities = await self.aquery(self._opportunities_with_products_query(account_id, product_ids, extra_filter))
+            if opportunities is None:
+                return None
+            return [await self._anest_line_items(opportunity, user_ids) for opportunity in opportunities]
+        except Exception as e:
+            logger.error("Error fetching opportunities with products: %s", e)
+            return None
+
+    async def _afetch_opportunities_with_products(self, account_id, product_ids, extra_filter = ""):
+        """
+        Run the combined query for all callers of the account, returning every
+        opportunity with all its line items and the newest SystemModstamp among
+        them, or None on failure.
+        """
+        opportunities = await self._aquery_opportunities_with_products(None, account_id, product_ids, extra_filter)
+        if opportunities is None:
+            return None
+        return opportunities, self._newest_modstamp(opportunities)
+
+    async def _afetch_opportunities_changed_since(self, account_id, product_ids, since):
+        """
+        Fetch the opportunities that changed, or whose line items changed, since the
+        given SystemModstamp. SOQL does not allow a semi-join under OR, so the two
+        are separate queries, run concurrently.
+        """
+        if not since:
+            return await self._afetch_opportunities_with_products(account_id, product_ids)
+
+        since = self._soql_datetime(since)
+        changed, line_items_changed = await asyncio.gather(
+            self._afetch_opportunities_with_products(account_id, product_ids, f" AND SystemModstamp >= {since}"),
+            self._afetch_opportunities_with_products(
+                account_id,
+                product_ids,
+                f" AND Id IN (SELECT OpportunityId FROM OpportunityLineItem WHERE SystemModstamp >= {since})"
+            )
+        )
+        if changed is None or line_items_changed is None:
+            return None
+
+        return self._merge_changes(changed, line_items_changed)
+
+    async def aget_opportunities_with_products(self, user_ids, account_id, product_ids = []):
+        """
+        Fetch the account's opportunities with their line items nested under
+        'OpportunityLineItems', using a relationship subquery so both come back
+        in a single round trip.
+
+        With the account cache enabled, the account is refreshed with only the
+        records changed since the last fetch, by SystemModstamp.
+
+        Returns None if the query failed so callers can fall back to
+        aget_opportunities_by_account_id and aget_opportunity_products.
+        """
+        opportunities = await acached_account_fetch(
+            self.config,
+            self._cache_key(account_id, product_ids),
+            lambda: self._afetch_opportunities_with_products(account_id, product_ids),
+            lambda since: self._afetch_opportunities_changed_since(account_id, product_ids, since),
+            sort_key=self._cache_sort_key
+        )
+        if opportunities is None:
+            return None
+        return [self._restrict_line_items(opportunity, user_ids) for opportunity in opportunities]
+
+    @staticmethod
+    def _parse_datetime(value):
+        """Parse a Salesforce datetime such as 2025-01-01T00:00:00.000+0000"""
+        if not value:
+            return datetime.min.replace(tzinfo=timezone.utc)
+        return datetime.strptime(value, '%Y-%m-%dT%H:%M:%S.%f%z')
+
+    @classmethod
+    def _soql_datetime(cls, value):
+        # SOQL datetime literals need a colon in the offset, e.g. +00:00
+        return cls._parse_datetime(value).isoformat(timespec='seconds')
+
+    def _products_by_id_queries(self, product_ids):
+        for start in range(0, len(product_ids), PRODUCT_LOOKUP_BATCH_SIZE):
+            quoted_ids = [f"'{id}'" for id in product_ids[start:start + PRODUCT_LOOKUP_BATCH_SIZE]]
+            yield f"SELECT Id, Name FROM Product2 WHERE Id IN ({','.join(quoted_ids)})"
+
+    async def aget_products_by_id(self, product_ids) -> list:
+        """Fetch Id and Name of the given products, e.g. those a product catalog cannot name yet"""
+        products = []
+        for query in self._products_by_id_queries(list(product_ids)):
+            products.extend(await self.aquery(query) or [])
+        return products
+
+    def get_products_modified_since(self, last_modified):
+        """Fetch Id, Name and LastModifiedDate of products changed after the given timestamp"""
+        modified_filter = ""
+        if last_modified:
+            modified_filter = f" WHERE LastModifiedDate > {self._soql_datetime(last_modified)}"
+
+        products_query = f"""
+        SELECT Id, Name, LastModifiedDate
+        FROM Product2{modified_filter}
+        """
+        return self._perform_query(products_query, format = True)
+
+
+SERVICE_CLASSES = {
+    'salesforce': SalesforceService,
+    'pivotal': PivotalService,
+    'acrm': ACRMService
+}
+
+
+class ServiceRegistry:
+    """
+    Keeps CRM service instances alive across warm invocations so their pooled
+    sessions can reuse connections instead of opening a new TCP+TLS handshake.
+
+    Instances are keyed by platform, domain and a fingerprint of every config
+    field they read (SERVICE_CONFIG_FIELDS), and the least recently used one is
+    closed once the registry is full.
+    """
+
+    def __init__(self, max_size: int = MAX_REGISTERED_SERVICES):
+        self.max_size = max_size
+        self._services = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def _key(self, crm_platform: str, config: Dict[str, str]) -> tuple:
+        return (crm_platform, config.get('url_domain'), config_fingerprint(config, SERVICE_CONFIG_FIELDS))
+
+    def get(self, crm_platform: str, config: Dict[str, str]):
+        """Return the service instance for this tenant config, creating it on a miss"""
+        key = self._key(crm_platform, config)
+
+        with self._lock:
+            service = self._services.get(key)
+            if service is not None:
+                self.hits += 1
+                self._services.move_to_end(key)
+                return service
+
+            self.misses += 1
+            service = SERVICE_CLASSES[crm_platform](config)
+            self._services[key] = service
+
+            while len(self._services) > self.max_size:
+                _, evicted = self._services.popitem(last=False)
+                close_service(evicted)
+
+            return service
+
+    def stats(self) -> dict:
+        """
+        Report registry hits/misses, the requests sent over the sessions and
+        async clients against the connections they opened, and how many
+        services have an async client
+        """
+        connections_opened = 0
+        requests_sent = 0
+        async_clients = 0
+
+        with self._lock:
+            for service in self._services.values():
+                if service.async_client is not None:
+                    async_clients += 1
+                connections_opened += service.async_stats.connections_opened
+                requests_sent += service.async_stats.requests_sent
+
+                # The same adapter is mounted for both schemes
+                adapters = {id(adapter): adapter for adapter in service.session.adapters.values()}
+                for adapter in adapters.values():
+                    pools = adapter.poolmanager.pools
+                    for pool_key in pools.keys():
+                        pool = pools.get(pool_key)
+                        if pool is not None:
+                            connections_opened += pool.num_connections
+                            requests_sent += pool.num_requests
+
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'size': len(self._services),
+            'connections_opened': connections_opened,
+            'requests_sent': requests_sent,
+            'async_clients': async_clients
+        }
+
+
+registry = ServiceRegistry()
+
+
+def get_service(crm_platform: str, config: Dict[str, str]):
+    """Get a pooled CRM service instance for the tenant from the module registry"""
+    return registry.get(crm_platform, config)
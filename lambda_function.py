@@ -1,163 +1,785 @@
-import json
+import asyncio
+import itertools
+import logging
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
 
+import numpy as np
+import orjson
 
+import account_cache
 import crm_services
+import metrics
 import rank_services
+import records
+import single_flight
+import product_catalog
+import user_affinity
+from product_catalog import ProductCatalog
+from transcript_matching import get_transcript_features
 
 
-def lambda_handler(event, context) -> dict:
-    body = json.loads(event['body'])
+# Debug output from every module is dropped unless LOG_LEVEL=DEBUG
+logging.getLogger().setLevel(os.environ.get('LOG_LEVEL', 'INFO'))
+logger = logging.getLogger(__name__)
 
-    print(body)
 
-    data = body.get('data')
-    if not data:
-        return {
-            'statusCode': 400,
-            'body': json.dumps({
-                'error': 'Missing required parameters: data is required'
-            })
-        }
-    
-    config = body.get('config', {})
+# Seconds the handler waits for the CRM fetch stage before giving up on a call
+DEFAULT_FETCH_TIMEOUT = 25
 
-    transcript = data.get('transcript')
-    user_ids = data.get('user_ids')
-    account_id = data.get('account_id')
-    product_ids = data.get('product_ids')
+# Lowest raw score an opportunity is ranked with, unless config 'rank_threshold' sets another
+DEFAULT_RANK_THRESHOLD = 0.5
 
-    if not transcript or not account_id:
-        print('Missing required parameters: transcript, account_id are required')
-        return {
-            'statusCode': 400,
-            'body': json.dumps({
-                'error': 'Missing required parameters: transcript, account_id are required'
-            })
+# Defaults for the heuristic-then-LLM cascade, enabled with config 'ranking_mode': 'cascade'
+DEFAULT_CASCADE_TOP_K = 5
+DEFAULT_LATENCY_BUDGET_MS = 8000
+
+# Defaults for batch requests: accounts fetched at once and items accepted per invocation
+DEFAULT_BATCH_CONCURRENCY = 4
+DEFAULT_MAX_BATCH_ITEMS = 500
+
+# Runs background product catalog refreshes, shared across warm invocations
+fetch_executor = ThreadPoolExecutor(max_workers=4, thread_name_prefix='crm-fetch')
+
+# Runs CPU-bound transcript and scoring work off the event loop, so the CRM
+# calls of other accounts keep being served while an account is scored
+scoring_executor = ThreadPoolExecutor(max_workers=DEFAULT_BATCH_CONCURRENCY, thread_name_prefix='scoring')
+
+# Event loop lambda_handler runs requests on, kept across warm invocations so
+# the services' async clients keep their pooled connections
+_event_loop = None
+_event_loop_lock = threading.Lock()
+
+
+def get_event_loop() -> asyncio.AbstractEventLoop:
+    """Get the container's background event loop, starting it on first use"""
+    global _event_loop
+    if _event_loop is None:
+        with _event_loop_lock:
+            if _event_loop is None:
+                loop = asyncio.new_event_loop()
+                threading.Thread(target=loop.run_forever, name='handler-loop', daemon=True).start()
+                _event_loop = loop
+    return _event_loop
+
+
+def run_in_thread(executor, fn, *args, **kwargs):
+    """Run a blocking function on an executor and await it, carrying over the request's metrics"""
+    return asyncio.wrap_future(metrics.submit(executor, fn, *args, **kwargs))
+
+
+async def _await_fetch(coroutine, deadline, label, default=list):
+    """Await a CRM call until the shared deadline, cancelling it and returning default() if it runs out"""
+    try:
+        return await asyncio.wait_for(coroutine, timeout=max(deadline - time.monotonic(), 0))
+    except asyncio.TimeoutError:
+        logger.warning("Timed out fetching %s", label)
+        return default()
+
+
+async def fetch_account_data(crm_service, user_ids, account_id, product_ids, timeout=DEFAULT_FETCH_TIMEOUT):
+    """
+    Fetch opportunity products and opportunities concurrently.
+
+    A failed or timed out products call yields an empty list so ranking falls back
+    to stage and owner weights. Errors fetching opportunities are raised as before.
+    """
+    deadline = time.monotonic() + timeout
+    raw_opportunity_products, raw_opportunities = await asyncio.gather(
+        _await_fetch(crm_service.aget_opportunity_products(user_ids, account_id, product_ids), deadline, 'opportunity products'),
+        _await_fetch(crm_service.aget_opportunities_by_account_id(account_id), deadline, 'opportunities'),
+        return_exceptions=True
+    )
+
+    if isinstance(raw_opportunity_products, Exception):
+        logger.error("Error fetching opportunity products: %s", raw_opportunity_products)
+        raw_opportunity_products = []
+
+    if isinstance(raw_opportunities, Exception):
+        raise raw_opportunities
+
+    return raw_opportunity_products, raw_opportunities
+
+
+def get_product_catalog(crm_service, config) -> ProductCatalog | None:
+    """
+    Get the tenant's product catalog if it enabled it with config
+    'product_catalog', refreshing it in the background once it is older than
+    config 'catalog_refresh_interval' seconds.
+    """
+    if not config.get('product_catalog'):
+        return None
+
+    catalog = product_catalog.get_tenant_catalog(config.get('url_domain'))
+    refresh_interval = config.get('catalog_refresh_interval', product_catalog.DEFAULT_REFRESH_INTERVAL)
+    if hasattr(crm_service, 'get_products_modified_since') and catalog.needs_refresh(refresh_interval):
+        fetch_executor.submit(catalog.refresh, crm_service)
+
+    return catalog
+
+
+async def resolve_missing_product_names(crm_service, catalog, line_items, deadline) -> None:
+    """
+    Add the names of products the catalog cannot resolve to it, since line items
+    fetched for a catalog carry no Product2.Name. Without this, products new
+    since the catalog's last refresh would match nothing in the transcript.
+    """
+    if catalog is None or not hasattr(crm_service, 'aget_products_by_id'):
+        return
+
+    missing = {
+        line_item.get('Product2Id')
+        for line_item in line_items
+        if line_item.get('Product2Id')
+        and not (line_item.get('Product2') or {}).get('Name')
+        and line_item.get('Product2Id') not in catalog
+    }
+    if not missing:
+        return
+
+    metrics.count('catalog_misses', len(missing))
+    try:
+        products = await _await_fetch(crm_service.aget_products_by_id(sorted(missing)), deadline, 'missing product names')
+    except Exception as e:
+        logger.error("Error fetching missing product names: %s", e)
+        return
+
+    # Without LastModifiedDate these leave the catalog's refresh watermark alone
+    catalog.update({'Id': product.get('Id'), 'Name': product.get('Name')} for product in products)
+
+
+def ranking_stage_filter(crm_service, rank_service, config) -> records.StageFilter | None:
+    """
+    The stages whose opportunities can reach the rank threshold, or None to
+    keep every stage. Opportunities in other stages are dropped as their
+    records are built, and the account is not fetched at all if no stage can
+    qualify.
+
+    The cascade gives the LLM the best scored opportunities whatever their
+    score, so it needs them all. Config 'stage_pushdown' set to false turns the
+    filter off.
+    """
+    if config.get('ranking_mode') == 'cascade' or not config.get('stage_pushdown', True):
+        return None
+    return rank_service.stage_filter(
+        config.get('rank_threshold', DEFAULT_RANK_THRESHOLD),
+        config.get('affinity_weight', 0.0),
+        with_products=crm_service.fetches_products
+    )
+
+
+def uses_combined_fetch(crm_service, config) -> bool:
+    """Whether accounts are fetched with their products nested under each opportunity in one query"""
+    return config.get('fetch_mode', 'combined') == 'combined' and hasattr(crm_service, 'aget_opportunities_with_products')
+
+
+async def fetch_opportunities_with_products(crm_service, config, user_ids, account_id, product_ids, stage_filter=None):
+    """
+    Fetch the account's opportunities with their products as OpportunityRecords,
+    leaving out those in stages the stage_filter drops.
+
+    Services that support it return both in a single round trip with products
+    nested under each opportunity. Otherwise, when config 'fetch_mode' is
+    'split', or when the combined query fails, opportunities and products are
+    fetched separately and joined here.
+    """
+    if stage_filter is not None and stage_filter.excludes_all:
+        return []
+
+    timeout = config.get('fetch_timeout', DEFAULT_FETCH_TIMEOUT)
+    catalog = get_product_catalog(crm_service, config)
+
+    if uses_combined_fetch(crm_service, config):
+        deadline = time.monotonic() + timeout
+        raw_opportunities = await _await_fetch(
+            crm_service.aget_opportunities_with_products(user_ids, account_id, product_ids),
+            deadline,
+            'opportunities with products'
+        )
+
+        if raw_opportunities is not None:
+            line_items = itertools.chain.from_iterable(
+                opportunity.get('OpportunityLineItems') or () for opportunity in raw_opportunities
+            )
+            await resolve_missing_product_names(crm_service, catalog, line_items, deadline)
+            with metrics.span('product_map'):
+                return records.from_nested_products(raw_opportunities, catalog, stage_filter)
+
+        logger.warning('Combined fetch failed, fetching opportunities and products separately')
+
+    # Get opportunity products and opportunities assigned to users in parallel
+    deadline = time.monotonic() + timeout
+    raw_opportunity_products, raw_opportunities = await fetch_account_data(
+        crm_service,
+        user_ids,
+        account_id,
+        product_ids,
+        timeout=timeout
+    )
+    await resolve_missing_product_names(crm_service, catalog, raw_opportunity_products, deadline)
+
+    # Opportunities without products get none
+    with metrics.span('product_map'):
+        return records.from_separate_products(raw_opportunities, raw_opportunity_products, catalog, stage_filter)
+
+
+def get_user_product_names(user_ids) -> list:
+    """Names of the products sold by the users on the call, for the LLM prompt"""
+    catalog = product_catalog.get_catalog()
+    product_ids = user_affinity.get_affinity().products_for(user_ids)
+    return sorted(name for name in (catalog.get_name(product_id) for product_id in product_ids) if name)
+
+
+async def cascade_rank(rank_service, opportunity_records, scores, heuristic_result, transcript, user_ids, config, started_at):
+    """
+    Re-rank the heuristic's top candidates with the LLM within the request's latency budget.
+
+    The LLM is only consulted when the heuristic made no suggestion (unless config
+    'cascade_ambiguous_only' is false), and only for the config 'cascade_top_k'
+    highest scoring opportunities. If config 'latency_budget_ms', counted from the
+    start of the request, runs out or the LLM fails, the heuristic result is kept.
+
+    Returns:
+        The final ranking and metadata saying which stage produced it
+    """
+    budget_ms = config.get('latency_budget_ms', DEFAULT_LATENCY_BUDGET_MS)
+    metadata = {'budget_ms': budget_ms, 'llm_candidates': 0}
+
+    def finish(result, stage):
+        metadata['stage'] = stage
+        metadata['budget_spent_ms'] = round((time.monotonic() - started_at) * 1000, 1)
+        if metadata['llm_candidates']:
+            metadata['llm_cache'] = llm_cache_metadata(metrics.current())
+        return result, metadata
+
+    ambiguous = not any(opp.get('suggested') for opp in heuristic_result)
+    if (not hasattr(rank_service, 'arank_opportunities') or not len(scores)
+            or (config.get('cascade_ambiguous_only', True) and not ambiguous)):
+        return finish(heuristic_result, 'heuristic')
+
+    # Highest scoring candidates first, without sorting the whole account
+    top_k = min(config.get('cascade_top_k', DEFAULT_CASCADE_TOP_K), len(scores))
+    candidates = np.argpartition(-scores, top_k - 1)[:top_k]
+    candidates = candidates[np.argsort(-scores[candidates], kind='stable')].tolist()
+
+    remaining = budget_ms / 1000 - (time.monotonic() - started_at)
+    if remaining <= 0:
+        logger.warning('Latency budget spent before LLM ranking, using heuristic ranking')
+        return finish(heuristic_result, 'heuristic_fallback')
+
+    candidate_records = [
+        {
+            'Id': opportunity_records[index].id,
+            'Name': opportunity_records[index].name,
+            'StageName': opportunity_records[index].stage_name,
+            'Products': list(opportunity_records[index].product_names)
         }
-    
+        for index in candidates
+    ]
+    metadata['llm_candidates'] = len(candidate_records)
+
+    try:
+        with metrics.span('llm'):
+            llm_ranked = await asyncio.wait_for(
+                rank_service.arank_opportunities(candidate_records, get_user_product_names(user_ids), transcript),
+                timeout=remaining
+            )
+    except asyncio.TimeoutError:
+        logger.warning('LLM ranking exceeded the latency budget, using heuristic ranking')
+        return finish(heuristic_result, 'heuristic_fallback')
+    except Exception as e:
+        logger.warning("LLM ranking failed, using heuristic ranking: %s", e)
+        return finish(heuristic_result, 'heuristic_fallback')
+
+    ranked = [
+        opportunity_records[index].to_result(item['score'])
+        for index, item in zip(candidates, llm_ranked)
+        if item['score'] > 0
+    ]
+
+    if not ranked:
+        return finish(heuristic_result, 'heuristic_fallback')
+
+    ranked.sort(key=lambda x: x['rank'], reverse=True)
+    ranked = rank_service.normalize_scores(ranked)
+    ranked = rank_service.determine_suggestion(
+        ranked,
+        min_score_threshold=0.25,
+        score_difference_threshold=0.1
+    )
+    return finish(ranked, 'llm')
+
+
+def llm_cache_metadata(request_metrics) -> dict:
+    """
+    Describe how the LLM response cache served this request: hits, misses, the
+    model time the hits saved, and the container's totals.
+    """
+    from langchain_service import service as langchain_svc
+
+    counts = request_metrics.to_dict()['counts'] if request_metrics is not None else {}
+    return {
+        'request': {status: counts.get(f"llm_cache_{status}", 0) for status in ('hit', 'miss')},
+        'saved_ms': counts.get('llm_cache_saved_ms', 0),
+        'container': langchain_svc.cache.stats() if langchain_svc.cache is not None else None
+    }
+
+
+def account_cache_metadata(request_metrics) -> dict:
+    """
+    Describe how the account cache served this request: how many accounts came
+    from each path, the oldest cached data used, and the container's hit ratio.
+    """
+    timings = request_metrics.to_dict()
+    return {
+        'request': {
+            status: timings['counts'].get(f"account_cache_{status}", 0)
+            for status in ('hit', 'delta', 'refresh', 'stale', 'miss')
+        },
+        'staleness_s': timings['values'].get('account_cache_staleness_s'),
+        'container': account_cache.get_cache().stats()
+    }
+
+
+def crm_health_metadata(crm_service, request_metrics) -> dict:
+    """
+    Describe how this request's CRM calls went: retries, hedged requests, calls
+    refused by an open circuit, results cut short by a failed page, fetches
+    shared with concurrent callers, and the tenant's circuit state and latencies.
+    A request is degraded when any call was refused or cut short, so its
+    ranking may be built from cached, fewer or no opportunities.
+    """
+    counts = request_metrics.to_dict()['counts']
+    return {
+        'degraded': counts.get('crm_circuit_open', 0) > 0 or counts.get('crm_partial_results', 0) > 0,
+        'request': {
+            name: counts.get(f"crm_{name}", 0)
+            for name in ('retries', 'hedges', 'hedge_wins', 'circuit_open', 'partial_results', 'coalesced')
+        },
+        'tenant': crm_service.policy.health.stats(),
+        'single_flight': single_flight.get_single_flight().stats()
+    }
+
+
+def dump_body(payload: dict) -> str:
+    """Serialize a response body with orjson, which also takes numpy scalars"""
+    return orjson.dumps(payload, option=orjson.OPT_SERIALIZE_NUMPY).decode('utf-8')
+
+
+def error_response(message: str, status_code: int = 400) -> dict:
+    return {
+        'statusCode': status_code,
+        'body': dump_body({
+            'error': message
+        })
+    }
+
+
+def resolve_services(config):
+    """
+    Validate the tenant config and get its CRM and rank services.
+
+    Returns:
+        (crm_service, rank_service, None), or (None, None, error response) if the config is invalid
+    """
     if not config.get('crm_platform') or not config.get('access_token'):
-        print('Missing required parameters: crm_platform, access_token are required')
-        return {
-            'statusCode': 400,
-            'body': json.dumps({
-                'error': 'Missing required parameters: crm_platform, access_token are required'
-            })
-        }
+        logger.warning('Missing required parameters: crm_platform, access_token are required')
+        return None, None, error_response('Missing required parameters: crm_platform, access_token are required')
     
     crm_platform = config.get('crm_platform')
     
     if crm_platform == 'salesforce':
-        crm_service = crm_services.SalesforceService(config)
+        crm_service = crm_services.get_service('salesforce', config)
         rank_service = rank_services.SalesforceRank()
     elif crm_platform == 'pivotal':
         if not config.get('form_name') or not config.get('pivotal_environment_name'):
-            print('Missing required parameters: form_name and pivotal_environment_name are required')
-            return {
-                'statusCode': 400,
-                'body': json.dumps({
-                    'error': 'Missing required parameters: form_name and pivotal_environment_name are required'
-                })
-            }
-
-        crm_service = crm_services.PivotalService(config)
+            logger.warning('Missing required parameters: form_name and pivotal_environment_name are required')
+            return None, None, error_response('Missing required parameters: form_name and pivotal_environment_name are required')
+
+        crm_service = crm_services.get_service('pivotal', config)
         rank_service = rank_services.PivotalRank()
     elif crm_platform == 'acrm':
         user_credentials = config.get('access_token', '').split(':')
         if len(user_credentials) != 2:
-            print('Invalid access token format. Format should be username:password')
-            return {
-                'statusCode': 400,
-                'body': json.dumps({
-                    'error': 'Invalid access token format. Format should be username:password'
-                })
-            }
+            logger.warning('Invalid access token format. Format should be username:password')
+            return None, None, error_response('Invalid access token format. Format should be username:password')
 
         config['username'] = user_credentials[0]
         config['password'] = user_credentials[1]
-        crm_service = crm_services.ACRMService(config)
+        crm_service = crm_services.get_service('acrm', config)
         rank_service = rank_services.ACRMRank()
     else:
-        print('Invalid CRM platform. Valid platforms are salesforce, pivotal, acrm')
-        return {
-            'statusCode': 400,
-            'body': json.dumps({
-                'error': 'Invalid CRM platform. Valid platforms are salesforce, pivotal, acrm'
-            })
-        }
+        logger.warning('Invalid CRM platform. Valid platforms are salesforce, pivotal, acrm')
+        return None, None, error_response('Invalid CRM platform. Valid platforms are salesforce, pivotal, acrm')
 
-    # Get opportunity products
-    raw_opportunity_products = crm_service.get_opportunity_products(user_ids, account_id, product_ids, format = True)
-    opportunity_products = []
-
-    if raw_opportunity_products:  # Only process products if we got them successfully
-        for opportunity_product in raw_opportunity_products:
-            opportunity_products.append({
-                'id': opportunity_product.get('Id'),
-                'opportunity_id': opportunity_product.get('OpportunityId'),
-                'product_id': opportunity_product.get('Product2Id'),
-                'product_name': opportunity_product.get('Product2').get('Name'),
-                'quantity': opportunity_product.get('Quantity')
-            })
-
-    # Get opportunities assigned to users
-    raw_opportunities = crm_service.get_opportunities_by_account_id(account_id, format = True)
-    opportunities = []
-    
-    # Get opportunity products for each opportunity
-    opportunity_products_map = {}
-    for op in opportunity_products:
-        opp_id = op['opportunity_id']
-        if opp_id not in opportunity_products_map:
-            opportunity_products_map[opp_id] = []
-        opportunity_products_map[opp_id].append(op)
-    
-    for opportunity in raw_opportunities:
-        # Pass empty list if no products were found for this opportunity
-        opp_products = opportunity_products_map.get(opportunity.get('Id'), [])
-        opportunity_rank = rank_service.rank_opportunity_score(
-            opportunity,
-            opp_products,  # This will be empty if products request failed
+    return crm_service, rank_service, None
+
+
+async def fetch_account(crm_service, config, user_ids, account_id, product_ids, stage_filter=None):
+    """Fetch the account's opportunities with their products as OpportunityRecords"""
+    opportunity_records = await fetch_opportunities_with_products(
+        crm_service, config, user_ids, account_id, product_ids, stage_filter
+    )
+
+    metrics.count('opportunities', len(opportunity_records))
+    metrics.count('products', sum(len(record.product_ids) for record in opportunity_records))
+    return opportunity_records
+
+
+def score_account(rank_service, config, opportunity_records, transcript, transcript_features, user_ids):
+    """
+    Score one account's opportunities and rank the ones over the threshold.
+    CPU-bound, so the handler runs it on scoring_executor.
+
+    Returns:
+        The scores, and the ranked opportunities
+    """
+    metrics.count('transcript_bytes', len(transcript.encode('utf-8')))
+
+    # Optionally blend in whether the users on the call sell each opportunity's products
+    affinity_weight = config.get('affinity_weight', 0.0)
+    participant_products = user_affinity.get_affinity().products_for(user_ids) if affinity_weight else None
+    rank_threshold = config.get('rank_threshold', DEFAULT_RANK_THRESHOLD)
+
+    with metrics.span('scoring'):
+        scores = rank_service.score_opportunities_batch(
+            opportunity_records,
             transcript,
-            user_ids
+            user_ids,
+            features=transcript_features,
+            participant_products=participant_products,
+            affinity_weight=affinity_weight,
+            # The cascade picks its LLM candidates by score, so it needs them exact
+            min_score=rank_threshold if config.get('ranking_mode') != 'cascade' else None
         )
-        opportunity_to_be_added = {
-            'id': opportunity.get('Id'),
-            'name': opportunity.get('Name'),
-            'stage_name': opportunity.get('StageName'),
-            'owner_id': opportunity.get('OwnerId'),
-            'rank': opportunity_rank
-        }
-        opportunities.append(opportunity_to_be_added)
 
-    # Sort opportunities by rank in descending order
-    opportunities.sort(key=lambda x: x['rank'], reverse=True)
-    
-    # Filter out opportunities with score lower than 0.5
-    opportunities = [opp for opp in opportunities if opp['rank'] >= 0.5]
-    
-    # Only apply suggestion logic if we have opportunities left
-    if opportunities:
-        # Normalize scores before determining suggestion
-        opportunities = rank_service.normalize_scores(opportunities)
-        
-        opportunities = rank_service.determine_suggestion(
-            opportunities,
+    # Keep opportunities scoring at least the threshold, normalize and flag the suggestion
+    with metrics.span('normalization'):
+        opportunities = rank_service.rank_opportunities_batch(
+            opportunity_records,
+            transcript,
+            user_ids,
+            rank_threshold=rank_threshold,
             min_score_threshold=0.25,
-            score_difference_threshold=0.1
+            score_difference_threshold=0.1,
+            scores=scores
+        )
+
+    return scores, opportunities
+
+
+async def rank_account(rank_service, config, opportunity_records, transcript, transcript_features, user_ids, started_at):
+    """
+    Score and rank one account's opportunities against a transcript.
+
+    Returns:
+        The ranked opportunities, and the cascade metadata if config 'ranking_mode' is 'cascade' (else None)
+    """
+    scores, opportunities = await run_in_thread(
+        scoring_executor,
+        score_account,
+        rank_service,
+        config,
+        opportunity_records,
+        transcript,
+        transcript_features,
+        user_ids
+    )
+
+    if config.get('ranking_mode') != 'cascade':
+        return opportunities, None
+
+    return await cascade_rank(
+        rank_service,
+        opportunity_records,
+        scores,
+        opportunities,
+        transcript,
+        user_ids,
+        config,
+        started_at
+    )
+
+
+def _fetch_key(item, combined) -> tuple:
+    # Everything that changes what the CRM returns for an account. A combined
+    # fetch returns the products of every owner, restricted per item once fetched.
+    return (
+        item['account_id'],
+        () if combined else tuple(sorted(item.get('user_ids') or [])),
+        tuple(sorted(item.get('product_ids') or []))
+    )
+
+
+def _fetch_batch_accounts(crm_service, config, keys, semaphore, stage_filter=None):
+    """
+    Start fetching every distinct account of a batch, at most as many at once
+    as the semaphore allows, leaving out opportunities the stage_filter drops.
+
+    Services with a batched combined query fetch all accounts sharing the same
+    product filter in one call, falling back to single fetches for accounts it
+    failed for; otherwise each account is fetched on its own. A batched call
+    still running at config 'fetch_timeout' fails all of its accounts.
+
+    Returns:
+        Coroutines that each resolve to a dict of fetch key -> the account's
+        OpportunityRecords, or the exception fetching that account raised
+    """
+    async def fetch(key):
+        async with semaphore:
+            metrics.count('crm_fetches')
+            try:
+                return await fetch_account(crm_service, config, list(key[1]), key[0], list(key[2]), stage_filter)
+            except Exception as e:
+                logger.error("Error fetching account %s: %s", key[0], e)
+                return e
+
+    batched = uses_combined_fetch(crm_service, config) and hasattr(crm_service, 'aget_opportunities_with_products_batch')
+    if not batched or (stage_filter is not None and stage_filter.excludes_all):
+        async def fetch_one(key):
+            return {key: await fetch(key)}
+
+        return [fetch_one(key) for key in keys]
+
+    catalog = get_product_catalog(crm_service, config)
+
+    async def fetch_group(product_ids, group_keys):
+        async with semaphore:
+            metrics.count('crm_fetches')
+            deadline = time.monotonic() + config.get('fetch_timeout', DEFAULT_FETCH_TIMEOUT)
+            opportunities_by_account = await _await_fetch(
+                crm_service.aget_opportunities_with_products_batch([key[0] for key in group_keys], list(product_ids)),
+                deadline,
+                f"opportunities with products of {len(group_keys)} accounts",
+                default=lambda: None
+            )
+
+        if opportunities_by_account is None:
+            # Fetching the accounts one by one would start the timeout over
+            return {key: asyncio.TimeoutError(f"Timed out fetching account {key[0]}") for key in group_keys}
+
+        fetched = {}
+        for key in group_keys:
+            opportunities = opportunities_by_account.get(str(key[0]))
+            if opportunities is None:
+                fetched[key] = await fetch(key)
+                continue
+
+            with metrics.span('product_map'):
+                opportunity_records = records.from_nested_products(opportunities, catalog, stage_filter)
+            metrics.count('opportunities', len(opportunity_records))
+            metrics.count('products', sum(len(record.product_ids) for record in opportunity_records))
+            fetched[key] = opportunity_records
+
+        return fetched
+
+    groups = {}
+    for key in keys:
+        groups.setdefault(key[2], []).append(key)
+    return [fetch_group(product_ids, group_keys) for product_ids, group_keys in groups.items()]
+
+
+async def batch_handler(items, config, request_metrics) -> dict:
+    """
+    Rank a list of {account_id, transcript, user_ids, product_ids} items in one invocation.
+
+    Each distinct account is fetched once however many items share it, with up
+    to config 'batch_concurrency' fetches running at once, and items are ranked
+    as soon as their account arrives. Transcript features are built once per
+    distinct transcript. Every item gets its own result or error, in the order given.
+    """
+    if not isinstance(items, list) or not items:
+        return error_response('Missing required parameters: items must be a non-empty list')
+
+    max_items = config.get('max_batch_items', DEFAULT_MAX_BATCH_ITEMS)
+    if len(items) > max_items:
+        return error_response(f"Too many items: at most {max_items} are allowed per batch")
+
+    crm_service, rank_service, error = resolve_services(config)
+    if error:
+        return error
+
+    results = []
+    items_by_key = {}
+    combined = uses_combined_fetch(crm_service, config)
+    for index, item in enumerate(items):
+        result = {'index': index, 'account_id': None, 'result': None, 'error': None}
+        results.append(result)
+        if isinstance(item, dict):
+            result['account_id'] = item.get('account_id')
+            if 'id' in item:
+                result['id'] = item['id']
+
+        if not isinstance(item, dict) or not item.get('transcript') or not item.get('account_id'):
+            result['error'] = 'Missing required parameters: transcript, account_id are required'
+            continue
+        items_by_key.setdefault(_fetch_key(item, combined), []).append(index)
+
+    request_metrics.count('items', len(items))
+    features_by_transcript = {}
+    concurrency = max(1, config.get('batch_concurrency', DEFAULT_BATCH_CONCURRENCY))
+
+    semaphore = asyncio.Semaphore(concurrency)
+
+    stage_filter = ranking_stage_filter(crm_service, rank_service, config)
+
+    for fetch in asyncio.as_completed(_fetch_batch_accounts(crm_service, config, list(items_by_key), semaphore, stage_filter)):
+        # Only time spent waiting on the CRM counts, ranking overlaps the remaining fetches
+        with request_metrics.span('crm_fetch'):
+            fetched_by_key = await fetch
+
+        for key, opportunity_records in fetched_by_key.items():
+            if isinstance(opportunity_records, Exception):
+                for index in items_by_key[key]:
+                    results[index]['error'] = f"Error fetching account data: {opportunity_records}"
+                continue
+
+            for index in items_by_key[key]:
+                item_records = opportunity_records
+                if crm_service.owner_scoped_products:
+                    item_records = records.restrict_products(opportunity_records, items[index].get('user_ids'))
+
+                transcript = items[index]['transcript']
+                features = features_by_transcript.get(transcript)
+                if features is None:
+                    features = features_by_transcript[transcript] = await run_in_thread(
+                        scoring_executor, get_transcript_features, transcript
+                    )
+
+                try:
+                    opportunities, ranking = await rank_account(
+                        rank_service,
+                        config,
+                        item_records,
+                        transcript,
+                        features,
+                        items[index].get('user_ids'),
+                        time.monotonic()
+                    )
+                except Exception as e:
+                    logger.error("Error ranking item %s: %s", index, e)
+                    results[index]['error'] = f"Error ranking opportunities: {e}"
+                    continue
+
+                results[index]['result'] = opportunities
+                if ranking is not None:
+                    results[index]['ranking'] = ranking
+
+    metadata = {
+        'items': len(items),
+        'failed_items': sum(1 for result in results if result['error']),
+        'distinct_accounts': len(items_by_key),
+        'service_registry': crm_services.registry.stats(),
+        'crm_health': crm_health_metadata(crm_service, request_metrics)
+    }
+    if config.get('account_cache'):
+        metadata['account_cache'] = account_cache_metadata(request_metrics)
+    metadata['timings'] = request_metrics.to_dict()
+    if config.get('emit_metrics', True):
+        request_metrics.emit(crm_platform=config.get('crm_platform'), ranking_mode=config.get('ranking_mode', 'heuristic'))
+
+    return {
+        'statusCode': 200,
+        'body': dump_body({
+            'results': results,
+            'error': None,
+            'metadata': metadata
+        })
+    }
+
+
+def lambda_handler(event, context) -> dict:
+    """Run async_lambda_handler on the container's event loop, for the synchronous Lambda runtime"""
+    return asyncio.run_coroutine_threadsafe(async_lambda_handler(event, context), get_event_loop()).result()
+
+
+async def async_lambda_handler(event, context) -> dict:
+    """
+    Rank an account's opportunities, or a batch of accounts, against call transcripts.
+
+    CRM calls are awaited on the event loop, overlapping each other and the
+    transcript preparation, and CPU-bound scoring runs on scoring_executor.
+    """
+    started_at = time.monotonic()
+    request_metrics = metrics.start_request()
+
+    with request_metrics.span('request_parse'):
+        body = orjson.loads(event['body'])
+
+    logger.debug("Request body: %s", body)
+
+    config = body.get('config', {})
+
+    # A list of items ranks many accounts and transcripts in one invocation
+    if 'items' in body:
+        return await batch_handler(body.get('items'), config, request_metrics)
+
+    data = body.get('data')
+    if not data:
+        return error_response('Missing required parameters: data is required')
+
+    transcript = data.get('transcript')
+    user_ids = data.get('user_ids')
+    account_id = data.get('account_id')
+    product_ids = data.get('product_ids')
+
+    if not transcript or not account_id:
+        logger.warning('Missing required parameters: transcript, account_id are required')
+        return error_response('Missing required parameters: transcript, account_id are required')
+
+    crm_service, rank_service, error = resolve_services(config)
+    if error:
+        return error
+
+    crm_platform = config.get('crm_platform')
+
+    # Shared by every scorer so the transcript is only tokenized once per request,
+    # while the CRM is being queried
+    transcript_features = run_in_thread(scoring_executor, get_transcript_features, transcript)
+
+    with request_metrics.span('crm_fetch'):
+        opportunity_records = await fetch_account(
+            crm_service, config, user_ids, account_id, product_ids, ranking_stage_filter(crm_service, rank_service, config)
         )
+
+    transcript_features = await transcript_features
+
+    opportunities, ranking = await rank_account(
+        rank_service,
+        config,
+        opportunity_records,
+        transcript,
+        transcript_features,
+        user_ids,
+        started_at
+    )
+
+    metadata = {
+        'min_score_threshold': config.get('rank_threshold', DEFAULT_RANK_THRESHOLD),
+        'score_difference_threshold': 0.1,
+        'service_registry': crm_services.registry.stats(),
+        'crm_health': crm_health_metadata(crm_service, request_metrics)
+    }
+    if ranking is not None:
+        metadata['ranking'] = ranking
+    if config.get('account_cache'):
+        metadata['account_cache'] = account_cache_metadata(request_metrics)
+
+    metadata['timings'] = request_metrics.to_dict()
+    if config.get('emit_metrics', True):
+        request_metrics.emit(crm_platform=crm_platform, ranking_mode=config.get('ranking_mode', 'heuristic'))
     
     response = {
         'statusCode': 200,
-        'body': json.dumps({
+        'body': dump_body({
             'result': opportunities,
             'error': None,
-            'metadata': {
-                'min_score_threshold': 0.5,
-                'score_difference_threshold': 0.1
-            }
+            'metadata': metadata
         })
     }
     
-    print(response)
+    logger.debug("Response: %s", response)
 
     return response
@@ -1,14 +1,18 @@
+import asyncio
 from enum import Enum
+import hashlib
+import importlib
+import itertools
+import json
 import time
 import os
+import tempfile
+import threading
+from collections import OrderedDict
 from typing import List, Dict, Union, Type
 import logging
-from langchain_openai import ChatOpenAI
-from langchain.schema import AIMessage, HumanMessage, SystemMessage
 
-from dotenv import load_dotenv
-
-load_dotenv()
+import metrics
 
 
 logger = logging.getLogger(__name__)
@@ -16,6 +20,7 @@ logger = logging.getLogger(__name__)
 
 class Providers(str, Enum):
     OPENAI = "openai"
+    FAKE = "fake"
 
 class Speeds(str, Enum):
     SLOW = "slow"
@@ -24,35 +29,324 @@ class Speeds(str, Enum):
     SQL = "sql"
 
 
-# Define provider instances mapping
-PROVIDER_INSTANCES: Dict[Providers, Type[ChatOpenAI]] = {
-    Providers.OPENAI: ChatOpenAI,
+# Define provider instances mapping. Classes are imported on first use so the
+# heuristic ranking path never loads the LLM stack.
+PROVIDER_INSTANCES: Dict[Providers, str] = {
+    Providers.OPENAI: "langchain_openai.ChatOpenAI",
+    Providers.FAKE: "langchain_service.FakeChatModel",
 }
 
+_provider_classes: Dict[Providers, Type] = {}
+_import_lock = threading.Lock()
+
+
+def get_provider_class(provider: Providers) -> Type:
+    """Import the chat model class for a provider, loading .env the first time"""
+    provider_class = _provider_classes.get(provider)
+    if provider_class is None:
+        with _import_lock:
+            if not _provider_classes:
+                from dotenv import load_dotenv
+
+                load_dotenv()
+
+            module_name, class_name = PROVIDER_INSTANCES[provider].rsplit(".", 1)
+            provider_class = getattr(importlib.import_module(module_name), class_name)
+            _provider_classes[provider] = provider_class
+
+    return provider_class
+
+
 # Define speed mappings for each provider
 PROVIDER_SPEEDS = {
     Providers.OPENAI: {
         Speeds.SLOW: "o1",
         Speeds.MEDIUM: "gpt-4o",
         Speeds.FAST: "o1-mini",
-    }
+    },
+    Providers.FAKE: {
+        Speeds.SLOW: "o1",
+        Speeds.MEDIUM: "gpt-4o",
+        Speeds.FAST: "o1-mini",
+    },
 }
 
+# Response cache defaults. Set LLM_CACHE_DIR (e.g. /tmp/llm-cache) to keep
+# responses on disk across warm invocations of the same container.
+RESPONSE_CACHE_SIZE = 256
+RESPONSE_CACHE_TTL = 3600
+RESPONSE_CACHE_DISK_ENTRIES = 1024
+
+
+class FakeChatModel:
+    """
+    Offline stand-in for a chat model, for tests and local runs without API keys.
+
+    Returns the given responses in turn, or echoes the last message when none
+    are given, after an optional simulated latency.
+    """
+
+    def __init__(self, model: str, responses: List[str] | None = None, latency: float = 0.0, **kwargs):
+        self.model = model
+        self.latency = latency
+        self.calls = 0
+        self._responses = itertools.cycle(responses) if responses else None
+        self._lock = threading.Lock()
+
+    def invoke(self, message_list):
+        from langchain_core.messages import AIMessage
+
+        if self.latency:
+            time.sleep(self.latency)
+
+        with self._lock:
+            self.calls += 1
+            content = next(self._responses) if self._responses else message_list[-1].content
+
+        return AIMessage(content=content)
+
+    async def ainvoke(self, message_list):
+        from langchain_core.messages import AIMessage
+
+        if self.latency:
+            await asyncio.sleep(self.latency)
+
+        with self._lock:
+            self.calls += 1
+            content = next(self._responses) if self._responses else message_list[-1].content
+
+        return AIMessage(content=content)
+
+
+class ResponseCache:
+    """
+    LRU cache of model responses with TTL eviction and an optional on-disk tier.
+
+    Entries are keyed by a hash of the model, system message and messages, and
+    remember how long the original call took so hits can report latency saved.
+    """
+
+    def __init__(
+        self,
+        max_size: int = RESPONSE_CACHE_SIZE,
+        ttl: float = RESPONSE_CACHE_TTL,
+        disk_dir: str | None = None,
+        max_disk_entries: int = RESPONSE_CACHE_DISK_ENTRIES,
+    ):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.disk_dir = disk_dir
+        self.max_disk_entries = max_disk_entries
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self._disk_writes = 0
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self.latency_saved = 0.0
+
+        if self.disk_dir:
+            os.makedirs(self.disk_dir, exist_ok=True)
+
+    @staticmethod
+    def make_key(model: str, system_message: str, messages: List[Dict[str, str]]) -> str:
+        payload = json.dumps([model, system_message, messages], sort_keys=True)
+        return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+    def _disk_path(self, key: str) -> str:
+        return os.path.join(self.disk_dir, f"{key}.json")
+
+    def _read_disk(self, key: str) -> tuple | None:
+        try:
+            with open(self._disk_path(key), "r", encoding="utf-8") as f:
+                entry = json.load(f)
+        except (OSError, ValueError):
+            return None
+
+        if entry["expires_at"] <= time.time():
+            try:
+                os.remove(self._disk_path(key))
+            except OSError:
+                pass
+            return None
+
+        return entry["expires_at"], entry["response"], entry["latency"]
+
+    def _write_disk(self, key: str, expires_at: float, response: str, latency: float) -> None:
+        try:
+            fd, tmp_path = tempfile.mkstemp(dir=self.disk_dir, suffix=".tmp")
+            with os.fdopen(fd, "w", encoding="utf-8") as f:
+                json.dump({"expires_at": expires_at, "response": response, "latency": latency}, f)
+            os.replace(tmp_path, self._disk_path(key))
+        except OSError as e:
+            logger.debug(f"Failed to write response cache entry: {e}")
+            return
+
+        self._disk_writes += 1
+        if self._disk_writes % 64 == 0:
+            self._prune_disk()
+
+    def _prune_disk(self) -> None:
+        """Drop expired files and the oldest ones beyond max_disk_entries"""
+        try:
+            paths = [
+                os.path.join(self.disk_dir, name)
+                for name in os.listdir(self.disk_dir)
+                if name.endswith(".json")
+            ]
+            paths.sort(key=os.path.getmtime, reverse=True)
+            now = time.time()
+            for index, path in enumerate(paths):
+                if index >= self.max_disk_entries or os.path.getmtime(path) + self.ttl <= now:
+                    os.remove(path)
+        except OSError as e:
+            logger.debug(f"Failed to prune response cache: {e}")
+
+    def get(self, key: str) -> str | None:
+        """Get a cached response, checking memory first and then disk"""
+        now = time.time()
+
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[0] <= now:
+                del self._entries[key]
+                entry = None
+
+            if entry is not None:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                self.latency_saved += entry[2]
+
+        if entry is not None:
+            self._count_request(entry)
+            return entry[1]
+
+        if self.disk_dir:
+            entry = self._read_disk(key)
+            if entry is not None:
+                with self._lock:
+                    self._store(key, entry)
+                    self.hits += 1
+                    self.disk_hits += 1
+                    self.latency_saved += entry[2]
+                self._count_request(entry)
+                return entry[1]
+
+        with self._lock:
+            self.misses += 1
+        self._count_request(None)
+        return None
+
+    @staticmethod
+    def _count_request(entry: tuple | None) -> None:
+        """Count the lookup, and the model time a hit saved, on the current request's metrics"""
+        if entry is None:
+            metrics.count("llm_cache_miss")
+            return
+
+        metrics.count("llm_cache_hit")
+        metrics.count("llm_cache_saved_ms", round(entry[2] * 1000))
+
+    def _store(self, key: str, entry: tuple) -> None:
+        self._entries[key] = entry
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
+
+    def set(self, key: str, response: str, latency: float) -> None:
+        entry = (time.time() + self.ttl, response, latency)
+
+        with self._lock:
+            self._store(key, entry)
+
+        if self.disk_dir:
+            self._write_disk(key, *entry)
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "hits": self.hits,
+                "disk_hits": self.disk_hits,
+                "misses": self.misses,
+                "size": len(self._entries),
+                "latency_saved": round(self.latency_saved, 3),
+            }
+
 
 class LangChainService:
-    def __init__(self):
-        self.provider = Providers.OPENAI
+    def __init__(self, provider: Providers = Providers.OPENAI, cache: ResponseCache | None = None):
+        self.provider = provider
         self.model: str | None = None
+        self.cache = cache
+        self._clients: Dict[str, object] = {}
+        self._clients_lock = threading.Lock()
 
     def set_model(self, model: str) -> None:
-        """Set the model to be used for chat completion."""
+        """Set the default model used when no speed override is given."""
         self.model = model
 
+    def get_client(self, model: str):
+        """Get the chat model client for a model, creating it once per container."""
+        client = self._clients.get(model)
+        if client is None:
+            with self._clients_lock:
+                client = self._clients.get(model)
+                if client is None:
+                    client = get_provider_class(self.provider)(
+                        model=model,
+                        # temperature=0.0 if model == "o1-mini" else 0.4,
+                    )
+                    self._clients[model] = client
+        return client
+
+    def resolve_model(self, model_override: Speeds | None) -> str:
+        """Resolve the model for a call without mutating shared state."""
+        if model_override:
+            model = PROVIDER_SPEEDS[self.provider][model_override]
+            logger.debug(f"Overriding model with: {model}")
+            return model
+
+        if not self.model:
+            raise ValueError("Chat Model is not set!")
+
+        return self.model
+
+    def build_messages(self, model: str, messages: List[Dict[str, str]], system_message: str) -> list:
+        """Convert messages to LangChain format."""
+        from langchain.schema import AIMessage, HumanMessage, SystemMessage
+
+        if model == "o1-mini":
+            return [
+                HumanMessage(content=f"{system_message}\n\n{messages[0]['content']}")
+            ]
+
+        return [
+            SystemMessage(content=system_message),
+            *[
+                AIMessage(content=msg["content"])
+                if msg["role"] == "assistant"
+                else HumanMessage(content=msg["content"])
+                for msg in messages
+            ],
+        ]
+
+    def _cache_lookup(self, model: str, messages: List[Dict[str, str]], system_message: str, use_cache: bool) -> tuple:
+        """Get the cache key for a call, if it is cacheable, and any cached response"""
+        if not use_cache or self.cache is None:
+            return None, None
+
+        cache_key = self.cache.make_key(model, system_message, messages)
+        cached = self.cache.get(cache_key)
+        if cached is not None:
+            logger.debug("Response served from cache")
+        return cache_key, cached
+
     def chat(
         self,
         messages: List[Dict[str, str]],
         system_message: str,
         model_override: Speeds | None = Speeds.FAST,
+        use_cache: bool = True,
     ) -> str:
         """
         Process a chat conversation and return the model's response.
@@ -61,48 +355,59 @@ class LangChainService:
             messages: List of message dictionaries with 'role' and 'content'
             system_message: The system message to set context
             model_override: Optional speed-based model override
+            use_cache: Whether to serve and store the response in the response cache
 
         Returns:
             The model's response as a string
         """
-        if model_override:
-            logger.debug(
-                f"Overriding model with: {PROVIDER_SPEEDS[self.provider][model_override]}"
-            )
-            self.set_model(PROVIDER_SPEEDS[self.provider][model_override])
+        model = self.resolve_model(model_override)
 
-        if not self.model:
-            raise ValueError("Chat Model is not set!")
+        cache_key, cached = self._cache_lookup(model, messages, system_message, use_cache)
+        if cached is not None:
+            return cached
 
-        is_o1_mini = self.model == "o1-mini"
-        model_instance = PROVIDER_INSTANCES[self.provider](
-            model=self.model,
-            # temperature=0.0 if is_o1_mini else 0.4,
-        )
+        model_instance = self.get_client(model)
+        message_list = self.build_messages(model, messages, system_message)
 
         start_time = time.time()
 
-        # Convert messages to LangChain format
-        if is_o1_mini:
-            message_list = [
-                HumanMessage(content=f"{system_message}\n\n{messages[0]['content']}")
-            ]
-        else:
-            message_list = [
-                SystemMessage(content=system_message),
-                *[
-                    AIMessage(content=msg["content"])
-                    if msg["role"] == "assistant"
-                    else HumanMessage(content=msg["content"])
-                    for msg in messages
-                ],
-            ]
-
         invocation = model_instance.invoke(message_list)
 
         execution_time = time.time() - start_time
         logger.debug(f"Execution took {execution_time:.2f} seconds")
 
+        if cache_key is not None:
+            self.cache.set(cache_key, invocation.content, execution_time)
+
+        return invocation.content
+
+    async def achat(
+        self,
+        messages: List[Dict[str, str]],
+        system_message: str,
+        model_override: Speeds | None = Speeds.FAST,
+        use_cache: bool = True,
+    ) -> str:
+        """Async version of chat, awaiting the model with ainvoke instead of blocking a thread"""
+        model = self.resolve_model(model_override)
+
+        cache_key, cached = self._cache_lookup(model, messages, system_message, use_cache)
+        if cached is not None:
+            return cached
+
+        model_instance = self.get_client(model)
+        message_list = self.build_messages(model, messages, system_message)
+
+        start_time = time.time()
+
+        invocation = await model_instance.ainvoke(message_list)
+
+        execution_time = time.time() - start_time
+        logger.debug(f"Execution took {execution_time:.2f} seconds")
+
+        if cache_key is not None:
+            self.cache.set(cache_key, invocation.content, execution_time)
+
         return invocation.content
 
     def fetch_system_prompt(self, prompt: str) -> str:
@@ -126,4 +431,7 @@ class LangChainService:
             return f.read()
 
 
-service = LangChainService()
+service = LangChainService(
+    provider=Providers(os.environ.get("LLM_PROVIDER", Providers.OPENAI.value)),
+    cache=ResponseCache(disk_dir=os.environ.get("LLM_CACHE_DIR")),
+)
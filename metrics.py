@@ -0,0 +1,123 @@
+import contextvars
+import json
+import threading
+import time
+from contextlib import contextmanager
+from typing import Dict
+
+
+# CloudWatch namespace for the embedded metric lines emitted per request
+METRICS_NAMESPACE = 'GSDOpportunitySuggestion'
+
+_current = contextvars.ContextVar('request_metrics', default=None)
+
+
+class RequestMetrics:
+    """
+    Per-phase durations and counts for a single request.
+
+    Phases are summed across threads and may nest, e.g. 'parse' time is also
+    part of 'crm_fetch', so they do not add up to the request total.
+    """
+
+    def __init__(self):
+        self._phases: Dict[str, float] = {}
+        self._counts: Dict[str, int] = {}
+        self._values: Dict[str, float] = {}
+        self._lock = threading.Lock()
+        self.started_at = time.perf_counter()
+
+    @contextmanager
+    def span(self, phase: str):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add_time(phase, time.perf_counter() - start)
+
+    def add_time(self, phase: str, seconds: float) -> None:
+        with self._lock:
+            self._phases[phase] = self._phases.get(phase, 0.0) + seconds
+
+    def count(self, name: str, value: int = 1) -> None:
+        with self._lock:
+            self._counts[name] = self._counts.get(name, 0) + value
+
+    def observe(self, name: str, value: float) -> None:
+        """Record a value, keeping the largest one observed during the request"""
+        with self._lock:
+            if name not in self._values or value > self._values[name]:
+                self._values[name] = value
+
+    def to_dict(self) -> dict:
+        with self._lock:
+            phases_ms = {phase: round(seconds * 1000, 2) for phase, seconds in self._phases.items()}
+            counts = dict(self._counts)
+            values = dict(self._values)
+
+        phases_ms['total'] = round((time.perf_counter() - self.started_at) * 1000, 2)
+        return {'phases_ms': phases_ms, 'counts': counts, 'values': values}
+
+    def emit(self, **dimensions) -> None:
+        """Print the metrics as a CloudWatch embedded metric format line"""
+        values = self.to_dict()
+        phase_metrics = {f"{phase}_ms": duration for phase, duration in values['phases_ms'].items()}
+
+        print(json.dumps({
+            '_aws': {
+                'Timestamp': int(time.time() * 1000),
+                'CloudWatchMetrics': [{
+                    'Namespace': METRICS_NAMESPACE,
+                    'Dimensions': [sorted(dimensions)],
+                    'Metrics': [
+                        *[{'Name': name, 'Unit': 'Milliseconds'} for name in phase_metrics],
+                        *[{'Name': name, 'Unit': 'Count'} for name in values['counts']],
+                        *[{'Name': name, 'Unit': 'None'} for name in values['values']]
+                    ]
+                }]
+            },
+            **dimensions,
+            **phase_metrics,
+            **values['counts'],
+            **values['values']
+        }))
+
+
+def start_request() -> RequestMetrics:
+    """Start collecting metrics for the request running in the current context"""
+    request_metrics = RequestMetrics()
+    _current.set(request_metrics)
+    return request_metrics
+
+
+def current() -> RequestMetrics | None:
+    return _current.get()
+
+
+@contextmanager
+def span(phase: str):
+    """Time a phase of the current request, doing nothing outside of one"""
+    request_metrics = _current.get()
+    if request_metrics is None:
+        yield
+        return
+
+    with request_metrics.span(phase):
+        yield
+
+
+def count(name: str, value: int = 1) -> None:
+    request_metrics = _current.get()
+    if request_metrics is not None:
+        request_metrics.count(name, value)
+
+
+def observe(name: str, value: float) -> None:
+    request_metrics = _current.get()
+    if request_metrics is not None:
+        request_metrics.observe(name, value)
+
+
+def submit(executor, fn, *args, **kwargs):
+    """Submit work to an executor, carrying over the current request's metrics"""
+    return executor.submit(contextvars.copy_context().run, fn, *args, **kwargs)
@@ -0,0 +1,141 @@
+import csv
+import logging
+import os
+import threading
+import time
+from collections import OrderedDict
+from typing import Dict, Iterable
+
+
+logger = logging.getLogger(__name__)
+
+
+CATALOG_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'data', 'products.csv')
+
+# Seconds between delta refreshes of the catalog against the CRM
+DEFAULT_REFRESH_INTERVAL = 3600
+
+# Tenant catalogs kept in a warm container
+MAX_TENANT_CATALOGS = 32
+
+
+class ProductCatalog:
+    """
+    Id -> product name index so line items only need their Product2Id.
+
+    Loaded from data/products.csv and kept current by merging in products
+    whose LastModifiedDate moved past the newest one seen. Each tenant's CRM
+    has its own catalog, see get_tenant_catalog.
+    """
+
+    def __init__(self):
+        self._names: Dict[str, str] = {}
+        self._lock = threading.Lock()
+        self._refreshing = False
+        self.last_modified = ''
+        self.refreshed_at: float | None = None
+
+    @classmethod
+    def from_csv(cls, path: str = CATALOG_PATH) -> 'ProductCatalog':
+        catalog = cls()
+        with open(path, newline='', encoding='utf-8') as f:
+            catalog.update(csv.DictReader(f))
+        # Left unset so the first request brings the shipped snapshot up to date
+        return catalog
+
+    def copy(self, keep_last_modified: bool = True) -> 'ProductCatalog':
+        """A separate catalog with the same names, and the same watermark if keep_last_modified"""
+        catalog = ProductCatalog()
+        with self._lock:
+            catalog._names = dict(self._names)
+            catalog.last_modified = self.last_modified if keep_last_modified else ''
+        return catalog
+
+    def __len__(self) -> int:
+        return len(self._names)
+
+    def __contains__(self, product_id: str) -> bool:
+        return product_id in self._names
+
+    def get_name(self, product_id: str) -> str | None:
+        return self._names.get(product_id)
+
+    def update(self, products: Iterable[Dict[str, str]]) -> int:
+        """Merge product records with Id, Name and LastModifiedDate, returning how many changed"""
+        changed = 0
+        with self._lock:
+            for product in products:
+                product_id = product.get('Id')
+                if not product_id:
+                    continue
+
+                name = product.get('Name') or ''
+                if self._names.get(product_id) != name:
+                    self._names[product_id] = name
+                    changed += 1
+
+                # CRM timestamps share one UTC format, so they compare as strings
+                last_modified = product.get('LastModifiedDate') or ''
+                if last_modified > self.last_modified:
+                    self.last_modified = last_modified
+
+        return changed
+
+    def needs_refresh(self, interval: float = DEFAULT_REFRESH_INTERVAL) -> bool:
+        if self._refreshing:
+            return False
+        return self.refreshed_at is None or time.monotonic() - self.refreshed_at >= interval
+
+    def refresh(self, crm_service) -> int:
+        """Fetch products modified since the newest LastModifiedDate seen and merge them in"""
+        with self._lock:
+            if self._refreshing:
+                return 0
+            self._refreshing = True
+
+        try:
+            products = crm_service.get_products_modified_since(self.last_modified)
+            changed = self.update(products)
+            logger.info("Product catalog refreshed: %s changed, %s total", changed, len(self))
+            return changed
+        except Exception as e:
+            logger.error("Error refreshing product catalog: %s", e)
+            return 0
+        finally:
+            self.refreshed_at = time.monotonic()
+            self._refreshing = False
+
+
+_catalog = None
+_catalog_lock = threading.Lock()
+
+_tenant_catalogs = OrderedDict()
+_tenant_catalogs_lock = threading.Lock()
+
+
+def get_catalog() -> ProductCatalog:
+    """Get the container-wide catalog of data/products.csv, loading it on first use"""
+    global _catalog
+    if _catalog is None:
+        with _catalog_lock:
+            if _catalog is None:
+                _catalog = ProductCatalog.from_csv()
+    return _catalog
+
+
+def get_tenant_catalog(url_domain: str) -> ProductCatalog:
+    """
+    Get the catalog of one tenant's CRM, creating it on first use.
+
+    It starts with the names of data/products.csv but without its watermark,
+    since the snapshot's LastModifiedDate says nothing about which of the
+    tenant's products it holds. Its first refresh therefore loads every product.
+    """
+    with _tenant_catalogs_lock:
+        catalog = _tenant_catalogs.get(url_domain)
+        if catalog is None:
+            catalog = _tenant_catalogs[url_domain] = get_catalog().copy(keep_last_modified=False)
+            while len(_tenant_catalogs) > MAX_TENANT_CATALOGS:
+                _tenant_catalogs.popitem(last=False)
+        _tenant_catalogs.move_to_end(url_domain)
+        return catalog
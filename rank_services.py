@@ -1,11 +1,307 @@
+import asyncio
 import json
-from typing import List, Dict
+import logging
+from typing import AbstractSet, List, Dict, Sequence
 
-from langchain_service import Speeds, service as langchain_svc
+import numpy as np
 
+from records import OpportunityRecord, StageFilter
+from transcript_matching import TranscriptFeatures, get_transcript_features
+from user_affinity import calculate_affinity
 
-class ACRMRank:
-    def calculate_product_match(opportunity_products: List[Dict], transcript: str) -> float:
+
+logger = logging.getLogger(__name__)
+
+
+# Opportunities packed into a single LLM ranking prompt
+LLM_BATCH_SIZE = 20
+
+# Batched LLM ranking prompts in flight at once
+LLM_MAX_CONCURRENCY = 4
+
+# Slack for float rounding when a score bound is compared with a threshold, so an
+# opportunity that could score exactly the threshold is never dropped
+BOUND_TOLERANCE = 1e-9
+
+
+def parse_ranked_opportunities(response: str, opportunity_ids: List[str]) -> Dict[str, Dict]:
+    """
+    Parse a batched LLM ranking response into {'id', 'name', 'score'} dicts keyed by id.
+
+    Tolerates markdown fences, a single object instead of an array, and
+    truncated or malformed JSON: every complete object that can be decoded is
+    kept, and items with unknown ids or unusable scores are dropped.
+    """
+    if not response:
+        return {}
+
+    text = response.strip()
+    if text.startswith('```'):
+        text = text.strip('`')
+        text = text[text.find('\n') + 1:] if '\n' in text else text
+
+    try:
+        parsed = json.loads(text)
+        items = parsed if isinstance(parsed, list) else [parsed]
+    except ValueError:
+        # Salvage every complete object from a partial or malformed array
+        decoder = json.JSONDecoder()
+        items = []
+        position = text.find('{')
+        while position != -1:
+            try:
+                item, end = decoder.raw_decode(text, position)
+                items.append(item)
+                position = text.find('{', end)
+            except ValueError:
+                position = text.find('{', position + 1)
+
+    known_ids = set(opportunity_ids)
+    ranked = {}
+    for item in items:
+        if not isinstance(item, dict) or item.get('id') not in known_ids:
+            continue
+        try:
+            score = min(max(float(item.get('score')), 0.0), 1.0)
+        except (TypeError, ValueError):
+            continue
+        ranked[item['id']] = {'id': item['id'], 'name': item.get('name'), 'score': score}
+
+    return ranked
+
+
+class BatchRankMixin:
+    """
+    Vectorized scoring shared by the rank classes. Relies on the class's
+    get_stage_weight and STAGE_WEIGHTS, and uses the same weights as
+    rank_opportunity_score.
+    """
+
+    def score_upper_bound(self, stage_weight: float, affinity_weight: float = 0.0, with_products: bool = True) -> float:
+        """
+        Highest raw score an opportunity at a stage of this weight can reach,
+        whatever its owner and, if with_products, its products. Opportunities
+        without products have no affinity, so blending only lowers their bound.
+        """
+        without_products = (0.8 * stage_weight) + 0.2
+        if not with_products:
+            return min(without_products, 1.0)
+
+        products_bound = 0.5 + (0.4 * stage_weight) + 0.1
+        if affinity_weight:
+            products_bound = max(products_bound, ((1 - affinity_weight) * products_bound) + affinity_weight)
+        return min(max(without_products, products_bound), 1.0)
+
+    def stage_filter(self, rank_threshold: float, affinity_weight: float = 0.0, with_products: bool = True) -> StageFilter | None:
+        """
+        The stages whose opportunities can reach rank_threshold, so the others
+        need not be scored.
+
+        Any opportunity with products can score 0.6, so for a CRM whose
+        opportunities can have products (with_products) no stage is filtered
+        until the threshold is above that. Without products the bound is
+        0.8 * weight + 0.2, which already rules out weights below 0.375 at 0.5.
+
+        Weights come from get_stage_weight for every stage in STAGE_WEIGHTS and
+        for a stage it does not know, so the filter follows how stages are
+        actually scored. If unknown stages can qualify, the filter excludes the
+        known stages that cannot; otherwise it includes only those that can.
+
+        Returns:
+            The filter, or None if every stage can qualify
+        """
+        def qualifies(stage_name) -> bool:
+            weight = self.get_stage_weight(stage_name)
+            return self.score_upper_bound(weight, affinity_weight, with_products) >= rank_threshold - BOUND_TOLERANCE
+
+        if qualifies(''):
+            excluded = tuple(stage for stage in self.STAGE_WEIGHTS if not qualifies(stage))
+            return StageFilter(excluded, include=False) if excluded else None
+
+        return StageFilter(tuple(stage for stage in self.STAGE_WEIGHTS if qualifies(stage)), include=True)
+
+    def score_opportunities_batch(
+        self,
+        opportunities: Sequence[OpportunityRecord],
+        transcript: str,
+        user_ids: List[str],
+        features: TranscriptFeatures | None = None,
+        participant_products: AbstractSet[str] | None = None,
+        affinity_weight: float = 0.0,
+        min_score: float | None = None
+    ) -> np.ndarray:
+        """
+        Compute the raw score of every opportunity in one vectorized expression,
+        matching rank_opportunity_score for each of them.
+
+        With min_score, product matching is skipped for opportunities that could
+        not reach it even with every product mentioned. Those are scored as if
+        none was, which keeps them below min_score.
+
+        Args:
+            opportunities: Opportunity records with their products
+            transcript: Call transcript
+            user_ids: IDs of the users on the call
+            features: Precomputed transcript features for the request
+            participant_products: Product IDs sold by the users on the call
+            affinity_weight: Share of the score given to how many of the opportunity's
+                products the users on the call sell (default 0, scores unchanged)
+            min_score: Lowest score the caller keeps, below which scores need not be exact
+
+        Returns:
+            Array of scores between 0 and 1, in input order
+        """
+        count = len(opportunities)
+        if not count:
+            return np.zeros(0)
+
+        if features is None:
+            features = get_transcript_features(transcript)
+        matcher = features.matcher
+        user_id_set = set(user_ids or [])
+
+        # Look each distinct stage up once, a missing stage as ''
+        stage_weights = {}
+        for opportunity in opportunities:
+            if opportunity.stage_name not in stage_weights:
+                stage_weights[opportunity.stage_name] = self.get_stage_weight(
+                    opportunity.stage_name if opportunity.stage_name is not None else ''
+                )
+
+        stage_weight = np.fromiter(
+            (stage_weights[opportunity.stage_name] for opportunity in opportunities),
+            dtype=np.float64,
+            count=count
+        )
+        owner_match = np.fromiter(
+            (1.0 if opportunity.owner_id and opportunity.owner_id in user_id_set else 0.0
+             for opportunity in opportunities),
+            dtype=np.float64,
+            count=count
+        )
+        has_products = np.fromiter((bool(opportunity.product_names) for opportunity in opportunities), dtype=bool, count=count)
+        blend_affinity = bool(affinity_weight and participant_products)
+        if blend_affinity:
+            affinity = np.fromiter(
+                (calculate_affinity(opportunity.product_ids, participant_products) for opportunity in opportunities),
+                dtype=np.float64,
+                count=count
+            )
+
+        # Product matching is the costly part, so only match opportunities that
+        # could still reach min_score if every one of their products was mentioned.
+        # With products a score can always reach 0.5, so this only prunes above it.
+        needs_match = has_products
+        if min_score is not None:
+            best_scores = 0.5 + (0.4 * stage_weight) + (0.1 * owner_match)
+            if blend_affinity:
+                best_scores = ((1 - affinity_weight) * best_scores) + (affinity_weight * affinity)
+            needs_match = has_products & (np.minimum(best_scores, 1.0) >= min_score - BOUND_TOLERANCE)
+
+        product_match = np.fromiter(
+            (sum(1 for name in opportunity.product_names if matcher.is_mentioned(name)) / len(opportunity.product_names)
+             if match else 0.0
+             for opportunity, match in zip(opportunities, needs_match.tolist())),
+            dtype=np.float64,
+            count=count
+        )
+
+        scores = np.where(
+            has_products,
+            (0.5 * product_match) + (0.4 * stage_weight) + (0.1 * owner_match),
+            (0.8 * stage_weight) + (0.2 * owner_match)
+        )
+        if blend_affinity:
+            scores = ((1 - affinity_weight) * scores) + (affinity_weight * affinity)
+
+        return np.clip(scores, 0.0, 1.0)
+
+    def rank_opportunities_batch(
+        self,
+        opportunities: Sequence[OpportunityRecord],
+        transcript: str,
+        user_ids: List[str],
+        features: TranscriptFeatures | None = None,
+        rank_threshold: float = 0.5,
+        min_score_threshold: float = 0.25,
+        score_difference_threshold: float = 0.1,
+        participant_products: AbstractSet[str] | None = None,
+        affinity_weight: float = 0.0,
+        scores: np.ndarray | None = None
+    ) -> List[Dict]:
+        """
+        Score a whole account's opportunities at once and pick the suggestion.
+
+        Equivalent to calling rank_opportunity_score for each opportunity, dropping
+        scores below rank_threshold, then normalize_scores and determine_suggestion,
+        but with the weighting, filtering and ordering done as array operations.
+
+        Args:
+            opportunities: Opportunity records with their products
+            transcript: Call transcript
+            user_ids: IDs of the users on the call
+            features: Precomputed transcript features for the request
+            rank_threshold: Minimum raw score to be kept (default 0.5)
+            min_score_threshold: Minimum normalized score to be suggested (default 0.25)
+            score_difference_threshold: Required difference from next best score (default 0.1)
+            participant_products: Product IDs sold by the users on the call
+            affinity_weight: Share of the score given to how many of the opportunity's
+                products the users on the call sell (default 0, scores unchanged)
+            scores: Scores already computed by score_opportunities_batch
+
+        Returns:
+            Kept opportunities sorted by normalized rank with suggested flag
+        """
+        if not opportunities:
+            return []
+
+        if scores is None:
+            scores = self.score_opportunities_batch(
+                opportunities,
+                transcript,
+                user_ids,
+                features=features,
+                participant_products=participant_products,
+                affinity_weight=affinity_weight,
+                min_score=rank_threshold
+            )
+
+        # Keep scores above the threshold, highest first, ties in fetch order
+        kept = np.flatnonzero(scores >= rank_threshold)
+        if not kept.size:
+            return []
+        kept = kept[np.argsort(-scores[kept], kind='stable')]
+        kept_scores = scores[kept]
+
+        # cumsum adds left to right like the scalar path, so the total matches exactly
+        total_rank = np.cumsum(kept_scores)[-1]
+        if total_rank == 0:
+            ranks = kept_scores.tolist()
+        else:
+            ranks = [round(rank, 2) for rank in (kept_scores / total_rank).tolist()]
+
+        top_score = ranks[0]
+        second_score = ranks[1] if len(ranks) > 1 else 0
+        should_suggest = (top_score >= min_score_threshold and
+                          top_score - second_score >= score_difference_threshold)
+
+        return [
+            opportunities[index].to_result(rank, should_suggest and rank == top_score)
+            for index, rank in zip(kept.tolist(), ranks)
+        ]
+
+
+class ACRMRank(BatchRankMixin):
+    STAGE_WEIGHTS = {
+        "In Progress (BASE)": 1.0,
+        "Won (BASE)": 0.9,
+        "Verbal Agreement (BASE)": 0.7,
+        "Rests (BASE)": 0.4,
+        "Lost (BASE)": 0.1,
+        "Cancelled (BASE)": 0.1
+    }
+
+    def calculate_product_match(self, opportunity_products: List[Dict], transcript: str, features: TranscriptFeatures | None = None) -> float:
         """Calculate how many products from the opportunity are mentioned in the transcript"""
         if not opportunity_products:
             return 0.0
@@ -13,36 +309,22 @@ class ACRMRank:
         mentioned_products = 0
         total_products = len(opportunity_products)
         
-        # Convert transcript to lowercase once
-        transcript_lower = transcript.lower()
+        # Reuse the request's features so the transcript is only lowered and indexed once
+        if features is None:
+            features = get_transcript_features(transcript)
         
         for product in opportunity_products:
-            product_name = product.get('product_name', '').lower()
-            if not product_name:
-                continue
-                
-            # Split product name into words and check if any word is in transcript
-            product_words = product_name.split()
-            for word in product_words:
-                if len(word) > 3 and word in transcript_lower:  # Only check words longer than 3 chars
-                    mentioned_products += 1
-                    break  # Count the product as mentioned if any of its words are found
+            # Count the product as mentioned if any of its words longer than 3 chars is found
+            if features.matcher.is_mentioned(product.get('product_name')):
+                mentioned_products += 1
         
         match_score = mentioned_products / total_products if total_products > 0 else 0.0
-        print(f"Product match score: {match_score} ({mentioned_products}/{total_products})")
+        logger.debug("Product match score: %s (%s/%s)", match_score, mentioned_products, total_products)
         return match_score
 
     def get_stage_weight(self, stage_name: int) -> float:
         """Get weight based on opportunity stage"""
-        stage_weights = {
-            "In Progress (BASE)": 1.0,
-            "Won (BASE)": 0.9,
-            "Verbal Agreement (BASE)": 0.7,
-            "Rests (BASE)": 0.4,
-            "Lost (BASE)": 0.1,
-            "Cancelled (BASE)": 0.1
-        }
-        return stage_weights.get(stage_name, 0.0)
+        return self.STAGE_WEIGHTS.get(stage_name, 0.0)
 
     def calculate_owner_match(self, opportunity_owner_id: str, user_ids: List[str]) -> float:
         """Calculate if the opportunity owner is in the list of user IDs"""
@@ -52,8 +334,16 @@ class ACRMRank:
         return 1.0 if opportunity_owner_id in user_ids else 0.0
 
 
-class PivotalRank:
-    def calculate_product_match(self, opportunity_products: List[Dict], transcript: str) -> float:
+class PivotalRank(BatchRankMixin):
+    STAGE_WEIGHTS = {
+        0: 1.0,
+        1: 0.1,
+        2: 0.3,
+        3: 0.4,
+        4: 0.1
+    }
+
+    def calculate_product_match(self, opportunity_products: List[Dict], transcript: str, features: TranscriptFeatures | None = None) -> float:
         """Calculate how many products from the opportunity are mentioned in the transcript"""
         if not opportunity_products:
             return 0.0
@@ -61,36 +351,23 @@ class PivotalRank:
         mentioned_products = 0
         total_products = len(opportunity_products)
         
-        # Convert transcript to lowercase once
-        transcript_lower = transcript.lower()
+        # Reuse the request's features so the transcript is only lowered and indexed once
+        if features is None:
+            features = get_transcript_features(transcript)
         
         for product in opportunity_products:
-            product_name = product.get('product_name', '').lower()
-            if not product_name:
-                continue
-                
-            # Split product name into words and check if any word is in transcript
-            product_words = product_name.split()
-            for word in product_words:
-                if len(word) > 3 and word in transcript_lower:  # Only check words longer than 3 chars
-                    mentioned_products += 1
-                    break  # Count the product as mentioned if any of its words are found
+            # Count the product as mentioned if any of its words longer than 3 chars is found
+            if features.matcher.is_mentioned(product.get('product_name')):
+                mentioned_products += 1
         
         match_score = mentioned_products / total_products if total_products > 0 else 0.0
-        print(f"Product match score: {match_score} ({mentioned_products}/{total_products})")
+        logger.debug("Product match score: %s (%s/%s)", match_score, mentioned_products, total_products)
         return match_score
 
 
     def get_stage_weight(self, stage_name: int) -> float:
         """Get weight based on opportunity stage"""
-        stage_weights = {
-            0: 1.0,
-            1: 0.1,
-            2: 0.3,
-            3: 0.4, 
-            4: 0.1
-        }
-        return stage_weights.get(stage_name, 0.0)
+        return self.STAGE_WEIGHTS.get(stage_name, 0.0)
 
 
     def calculate_owner_match(self, opportunity_owner_id: str, user_ids: List[str]) -> float:
@@ -100,7 +377,7 @@ class PivotalRank:
         
         return 1.0 if opportunity_owner_id in user_ids else 0.0
 
-    def rank_opportunity_score(self, opportunity: Dict, opportunity_products: List[Dict], transcript: str, user_ids: List[str]) -> float:
+    def rank_opportunity_score(self, opportunity: Dict, opportunity_products: List[Dict], transcript: str, user_ids: List[str], features: TranscriptFeatures | None = None) -> float:
         """
         Calculate opportunity score based on multiple factors:
         If product_ids are provided:
@@ -112,21 +389,21 @@ class PivotalRank:
             - Owner match (20%)
         """
         # Add debug logging
-        print(f"Stage name: {opportunity.get('StageName', 'Unknown')}")
-        print(f"Products count: {len(opportunity_products)}")
-        print(f"Owner ID: {opportunity.get('OwnerId', 'Unknown')}")
+        logger.debug("Stage name: %s", opportunity.get('StageName', 'Unknown'))
+        logger.debug("Products count: %s", len(opportunity_products))
+        logger.debug("Owner ID: %s", opportunity.get('OwnerId', 'Unknown'))
         
         # Calculate individual components
         stage_weight = self.get_stage_weight(opportunity.get('StageName', ''))
         owner_match = self.calculate_owner_match(opportunity.get('OwnerId'), user_ids)
 
         # Log individual scores
-        print(f"Stage weight: {stage_weight}")
-        print(f"Owner match: {owner_match}")
+        logger.debug("Stage weight: %s", stage_weight)
+        logger.debug("Owner match: %s", owner_match)
         
         if opportunity_products:  # If we have products to match
-            product_match = self.calculate_product_match(opportunity_products, transcript)
-            print(f"Product match: {product_match}")
+            product_match = self.calculate_product_match(opportunity_products, transcript, features)
+            logger.debug("Product match: %s", product_match)
 
             # Calculate final score with all weights
             final_score = (
@@ -135,24 +412,58 @@ class PivotalRank:
                 (0.1 * owner_match)
             )
         else:  # If no products to match, redistribute weights
-            print("No products to match, using stage and owner weights only")
+            logger.debug("No products to match, using stage and owner weights only")
             final_score = (
                 (0.8 * stage_weight) +
                 (0.2 * owner_match)
             )
         
         # Log final score
-        print(f"Final score before normalization: {final_score}")
+        logger.debug("Final score before normalization: %s", final_score)
         
         # Normalize to ensure we don't exceed 1.0
         normalized_score = min(max(final_score, 0.0), 1.0)
-        print(f"Final normalized score: {normalized_score}")
+        logger.debug("Final normalized score: %s", normalized_score)
         
         return normalized_score
 
     
-class SalesforceRank:
-    def calculate_product_match(self, opportunity_products: List[Dict], transcript: str) -> float:
+class SalesforceRank(BatchRankMixin):
+    STAGE_WEIGHTS = {
+        # High probability stages (1.0 - 0.8)
+        'Engaged': 1.0,
+        'Proposal': 0.9,
+        'Quote Follow-Up': 0.85,
+        'Finalizing': 0.8,
+
+        # Medium-high probability stages (0.7 - 0.6)
+        'Outreach': 0.7,
+        'User': 0.7,
+        'Business': 0.65,
+        'Introduction': 0.7,
+        'Connect': 0.65,
+        'Engage': 0.65,
+        'Pending': 0.7,  # Increased from 0.6 to 0.7
+
+        # Medium probability stages (0.5 - 0.4)
+        'Activation': 0.5,
+        'Review': 0.5,
+        'Identify Resolution': 0.45,
+        'Resolution Attempt': 0.45,
+
+        # Low-medium probability stages (0.3 - 0.2)
+        'Resolution Success': 0.3,
+        'Co-Term': 0.25,
+
+        # Low probability stages (0.1 - 0.0)
+        'Resolution Fail/Futile': 0.1,
+        "Won't Process": 0.05,
+        'Closed Won': 0.1,
+        'Closed Lost': 0.0,
+        'None': 0.0
+    }
+
+    def calculate_product_match(self, opportunity_products: List[Dict], transcript: str, features: TranscriptFeatures | None = None) -> float:
         """Calculate how many products from the opportunity are mentioned in the transcript"""
         if not opportunity_products:
             return 0.0
@@ -160,66 +471,30 @@ class SalesforceRank:
         mentioned_products = 0
         total_products = len(opportunity_products)
         
-        # Convert transcript to lowercase once
-        transcript_lower = transcript.lower()
+        # Reuse the request's features so the transcript is only lowered and indexed once
+        if features is None:
+            features = get_transcript_features(transcript)
         
         for product in opportunity_products:
-            product_name = product.get('product_name', '').lower()
-            if not product_name:
-                continue
-                
-            # Split product name into words and check if any word is in transcript
-            product_words = product_name.split()
-            for word in product_words:
-                if len(word) > 3 and word in transcript_lower:  # Only check words longer than 3 chars
-                    mentioned_products += 1
-                    break  # Count the product as mentioned if any of its words are found
+            # Count the product as mentioned if any of its words longer than 3 chars is found
+            if features.matcher.is_mentioned(product.get('product_name')):
+                mentioned_products += 1
         
         match_score = mentioned_products / total_products if total_products > 0 else 0.0
-        print(f"Product match score: {match_score} ({mentioned_products}/{total_products})")
+        logger.debug("Product match score: %s (%s/%s)", match_score, mentioned_products, total_products)
         return match_score
 
     def get_stage_weight(self, stage_name: str) -> float:
         """Get weight based on opportunity stage"""
-        stage_weights = {
-            # High probability stages (1.0 - 0.8)
-            'Engaged': 1.0,
-            'Proposal': 0.9,
-            'Quote Follow-Up': 0.85,
-            'Finalizing': 0.8,
-            
-            # Medium-high probability stages (0.7 - 0.6)
-            'Outreach': 0.7,
-            'User': 0.7,
-            'Business': 0.65,
-            'Introduction': 0.7,
-            'Connect': 0.65,
-            'Engage': 0.65,
-            'Pending': 0.7,  # Increased from 0.6 to 0.7
-            
-            # Medium probability stages (0.5 - 0.4)
-            'Activation': 0.5,
-            'Review': 0.5,
-            'Identify Resolution': 0.45,
-            'Resolution Attempt': 0.45,
-            
-            # Low-medium probability stages (0.3 - 0.2)
-            'Resolution Success': 0.3,
-            'Co-Term': 0.25,
-            
-            # Low probability stages (0.1 - 0.0)
-            'Resolution Fail/Futile': 0.1,
-            "Won't Process": 0.05,
-            'Closed Won': 0.1,
-            'Closed Lost': 0.0,
-            'None': 0.0
-        }
-        return stage_weights.get(stage_name.lower(), 0.2)
-
-    def calculate_name_match(self, opportunity_name: str, transcript: str) -> float:
+        return self.STAGE_WEIGHTS.get(stage_name.lower(), 0.2)
+
+    def calculate_name_match(self, opportunity_name: str, transcript: str, features: TranscriptFeatures | None = None) -> float:
         """Simple name matching - can be enhanced with more sophisticated NLP"""
+        if features is None:
+            features = get_transcript_features(transcript)
+
         opportunity_words = set(opportunity_name.lower().split())
-        transcript_words = set(transcript.lower().split())
+        transcript_words = features.tokens
         
         if not opportunity_words:
             return 0.0
@@ -234,7 +509,7 @@ class SalesforceRank:
         
         return 1.0 if opportunity_owner_id in user_ids else 0.0
 
-    def rank_opportunity_score(self, opportunity: Dict, opportunity_products: List[Dict], transcript: str, user_ids: List[str]) -> float:
+    def rank_opportunity_score(self, opportunity: Dict, opportunity_products: List[Dict], transcript: str, user_ids: List[str], features: TranscriptFeatures | None = None) -> float:
         """
         Calculate opportunity score based on multiple factors:
         If product_ids are provided:
@@ -246,21 +521,21 @@ class SalesforceRank:
             - Owner match (20%)
         """
         # Add debug logging
-        print(f"Stage name: {opportunity.get('StageName', 'Unknown')}")
-        print(f"Products count: {len(opportunity_products)}")
-        print(f"Owner ID: {opportunity.get('OwnerId', 'Unknown')}")
+        logger.debug("Stage name: %s", opportunity.get('StageName', 'Unknown'))
+        logger.debug("Products count: %s", len(opportunity_products))
+        logger.debug("Owner ID: %s", opportunity.get('OwnerId', 'Unknown'))
         
         # Calculate individual components
         stage_weight = self.get_stage_weight(opportunity.get('StageName', ''))
         owner_match = self.calculate_owner_match(opportunity.get('OwnerId'), user_ids)
         
         # Log individual scores
-        print(f"Stage weight: {stage_weight}")
-        print(f"Owner match: {owner_match}")
+        logger.debug("Stage weight: %s", stage_weight)
+        logger.debug("Owner match: %s", owner_match)
         
         if opportunity_products:  # If we have products to match
-            product_match = self.calculate_product_match(opportunity_products, transcript)
-            print(f"Product match: {product_match}")
+            product_match = self.calculate_product_match(opportunity_products, transcript, features)
+            logger.debug("Product match: %s", product_match)
             
             # Calculate final score with all weights
             final_score = (
@@ -269,22 +544,25 @@ class SalesforceRank:
                 (0.1 * owner_match)
             )
         else:  # If no products to match, redistribute weights
-            print("No products to match, using stage and owner weights only")
+            logger.debug("No products to match, using stage and owner weights only")
             final_score = (
                 (0.8 * stage_weight) +
                 (0.2 * owner_match)
             )
         
         # Log final score
-        print(f"Final score before normalization: {final_score}")
+        logger.debug("Final score before normalization: %s", final_score)
         
         # Normalize to ensure we don't exceed 1.0
         normalized_score = min(max(final_score, 0.0), 1.0)
-        print(f"Final normalized score: {normalized_score}")
+        logger.debug("Final normalized score: %s", normalized_score)
         
         return normalized_score
 
     def rank_opportunity(opportunity: dict, user_products: list, transcript: str) -> dict:
+        # Imported here so the heuristic path never loads the LLM stack
+        from langchain_service import Speeds, service as langchain_svc
+
         context = f"You are a senior software engineer. Given the following opportunity, rank it based on the products that are being discussed here: {transcript}."
         prompt = f"""
             These are the products that the sales representative is selling:
@@ -311,13 +589,95 @@ class SalesforceRank:
                 Speeds.FAST
             )
         
-        print(f"Ranked opportunity: {ranked_opportunities}")
+        logger.debug("Ranked opportunity: %s", ranked_opportunities)
         
         json_ranked_opportunity = json.loads(ranked_opportunities)
-        print(f"JSON Ranked opportunity: {json_ranked_opportunity}")
+        logger.debug("JSON Ranked opportunity: %s", json_ranked_opportunity)
         
         return json_ranked_opportunity
 
+    def _build_batch_prompt(self, opportunities: List[Dict], user_products: list) -> str:
+        return f"""
+            These are the products that the sales representative is selling:
+            {user_products}
+
+            Score each of the opportunities below between 0 and 1. Being closer to 1 means the opportunity is more likely to be the one being discussed.
+            The response should be a JSON array, not a string or markdown, with one object per opportunity in this structure:
+            
+            [
+                {{
+                    "id": "The opportunity id",
+                    "name": "The opportunity name",
+                    "score": "The score of the opportunity"
+                }}
+            ]
+            
+            If an opportunity is not related to the products being discussed, set its score to 0.
+            
+            These records come from the Salesforce API:
+            {json.dumps(opportunities, default=str)}
+        """
+
+    async def _rank_llm_batch(self, opportunities: List[Dict], user_products: list, transcript: str, semaphore: asyncio.Semaphore, retry_missing: bool = True) -> List[Dict]:
+        """Rank one batch with a single prompt, re-asking once for opportunities missing from the response"""
+        from langchain_service import Speeds, service as langchain_svc
+
+        context = f"You are a senior software engineer. Given the following opportunities, rank them based on the products that are being discussed here: {transcript}."
+        prompt = self._build_batch_prompt(opportunities, user_products)
+
+        try:
+            async with semaphore:
+                response = await langchain_svc.achat(
+                    [{ 'role': 'user', 'content': context }],
+                    prompt,
+                    Speeds.FAST
+                )
+        except Exception as e:
+            logger.error("LLM batch ranking failed: %s", e)
+            response = ''
+
+        ranked = parse_ranked_opportunities(response, [opportunity.get('Id') for opportunity in opportunities])
+
+        missing = [opportunity for opportunity in opportunities if opportunity.get('Id') not in ranked]
+        if missing and retry_missing and len(missing) < len(opportunities):
+            logger.warning("LLM response missed %s of %s opportunities, retrying them", len(missing), len(opportunities))
+            for item in await self._rank_llm_batch(missing, user_products, transcript, semaphore, retry_missing=False):
+                ranked[item['id']] = item
+
+        # Opportunities the model never scored keep a zero score rather than failing the batch
+        return [
+            ranked.get(opportunity.get('Id')) or {
+                'id': opportunity.get('Id'),
+                'name': opportunity.get('Name'),
+                'score': 0.0,
+                'error': 'missing from LLM response'
+            }
+            for opportunity in opportunities
+        ]
+
+    async def arank_opportunities(self, opportunities: List[Dict], user_products: list, transcript: str, batch_size: int = LLM_BATCH_SIZE, max_concurrency: int = LLM_MAX_CONCURRENCY) -> List[Dict]:
+        """
+        Rank opportunities with the LLM, packing up to batch_size of them into each
+        prompt so the transcript is sent once per batch, and running at most
+        max_concurrency batches at a time.
+
+        Returns:
+            One {'id', 'name', 'score'} dict per opportunity, in input order
+        """
+        if not opportunities:
+            return []
+
+        semaphore = asyncio.Semaphore(max_concurrency)
+        batches = [opportunities[i:i + batch_size] for i in range(0, len(opportunities), batch_size)]
+        results = await asyncio.gather(*[
+            self._rank_llm_batch(batch, user_products, transcript, semaphore) for batch in batches
+        ])
+        return [item for batch in results for item in batch]
+
+    def rank_opportunities(self, opportunities: List[Dict], user_products: list, transcript: str, batch_size: int = LLM_BATCH_SIZE, max_concurrency: int = LLM_MAX_CONCURRENCY) -> List[Dict]:
+        """Synchronous wrapper around arank_opportunities for callers outside an event loop"""
+        return asyncio.run(self.arank_opportunities(opportunities, user_products, transcript, batch_size, max_concurrency))
+
     def determine_suggestion(self, opportunities: List[Dict], min_score_threshold: float = 0.25, score_difference_threshold: float = 0.1) -> List[Dict]:
         """
         Determine which opportunity should be suggested based on dynamic thresholds.
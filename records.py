@@ -0,0 +1,145 @@
+from typing import Dict, Iterable, List, NamedTuple
+
+from product_catalog import ProductCatalog
+
+
+def line_item_product_name(line_item: dict, catalog: ProductCatalog | None = None) -> str | None:
+    """
+    Name of a raw OpportunityLineItem's product. With a catalog, names missing
+    from the record are resolved locally from Product2Id, so the CRM query does
+    not need to join Product2.
+    """
+    product_name = (line_item.get('Product2') or {}).get('Name')
+    if not product_name and catalog is not None:
+        product_name = catalog.get_name(line_item.get('Product2Id'))
+    return product_name
+
+
+class StageFilter(NamedTuple):
+    """
+    The stages worth fetching and ranking: only those listed if include, else
+    any but those listed. Stage names compare as the rank class looks them up,
+    a missing stage as ''.
+    """
+
+    stages: tuple
+    include: bool
+
+    def keeps(self, stage_name) -> bool:
+        return ((stage_name if stage_name is not None else '') in self.stages) == self.include
+
+    @property
+    def excludes_all(self) -> bool:
+        """True if no stage is kept, so there is nothing worth fetching"""
+        return self.include and not self.stages
+
+
+class OpportunityRecord:
+    """
+    The fields of an opportunity ranking reads, with its products as parallel
+    tuples of ids and names. Built once from the raw CRM records, which may be
+    larger and cached, so they need not be kept for the rest of the request.
+
+    Products are columns rather than an object each since every tracked object
+    adds to the garbage collector's work, which dominates on large accounts.
+    """
+
+    __slots__ = ('id', 'name', 'stage_name', 'owner_id', 'product_ids', 'product_names')
+
+    def __init__(
+        self,
+        id: str | None,
+        name: str | None,
+        stage_name,
+        owner_id: str | None,
+        product_ids: tuple = (),
+        product_names: tuple = ()
+    ):
+        self.id = id
+        self.name = name
+        self.stage_name = stage_name
+        self.owner_id = owner_id
+        self.product_ids = product_ids
+        self.product_names = product_names
+
+    @classmethod
+    def from_crm(cls, opportunity: dict, line_items: Iterable[dict] | None = None, catalog: ProductCatalog | None = None) -> 'OpportunityRecord':
+        """Build the record from a raw opportunity and its line items, by default those nested under 'OpportunityLineItems'"""
+        if line_items is None:
+            line_items = opportunity.get('OpportunityLineItems') or ()
+        return cls(
+            opportunity.get('Id'),
+            opportunity.get('Name'),
+            opportunity.get('StageName'),
+            opportunity.get('OwnerId'),
+            tuple(line_item.get('Product2Id') for line_item in line_items),
+            tuple(line_item_product_name(line_item, catalog) for line_item in line_items)
+        )
+
+    def to_result(self, rank: float, suggested: bool | None = None) -> dict:
+        """The opportunity as the handler returns it, with suggested left out until it is decided"""
+        result = {
+            'id': self.id,
+            'name': self.name,
+            'stage_name': self.stage_name,
+            'owner_id': self.owner_id,
+            'rank': rank
+        }
+        if suggested is not None:
+            result['suggested'] = suggested
+        return result
+
+
+def from_nested_products(
+    raw_opportunities: Iterable[dict],
+    catalog: ProductCatalog | None = None,
+    stage_filter: StageFilter | None = None
+) -> List[OpportunityRecord]:
+    """
+    Build records for opportunities fetched with their line items nested under
+    'OpportunityLineItems', skipping those in stages the stage_filter drops
+    """
+    return [
+        OpportunityRecord.from_crm(opportunity, catalog=catalog)
+        for opportunity in raw_opportunities
+        if stage_filter is None or stage_filter.keeps(opportunity.get('StageName'))
+    ]
+
+
+def restrict_products(opportunity_records: List[OpportunityRecord], user_ids: Iterable[str] | None) -> List[OpportunityRecord]:
+    """
+    Drop the products of opportunities none of the users own, as the line item
+    query scoped to the users' opportunities would. Records are copied rather
+    than changed, since other items ranked against the account share them.
+    """
+    if not user_ids:
+        return opportunity_records
+
+    user_ids = set(user_ids)
+    return [
+        record if record.owner_id in user_ids or not record.product_ids
+        else OpportunityRecord(record.id, record.name, record.stage_name, record.owner_id)
+        for record in opportunity_records
+    ]
+
+
+def from_separate_products(
+    raw_opportunities: Iterable[dict],
+    raw_opportunity_products: Iterable[dict],
+    catalog: ProductCatalog | None = None,
+    stage_filter: StageFilter | None = None
+) -> List[OpportunityRecord]:
+    """
+    Build records for opportunities and line items fetched separately, joining
+    the line items to their opportunity by OpportunityId. Opportunities without
+    line items get no products, and those in stages the stage_filter drops are skipped.
+    """
+    line_items_by_opportunity: Dict[str, list] = {}
+    for line_item in raw_opportunity_products:
+        line_items_by_opportunity.setdefault(line_item.get('OpportunityId'), []).append(line_item)
+
+    return [
+        OpportunityRecord.from_crm(opportunity, line_items_by_opportunity.get(opportunity.get('Id'), ()), catalog)
+        for opportunity in raw_opportunities
+        if stage_filter is None or stage_filter.keeps(opportunity.get('StageName'))
+    ]
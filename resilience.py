@@ -0,0 +1,346 @@
+import asyncio
+import logging
+import threading
+import time
+from collections import OrderedDict, deque
+from typing import Awaitable, Callable, Dict
+
+import httpx
+import requests
+from tenacity import (
+    AsyncRetrying,
+    Retrying,
+    retry_if_exception_type,
+    retry_if_result,
+    stop_after_attempt,
+    wait_random_exponential
+)
+
+import metrics
+
+
+logger = logging.getLogger(__name__)
+
+
+# Seconds a CRM call may wait for a response before latencies are known, and the
+# most an adaptive timeout grows to. Tenants override it with config 'crm_timeout'.
+DEFAULT_TIMEOUT = 20
+
+# Adaptive timeouts are this multiple of the endpoint's p99, but never below MIN_TIMEOUT
+TIMEOUT_P99_MULTIPLIER = 3
+MIN_TIMEOUT = 2
+
+# Latencies kept per endpoint, and how many are needed before timeouts and hedging adapt
+LATENCY_WINDOW = 200
+MIN_LATENCY_SAMPLES = 20
+
+# Attempts per idempotent call, with full-jitter exponential backoff between them
+MAX_ATTEMPTS = 3
+RETRY_BACKOFF = 0.1
+RETRY_MAX_BACKOFF = 2
+
+# Statuses worth retrying; anything else is the CRM's answer
+RETRY_STATUSES = frozenset({429, 500, 502, 503, 504})
+
+# Failed calls in a row that open a tenant's circuit, and seconds it stays open
+# before a single trial call is let through
+BREAKER_FAILURE_THRESHOLD = 5
+BREAKER_RESET_TIMEOUT = 30
+
+# Tenants whose latencies and circuit are tracked in a warm container
+MAX_TRACKED_TENANTS = 64
+
+TRANSIENT_ERRORS = (
+    requests.exceptions.ConnectionError,
+    requests.exceptions.Timeout,
+    httpx.TransportError
+)
+
+
+class CircuitOpenError(Exception):
+    """Raised instead of calling a CRM whose circuit is open"""
+
+
+class LatencyWindow:
+    """The most recent successful call durations of one endpoint"""
+
+    def __init__(self, size: int = LATENCY_WINDOW):
+        self._durations = deque(maxlen=size)
+        self._lock = threading.Lock()
+
+    def record(self, seconds: float) -> None:
+        with self._lock:
+            self._durations.append(seconds)
+
+    def percentile(self, fraction: float) -> float | None:
+        """Nearest-rank percentile, or None until MIN_LATENCY_SAMPLES durations are known"""
+        with self._lock:
+            if len(self._durations) < MIN_LATENCY_SAMPLES:
+                return None
+            durations = sorted(self._durations)
+        return durations[min(int(fraction * len(durations)), len(durations) - 1)]
+
+
+class CircuitBreaker:
+    """
+    Opens after failure_threshold failed calls in a row, rejecting calls for
+    reset_timeout seconds. Then one trial call is let through: success closes
+    the circuit, failure opens it again.
+    """
+
+    def __init__(self, failure_threshold: int = BREAKER_FAILURE_THRESHOLD, reset_timeout: float = BREAKER_RESET_TIMEOUT):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self._failures = 0
+        self._opened_at = None
+        self._trial_in_flight = False
+        self._lock = threading.Lock()
+        self.times_opened = 0
+
+    @property
+    def state(self) -> str:
+        with self._lock:
+            if self._opened_at is None:
+                return 'closed'
+            if time.monotonic() - self._opened_at < self.reset_timeout:
+                return 'open'
+            return 'half_open'
+
+    def allow(self) -> bool:
+        with self._lock:
+            if self._opened_at is None:
+                return True
+            if time.monotonic() - self._opened_at < self.reset_timeout or self._trial_in_flight:
+                return False
+            self._trial_in_flight = True
+            return True
+
+    def record_success(self) -> None:
+        with self._lock:
+            self._failures = 0
+            self._opened_at = None
+            self._trial_in_flight = False
+
+    def record_failure(self) -> None:
+        with self._lock:
+            self._failures += 1
+            if self._trial_in_flight or self._failures >= self.failure_threshold:
+                if self._opened_at is None or self._trial_in_flight:
+                    self.times_opened += 1
+                self._opened_at = time.monotonic()
+            self._trial_in_flight = False
+
+    def release_trial(self) -> None:
+        """Give up a half-open trial that ended without an answer from the CRM, so another call can try"""
+        with self._lock:
+            self._trial_in_flight = False
+
+
+class TenantHealth:
+    """Latencies per endpoint and the circuit breaker of one tenant's CRM"""
+
+    def __init__(self):
+        self.breaker = CircuitBreaker()
+        self._latencies: Dict[str, LatencyWindow] = {}
+        self._lock = threading.Lock()
+
+    def latencies(self, endpoint: str) -> LatencyWindow:
+        with self._lock:
+            window = self._latencies.get(endpoint)
+            if window is None:
+                window = self._latencies[endpoint] = LatencyWindow()
+            return window
+
+    def stats(self) -> dict:
+        with self._lock:
+            endpoints = dict(self._latencies)
+        return {
+            'circuit': self.breaker.state,
+            'times_opened': self.breaker.times_opened,
+            'latency_ms': {
+                endpoint: {
+                    name: round(value * 1000, 1) if value is not None else None
+                    for name, value in (('p50', window.percentile(0.5)), ('p95', window.percentile(0.95)), ('p99', window.percentile(0.99)))
+                }
+                for endpoint, window in endpoints.items()
+            }
+        }
+
+
+_tenants = OrderedDict()
+_tenants_lock = threading.Lock()
+
+
+def get_tenant_health(tenant: tuple) -> TenantHealth:
+    """Get the tracked health of a tenant, e.g. ('salesforce', url_domain), creating it on first use"""
+    with _tenants_lock:
+        health = _tenants.get(tenant)
+        if health is None:
+            health = _tenants[tenant] = TenantHealth()
+            while len(_tenants) > MAX_TRACKED_TENANTS:
+                _tenants.popitem(last=False)
+        _tenants.move_to_end(tenant)
+        return health
+
+
+def _retryable_response(response) -> bool:
+    return response.status_code in RETRY_STATUSES
+
+
+def _count_retry(retry_state) -> None:
+    metrics.count('crm_retries')
+    logger.warning("Retrying CRM call after attempt %s", retry_state.attempt_number)
+
+
+class CallPolicy:
+    """
+    How a service calls its tenant's CRM: adaptive timeouts, retries with
+    jittered backoff, hedged requests and the tenant's circuit breaker.
+
+    Health is shared by every service instance of the tenant. Settings come from
+    the tenant config: 'crm_timeout' caps timeouts, 'crm_max_attempts' bounds
+    retries and 'crm_hedging' set to false turns hedged requests off.
+    """
+
+    def __init__(self, tenant: tuple, config: Dict[str, str]):
+        self.health = get_tenant_health(tenant)
+        self.max_timeout = config.get('crm_timeout', DEFAULT_TIMEOUT)
+        self.max_attempts = max(1, config.get('crm_max_attempts', MAX_ATTEMPTS))
+        self.hedging = config.get('crm_hedging', True)
+
+    def timeout(self, endpoint: str) -> float:
+        """A multiple of the endpoint's p99 between MIN_TIMEOUT and the cap, or the cap until it is known"""
+        p99 = self.health.latencies(endpoint).percentile(0.99)
+        if p99 is None:
+            return self.max_timeout
+        return min(max(p99 * TIMEOUT_P99_MULTIPLIER, MIN_TIMEOUT), self.max_timeout)
+
+    def hedge_delay(self, endpoint: str) -> float | None:
+        """Seconds after which a duplicate request is sent: the endpoint's p95, once known"""
+        return self.health.latencies(endpoint).percentile(0.95) if self.hedging else None
+
+    def _retry_settings(self, idempotent: bool) -> dict:
+        return {
+            'stop': stop_after_attempt(self.max_attempts if idempotent else 1),
+            'wait': wait_random_exponential(multiplier=RETRY_BACKOFF, max=RETRY_MAX_BACKOFF),
+            'retry': retry_if_exception_type(TRANSIENT_ERRORS) | retry_if_result(_retryable_response),
+            'before_sleep': _count_retry,
+            # Out of attempts: return the last response, or raise the last error
+            'retry_error_callback': lambda retry_state: retry_state.outcome.result()
+        }
+
+    def _admit(self) -> None:
+        if not self.health.breaker.allow():
+            metrics.count('crm_circuit_open')
+            raise CircuitOpenError('CRM circuit is open, failing fast')
+
+    def _record(self, response) -> None:
+        if _retryable_response(response):
+            self.health.breaker.record_failure()
+        else:
+            self.health.breaker.record_success()
+
+    def _attempt(self, endpoint: str, send: Callable[[float], object]):
+        start = time.perf_counter()
+        response = send(self.timeout(endpoint))
+        if _retryable_response(response):
+            # Load the error body so it can still be logged, and release the connection
+            response.content
+            response.close()
+        else:
+            self.health.latencies(endpoint).record(time.perf_counter() - start)
+        return response
+
+    def call(self, endpoint: str, send: Callable[[float], object], idempotent: bool = False):
+        """
+        Call send(timeout) and return its requests response. Idempotent calls are
+        retried on connection errors, timeouts and RETRY_STATUSES. Hedging needs
+        a second request in flight, so only acall hedges.
+
+        Raises:
+            CircuitOpenError: If the tenant's circuit is open
+        """
+        self._admit()
+        try:
+            response = Retrying(**self._retry_settings(idempotent))(self._attempt, endpoint, send)
+        except Exception:
+            self.health.breaker.record_failure()
+            raise
+        except BaseException:
+            # Cancelled by the caller's deadline or interrupted; the CRM did not fail
+            self.health.breaker.release_trial()
+            raise
+
+        self._record(response)
+        return response
+
+    async def _aattempt(self, endpoint: str, send: Callable[[float], Awaitable[httpx.Response]]) -> httpx.Response:
+        start = time.perf_counter()
+        response = await send(self.timeout(endpoint))
+        if _retryable_response(response):
+            await response.aread()
+            await response.aclose()
+        else:
+            self.health.latencies(endpoint).record(time.perf_counter() - start)
+        return response
+
+    async def _ahedged(self, endpoint: str, send: Callable[[float], Awaitable[httpx.Response]]) -> httpx.Response:
+        """
+        Send the request, and a duplicate if no response arrived within the hedge
+        delay. The first response wins; the other request is cancelled, or closed
+        if it also completed.
+        """
+        first = asyncio.ensure_future(self._aattempt(endpoint, send))
+        delay = self.hedge_delay(endpoint)
+        if delay is None:
+            return await first
+
+        pending = {first}
+        try:
+            done, _ = await asyncio.wait(pending, timeout=delay)
+            if not done:
+                metrics.count('crm_hedges')
+                pending.add(asyncio.ensure_future(self._aattempt(endpoint, send)))
+
+            error = None
+            while pending:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                responses = [task.result() for task in done if task.exception() is None]
+                if not responses:
+                    error = next(task.exception() for task in done)
+                    continue
+
+                winner = next(task for task in done if task.exception() is None)
+                if winner is not first:
+                    metrics.count('crm_hedge_wins')
+                for response in responses[1:]:
+                    await response.aclose()
+                return winner.result()
+
+            raise error
+        finally:
+            for task in pending:
+                task.cancel()
+
+    async def acall(self, endpoint: str, send: Callable[[float], Awaitable[httpx.Response]], idempotent: bool = False) -> httpx.Response:
+        """
+        Async version of call for httpx responses, where idempotent calls are also
+        hedged once they take longer than the endpoint's p95.
+
+        Raises:
+            CircuitOpenError: If the tenant's circuit is open
+        """
+        self._admit()
+        attempt = self._ahedged if idempotent else self._aattempt
+        try:
+            response = await AsyncRetrying(**self._retry_settings(idempotent))(attempt, endpoint, send)
+        except Exception:
+            self.health.breaker.record_failure()
+            raise
+        except BaseException:
+            # Cancelled by the caller's deadline or interrupted; the CRM did not fail
+            self.health.breaker.release_trial()
+            raise
+
+        self._record(response)
+        return response
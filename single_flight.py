@@ -0,0 +1,101 @@
+import asyncio
+import threading
+from concurrent.futures import Future
+from typing import Awaitable, Callable
+
+import metrics
+
+
+class SingleFlight:
+    """
+    Collapses concurrent calls for the same key into one: the first caller runs
+    the fetch and every caller that arrives while it is in flight gets its
+    result (or its exception) instead of running it again.
+
+    Threads share calls made with do, and tasks on an event loop share those
+    made with ado. Nothing is kept once a call completes; caching is up to the
+    fetch itself.
+    """
+
+    def __init__(self):
+        self._calls = {}
+        self._tasks = {}
+        self._lock = threading.Lock()
+        self.calls = 0
+        self.coalesced = 0
+
+    def _record(self, leader: bool) -> None:
+        with self._lock:
+            if leader:
+                self.calls += 1
+            else:
+                self.coalesced += 1
+        if not leader:
+            metrics.count('crm_coalesced')
+
+    def do(self, key: str, fetch: Callable[[], object]):
+        """Run fetch, or wait for the call of another thread already running it for key"""
+        with self._lock:
+            future = self._calls.get(key)
+            leader = future is None
+            if leader:
+                future = self._calls[key] = Future()
+
+        self._record(leader)
+        if not leader:
+            return future.result()
+
+        try:
+            result = fetch()
+        except BaseException as e:
+            future.set_exception(e)
+            raise
+        else:
+            future.set_result(result)
+            return result
+        finally:
+            with self._lock:
+                del self._calls[key]
+
+    async def ado(self, key: str, fetch: Callable[[], Awaitable[object]]):
+        """
+        Async version of do, for a coroutine function. The fetch runs as its own
+        task, so a caller that is cancelled, e.g. by its deadline, does not
+        cancel it for the others.
+        """
+        loop_key = (asyncio.get_running_loop(), key)
+        with self._lock:
+            task = self._tasks.get(loop_key)
+            leader = task is None
+            if leader:
+                task = self._tasks[loop_key] = asyncio.ensure_future(fetch())
+                task.add_done_callback(lambda _: self._forget(loop_key))
+
+        self._record(leader)
+        return await asyncio.shield(task)
+
+    def _forget(self, loop_key: tuple) -> None:
+        with self._lock:
+            del self._tasks[loop_key]
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                'calls': self.calls,
+                'coalesced': self.coalesced,
+                'in_flight': len(self._calls) + len(self._tasks)
+            }
+
+
+_single_flight = None
+_single_flight_lock = threading.Lock()
+
+
+def get_single_flight() -> SingleFlight:
+    """Get the container-wide SingleFlight shared by every service"""
+    global _single_flight
+    if _single_flight is None:
+        with _single_flight_lock:
+            if _single_flight is None:
+                _single_flight = SingleFlight()
+    return _single_flight
@@ -0,0 +1,146 @@
+import asyncio
+
+import pytest
+
+import account_cache
+from account_cache import AccountCache
+
+
+class Clock:
+    """Stands in for time.time so entries age without waiting"""
+
+    def __init__(self, now=1000.0):
+        self.now = now
+
+    def __call__(self):
+        return self.now
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(account_cache.time, 'time', clock)
+    return clock
+
+
+def record(id, modstamp):
+    return {'Id': id, 'SystemModstamp': modstamp}
+
+
+def by_modstamp(record):
+    return record['SystemModstamp']
+
+
+def unexpected():
+    raise AssertionError('fetch should not be called')
+
+
+def cache_account(cache, records, sync_marker='2025-01-02'):
+    return cache.fetch('key', lambda: (records, sync_marker))
+
+
+def test_fresh_entries_are_served_without_fetching(clock):
+    cache = AccountCache()
+    records = cache_account(cache, [record('A', '2025-01-01')])
+
+    clock.now += account_cache.DEFAULT_REFRESH_INTERVAL - 1
+
+    assert cache.fetch('key', unexpected, unexpected) is records
+    assert cache.stats()['misses'] == 1 and cache.stats()['hits'] == 1
+
+
+@pytest.mark.parametrize('sort_key, order', [(by_modstamp, ['B', 'C', 'A']), (None, ['A', 'B', 'C'])])
+def test_delta_replaces_changed_records_and_adds_new_ones(clock, sort_key, order):
+    cache = AccountCache()
+    cache_account(cache, [record('A', '2025-01-01'), record('B', '2025-01-02')])
+    clock.now += account_cache.DEFAULT_REFRESH_INTERVAL
+    markers = []
+
+    def fetch_delta(since):
+        markers.append(since)
+        return [record('B', '2025-01-05'), record('C', '2025-01-03')], '2025-01-05'
+
+    records = cache.fetch('key', unexpected, fetch_delta, sort_key=sort_key)
+
+    assert markers == ['2025-01-02']
+    assert [r['Id'] for r in records] == order
+    assert next(r for r in records if r['Id'] == 'B')['SystemModstamp'] == '2025-01-05'
+    assert cache.lookup('key')['sync_marker'] == '2025-01-05'
+    assert cache.stats()['delta_refreshes'] == 1
+
+
+def test_delta_without_changes_keeps_the_sync_marker_and_full_fetch_time(clock):
+    cache = AccountCache()
+    cache_account(cache, [record('A', '2025-01-01')])
+    full_fetched_at = clock.now
+    clock.now += account_cache.DEFAULT_REFRESH_INTERVAL
+
+    assert [r['Id'] for r in cache.fetch('key', unexpected, lambda since: ([], None))] == ['A']
+
+    entry = cache.lookup('key')
+    assert entry['sync_marker'] == '2025-01-02'
+    assert entry['full_fetched_at'] == full_fetched_at and entry['synced_at'] == clock.now
+
+
+def test_failed_refresh_serves_the_stale_entry(clock):
+    cache = AccountCache()
+    records = cache_account(cache, [record('A', '2025-01-01')])
+    clock.now += account_cache.DEFAULT_REFRESH_INTERVAL
+
+    assert cache.fetch('key', unexpected, lambda since: None) is records
+    assert cache.fetch('key', lambda: None) is records
+    assert cache.stats()['stale_hits'] == 2
+
+
+def test_failed_fetch_without_an_entry_returns_none(clock):
+    cache = AccountCache()
+
+    assert cache.fetch('key', lambda: None) is None
+    assert cache.stats()['misses'] == 1
+
+
+def test_entries_past_the_ttl_are_fetched_in_full(clock):
+    cache = AccountCache()
+    cache_account(cache, [record('A', '2025-01-01')])
+    clock.now += account_cache.DEFAULT_TTL
+
+    records = cache.fetch('key', lambda: ([record('B', '2025-01-09')], '2025-01-09'), unexpected)
+
+    assert [r['Id'] for r in records] == ['B']
+    # A dropped entry is not served as stale either
+    clock.now += account_cache.DEFAULT_TTL
+    assert cache.fetch('key', lambda: None) is None
+
+
+def test_afetch_merges_deltas_like_fetch(clock):
+    cache = AccountCache()
+    cache_account(cache, [record('A', '2025-01-01')])
+    clock.now += account_cache.DEFAULT_REFRESH_INTERVAL
+
+    async def fetch_delta(since):
+        return [record('C', '2025-01-03')], '2025-01-03'
+
+    records = asyncio.run(cache.afetch('key', unexpected, fetch_delta, sort_key=by_modstamp))
+
+    assert [r['Id'] for r in records] == ['C', 'A']
+
+
+def test_update_stores_batched_fetches_or_falls_back_to_the_stale_entry(clock):
+    cache = AccountCache()
+    assert cache.get_fresh('key') is None
+
+    records = cache.update('key', [record('A', '2025-01-01')])
+    assert cache.get_fresh('key') is records
+
+    clock.now += account_cache.DEFAULT_REFRESH_INTERVAL
+    assert cache.get_fresh('key') is None
+    assert cache.update('key', None) is records
+    assert cache.update('other', None) is None
+
+
+def test_disk_tier_serves_a_new_cache(clock, tmp_path):
+    cache_account(AccountCache(disk_dir=str(tmp_path)), [record('A', '2025-01-01')])
+
+    records = AccountCache(disk_dir=str(tmp_path)).fetch('key', unexpected)
+
+    assert [r['Id'] for r in records] == ['A']
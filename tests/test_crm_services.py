@@ -0,0 +1,247 @@
+import asyncio
+
+import httpx
+import pytest
+
+import account_cache
+import crm_services
+import metrics
+from crm_services import ServiceRegistry
+
+
+SALESFORCE = {'url_domain': 'https://tenant.example.com', 'access_token': 'token', 'crm_timeout': 5}
+
+
+def test_registry_reuses_a_service_for_settings_it_does_not_read():
+    registry = ServiceRegistry()
+    service = registry.get('salesforce', SALESFORCE)
+
+    assert registry.get('salesforce', {**SALESFORCE, 'ranking_mode': 'cascade'}) is service
+    assert registry.stats()['hits'] == 1
+
+
+def test_registry_never_changes_the_config_of_a_registered_service():
+    registry = ServiceRegistry()
+    service = registry.get('salesforce', SALESFORCE)
+
+    changed = registry.get('salesforce', {**SALESFORCE, 'crm_timeout': 9})
+
+    assert changed is not service
+    assert service.config == SALESFORCE and service.policy.max_timeout == 5
+    assert changed.policy.max_timeout == 9
+
+
+def test_registry_closes_the_least_recently_used_service(monkeypatch):
+    closed = []
+    monkeypatch.setattr(crm_services, 'close_service', closed.append)
+    registry = ServiceRegistry(max_size=2)
+
+    first = registry.get('salesforce', {**SALESFORCE, 'access_token': 'a'})
+    second = registry.get('salesforce', {**SALESFORCE, 'access_token': 'b'})
+    registry.get('salesforce', {**SALESFORCE, 'access_token': 'a'})
+    registry.get('salesforce', {**SALESFORCE, 'access_token': 'c'})
+
+    assert closed == [second]
+    assert registry.get('salesforce', {**SALESFORCE, 'access_token': 'a'}) is first
+
+
+def tenants_on_one_endpoint(platform, field):
+    """Two tenants of a platform sharing url_domain, told apart only by field"""
+    base = {'url_domain': 'https://shared.example.com', 'username': 'user', 'password': 'secret',
+            'access_token': 'token', 'form_name': 'Company', 'pivotal_environment_name': 'prod', 'acrm_product_table': 'Y3'}
+    return (
+        crm_services.SERVICE_CLASSES[platform]({**base, field: 'tenant-a'}),
+        crm_services.SERVICE_CLASSES[platform]({**base, field: 'tenant-b'})
+    )
+
+
+async def respond_as_tenant(service, field, delay=0.01):
+    await asyncio.sleep(delay)
+    return [{'Id': service.config[field], 'Name': service.config[field], 'StageName': 'Open'}]
+
+
+async def as_full_fetch(records):
+    """Wrap a fetch of records as an account cache fetch_full result"""
+    return await records, None
+
+
+@pytest.mark.parametrize('field', ['username', 'password'])
+def test_acrm_split_fetches_are_not_shared_across_tenants(monkeypatch, field):
+    tenant_a, tenant_b = tenants_on_one_endpoint('acrm', field)
+    for service in (tenant_a, tenant_b):
+        monkeypatch.setattr(service, '_apost_query', lambda query, with_products=False, service=service: respond_as_tenant(service, field))
+
+    async def run():
+        return await asyncio.gather(
+            tenant_a.aget_opportunities_by_account_id('42'),
+            tenant_b.aget_opportunities_by_account_id('42'),
+            tenant_a.aget_opportunities_by_account_id('42')
+        )
+
+    a, b, a_again = asyncio.run(run())
+
+    assert [record['Id'] for record in a] == ['tenant-a']
+    assert [record['Id'] for record in b] == ['tenant-b']
+    assert a_again is a
+
+
+@pytest.mark.parametrize('platform, field', [
+    ('acrm', 'username'),
+    ('pivotal', 'access_token'),
+    ('pivotal', 'pivotal_environment_name'),
+    ('salesforce', 'access_token')
+])
+def test_coalesced_fetches_are_not_shared_across_tenants(platform, field):
+    tenant_a, tenant_b = tenants_on_one_endpoint(platform, field)
+    key_parts = (platform, 'opportunities', '42')
+
+    async def run():
+        return await asyncio.gather(*[
+            crm_services.acached_account_fetch(
+                service.config,
+                key_parts,
+                lambda service=service: as_full_fetch(respond_as_tenant(service, field))
+            )
+            for service in (tenant_a, tenant_b)
+        ])
+
+    a, b = asyncio.run(run())
+
+    assert [record['Id'] for record in a] == ['tenant-a']
+    assert [record['Id'] for record in b] == ['tenant-b']
+
+
+@pytest.fixture
+def disk_account_cache(monkeypatch, tmp_path):
+    """A fresh container account cache with a disk tier, as with ACCOUNT_CACHE_DIR"""
+    monkeypatch.setattr(account_cache, '_cache', account_cache.AccountCache(disk_dir=str(tmp_path)))
+    return tmp_path
+
+
+@pytest.mark.parametrize('platform, field', [
+    ('acrm', 'password'),
+    ('pivotal', 'pivotal_environment_name'),
+    ('salesforce', 'access_token')
+])
+def test_account_cache_entries_are_not_served_across_tenants(disk_account_cache, monkeypatch, platform, field):
+    tenant_a, tenant_b = tenants_on_one_endpoint(platform, field)
+    for service in (tenant_a, tenant_b):
+        service.config['account_cache'] = True
+    key_parts = tenant_a._cache_key('42', []) if platform != 'pivotal' else tenant_a._cache_key('42')
+
+    def fetch(service):
+        return crm_services.acached_account_fetch(
+            service.config, key_parts, lambda: as_full_fetch(respond_as_tenant(service, field, delay=0))
+        )
+
+    assert [record['Id'] for record in asyncio.run(fetch(tenant_a))] == ['tenant-a']
+    assert [record['Id'] for record in asyncio.run(fetch(tenant_b))] == ['tenant-b']
+
+    # A new container reads the disk tier, still per tenant
+    monkeypatch.setattr(account_cache, '_cache', account_cache.AccountCache(disk_dir=str(disk_account_cache)))
+
+    async def never_fetched():
+        raise AssertionError('should be served from the disk tier')
+
+    for service, expected in ((tenant_a, 'tenant-a'), (tenant_b, 'tenant-b')):
+        records = asyncio.run(crm_services.acached_account_fetch(service.config, key_parts, never_fetched))
+        assert [record['Id'] for record in records] == [expected]
+
+
+def test_acrm_batch_cache_entries_are_not_served_across_tenants(disk_account_cache, monkeypatch):
+    tenant_a, tenant_b = tenants_on_one_endpoint('acrm', 'username')
+    queried = []
+    for service in (tenant_a, tenant_b):
+        service.config['account_cache'] = True
+
+        async def post_query(query, with_products=False, service=service):
+            queried.append(service.config['username'])
+            return [{'Id': service.config['username'], 'AccountId': '42', 'OpportunityLineItems': []}]
+
+        monkeypatch.setattr(service, '_apost_query', post_query)
+
+    a = asyncio.run(tenant_a.aget_opportunities_with_products_batch(['42']))
+    b = asyncio.run(tenant_b.aget_opportunities_with_products_batch(['42']))
+    a_again = asyncio.run(tenant_a.aget_opportunities_with_products_batch(['42']))
+
+    assert queried == ['tenant-a', 'tenant-b']
+    assert a['42'][0]['Id'] == a_again['42'][0]['Id'] == 'tenant-a'
+    assert b['42'][0]['Id'] == 'tenant-b'
+
+
+ACRM = {'url_domain': 'https://acrm.example.com/xml', 'username': 'user', 'password': 'secret'}
+
+
+def test_acrm_queries_products_only_from_a_configured_table():
+    baseline = crm_services.ACRMService(ACRM)
+    assert not baseline.fetches_products
+    assert '<table table="Y1" />' in baseline._build_query(['42'], with_products=True)
+    assert '<fields table="Y1"' in baseline._build_query(['42'], with_products=True)
+
+    query = crm_services.ACRMService({**ACRM, 'acrm_product_table': 'Y9'})._build_query(['42'], with_products=True)
+    assert '<table table="Y1"><table table="Y9" /></table>' in query
+    assert f'<fields table="Y9" fields="{crm_services.ACRM_PRODUCT_FIELDS}" />' in query
+
+
+def test_acrm_without_a_product_table_fetches_in_one_baseline_query(monkeypatch):
+    service = crm_services.ACRMService(ACRM)
+    queries = []
+
+    async def post_query(query, with_products=False):
+        queries.append(query)
+        return [{'Id': '006A', 'Name': 'A', 'StageName': 'Won (BASE)', 'AccountId': '42', 'OpportunityLineItems': []}]
+
+    monkeypatch.setattr(service, '_apost_query', post_query)
+
+    async def split():
+        return await asyncio.gather(
+            service.aget_opportunity_products(None, '42'),
+            service.aget_opportunities_by_account_id('42')
+        )
+
+    products, opportunities = asyncio.run(split())
+    combined = asyncio.run(service.aget_opportunities_with_products(None, '42'))
+
+    assert products == []
+    assert [opportunity['Id'] for opportunity in opportunities] == ['006A']
+    assert [opportunity['Id'] for opportunity in combined] == ['006A']
+    assert len(queries) == 2 and all('table="Y1" />' in query for query in queries)
+
+
+def paged_salesforce(monkeypatch, later_page):
+    """A Salesforce service whose query results span two pages, the second being later_page"""
+    service = crm_services.SalesforceService({'url_domain': 'https://sf.example.com', 'access_token': 'token'})
+    first = {'done': False, 'nextRecordsUrl': '/next', 'records': [{'Id': '006A', 'OpportunityLineItems': None}]}
+
+    async def get_page(url, params=None):
+        if params is not None:
+            return first
+        if isinstance(later_page, Exception):
+            raise later_page
+        return later_page
+
+    monkeypatch.setattr(service, '_aget_page', get_page)
+    monkeypatch.setattr(service, '_get_page', lambda url, params=None: asyncio.run(get_page(url, params)))
+    return service, first
+
+
+@pytest.mark.parametrize('later_page', [None, httpx.ConnectError('reset')])
+def test_a_failed_later_page_is_never_returned_as_the_whole_result(monkeypatch, later_page):
+    service, first = paged_salesforce(monkeypatch, later_page)
+    request_metrics = metrics.start_request()
+
+    with pytest.raises(crm_services.IncompleteResultError):
+        asyncio.run(service.aquery('SELECT Id FROM Opportunity'))
+    with pytest.raises(crm_services.IncompleteResultError):
+        list(service._iter_pages(first))
+
+    # The combined fetch fails so the handler falls back, and the request is flagged
+    assert asyncio.run(service.aget_opportunities_with_products(None, '001')) is None
+    assert request_metrics.to_dict()['counts']['crm_partial_results'] == 3
+
+
+def test_every_page_is_collected(monkeypatch):
+    service, first = paged_salesforce(monkeypatch, {'done': True, 'records': [{'Id': '006B'}]})
+
+    assert [record['Id'] for record in asyncio.run(service.aquery('SELECT Id FROM Opportunity'))] == ['006A', '006B']
+    assert [[record['Id'] for record in records] for records in service._iter_pages(first)] == [['006A'], ['006B']]
@@ -0,0 +1,93 @@
+import asyncio
+import json
+import time
+
+import numpy as np
+
+import crm_services
+import lambda_function
+import langchain_service
+import metrics
+from langchain_service import ResponseCache
+from records import OpportunityRecord
+
+
+ITEM = {'transcript': 'We talked about the renewal', 'account_id': '001'}
+
+
+def run_batch(monkeypatch, crm_service, items, config):
+    """Run batch_handler against crm_service, returning its results and the records each item was ranked with"""
+    ranked = {}
+
+    async def rank_account(rank_service, config, opportunity_records, transcript, features, user_ids, started_at):
+        ranked[tuple(user_ids or ())] = opportunity_records
+        return [], None
+
+    monkeypatch.setattr(lambda_function, 'resolve_services', lambda config: (crm_service, None, None))
+    monkeypatch.setattr(lambda_function, 'rank_account', rank_account)
+
+    config = {'crm_platform': 'salesforce', 'stage_pushdown': False, 'emit_metrics': False, **config}
+    response = asyncio.run(lambda_function.batch_handler(items, config, metrics.start_request()))
+    return json.loads(response['body'])['results'], ranked
+
+
+def test_combined_fetches_are_shared_by_items_of_other_users(monkeypatch):
+    service = crm_services.SalesforceService({'url_domain': 'https://sf.example.com', 'access_token': 'token'})
+    fetched_for = []
+
+    async def fetch(user_ids, account_id, product_ids=[]):
+        fetched_for.append(user_ids)
+        return [
+            {'Id': '006A', 'OwnerId': 'u1', 'StageName': 'Open', 'OpportunityLineItems': [{'Product2Id': 'p1'}]},
+            {'Id': '006B', 'OwnerId': 'u2', 'StageName': 'Open', 'OpportunityLineItems': [{'Product2Id': 'p2'}]}
+        ]
+
+    monkeypatch.setattr(service, 'aget_opportunities_with_products', fetch)
+    results, ranked = run_batch(monkeypatch, service, [{**ITEM, 'user_ids': ['u1']}, {**ITEM, 'user_ids': ['u2']}], {})
+
+    assert fetched_for == [[]]
+    assert [result['error'] for result in results] == [None, None]
+    assert [record.product_ids for record in ranked[('u1',)]] == [('p1',), ()]
+    assert [record.product_ids for record in ranked[('u2',)]] == [(), ('p2',)]
+
+
+def test_a_batched_fetch_past_the_timeout_fails_its_accounts(monkeypatch):
+    service = crm_services.ACRMService({'url_domain': 'https://acrm.example.com', 'access_token': 'user:secret'})
+    single_fetches = []
+
+    async def fetch_batch(account_ids, product_ids=[]):
+        await asyncio.sleep(1)
+
+    async def fetch(user_ids, account_id, product_ids=[]):
+        single_fetches.append(account_id)
+        return []
+
+    monkeypatch.setattr(service, 'aget_opportunities_with_products_batch', fetch_batch)
+    monkeypatch.setattr(service, 'aget_opportunities_with_products', fetch)
+    results, _ = run_batch(monkeypatch, service, [ITEM, {**ITEM, 'account_id': '002'}], {'crm_platform': 'acrm', 'fetch_timeout': 0.05})
+
+    assert all('Timed out fetching account' in result['error'] for result in results)
+    assert single_fetches == []
+
+
+def test_cascade_reports_the_llm_cache_once_it_was_consulted(monkeypatch):
+    cache = ResponseCache()
+    cache.set('cached', '[]', latency=0.25)
+    monkeypatch.setattr(langchain_service.service, 'cache', cache)
+
+    class CachedRank:
+        async def arank_opportunities(self, candidates, user_products, transcript):
+            cache.get('cached')
+            cache.get('uncached')
+            return [{'score': 0} for _ in candidates]
+
+    opportunity_records = [OpportunityRecord('006A', 'A', 'Open', 'u1')]
+    metrics.start_request()
+    result, metadata = asyncio.run(lambda_function.cascade_rank(
+        CachedRank(), opportunity_records, np.array([0.5]), [], 'transcript', [], {}, time.monotonic()
+    ))
+
+    assert metadata['stage'] == 'heuristic_fallback'
+    assert metadata['llm_cache']['request'] == {'hit': 1, 'miss': 1}
+    assert metadata['llm_cache']['saved_ms'] == 250
+    assert metadata['llm_cache']['container']['hits'] == 1
@@ -0,0 +1,169 @@
+import asyncio
+import json
+
+import pytest
+
+import langchain_service
+import metrics
+from langchain_service import FakeChatModel, LangChainService, Providers, ResponseCache, Speeds
+from rank_services import SalesforceRank, parse_ranked_opportunities
+
+
+class Clock:
+    """Stands in for time.time so TTLs expire without waiting"""
+
+    def __init__(self, now=1000.0):
+        self.now = now
+
+    def __call__(self):
+        return self.now
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(langchain_service.time, 'time', clock)
+    return clock
+
+
+def fake_service(responses, cache=None):
+    """A LangChainService whose FAST model answers with the given responses in turn"""
+    service = LangChainService(provider=Providers.FAKE, cache=cache)
+    model = langchain_service.PROVIDER_SPEEDS[Providers.FAKE][Speeds.FAST]
+    service._clients[model] = FakeChatModel(model, responses=responses)
+    return service, service._clients[model]
+
+
+def test_response_cache_expires_entries_after_ttl(clock):
+    cache = ResponseCache(ttl=60)
+    cache.set('key', 'response', latency=1.5)
+
+    clock.now += 59
+    assert cache.get('key') == 'response'
+
+    clock.now += 2
+    assert cache.get('key') is None
+    assert cache.stats() == {'hits': 1, 'disk_hits': 0, 'misses': 1, 'size': 0, 'latency_saved': 1.5}
+
+
+def test_response_cache_evicts_least_recently_used(clock):
+    cache = ResponseCache(max_size=2)
+    cache.set('a', 'A', latency=0.1)
+    cache.set('b', 'B', latency=0.1)
+    assert cache.get('a') == 'A'
+
+    cache.set('c', 'C', latency=0.1)
+
+    assert cache.get('b') is None
+    assert cache.get('a') == 'A'
+    assert cache.get('c') == 'C'
+
+
+def test_response_cache_disk_tier_survives_a_new_cache(clock, tmp_path):
+    ResponseCache(disk_dir=str(tmp_path), ttl=60).set('key', 'response', latency=2.0)
+
+    # A new container's cache starts empty in memory and reads the entry from disk
+    cache = ResponseCache(disk_dir=str(tmp_path), ttl=60)
+    assert cache.get('key') == 'response'
+    assert cache.get('key') == 'response'
+    assert cache.stats()['disk_hits'] == 1
+
+    clock.now += 61
+    assert ResponseCache(disk_dir=str(tmp_path), ttl=60).get('key') is None
+    assert not list(tmp_path.glob('*.json'))
+
+
+def test_response_cache_counts_lookups_on_the_request(clock, tmp_path):
+    ResponseCache(disk_dir=str(tmp_path)).set('disk', 'response', latency=2.0)
+    cache = ResponseCache(disk_dir=str(tmp_path))
+    cache.set('memory', 'response', latency=1.5)
+    request_metrics = metrics.start_request()
+
+    assert cache.get('memory') == cache.get('disk') == 'response'
+    assert cache.get('missing') is None
+
+    assert request_metrics.to_dict()['counts'] == {'llm_cache_hit': 2, 'llm_cache_miss': 1, 'llm_cache_saved_ms': 3500}
+
+
+def test_chat_serves_repeated_prompts_from_cache(clock):
+    service, model = fake_service(['first', 'second'], cache=ResponseCache())
+    messages = [{'role': 'user', 'content': 'context'}]
+
+    assert service.chat(messages, 'prompt', Speeds.FAST) == 'first'
+    assert asyncio.run(service.achat(messages, 'prompt', Speeds.FAST)) == 'first'
+    assert service.chat(messages, 'prompt', Speeds.FAST, use_cache=False) == 'second'
+    assert model.calls == 2
+
+
+IDS = ['006A', '006B', '006C']
+
+
+def test_parse_keeps_complete_objects_of_a_truncated_array():
+    response = '[{"id": "006A", "name": "A", "score": 0.9}, {"id": "006B", "name": "B", "score": 0.4}, {"id": "006C", "na'
+
+    assert parse_ranked_opportunities(response, IDS) == {
+        '006A': {'id': '006A', 'name': 'A', 'score': 0.9},
+        '006B': {'id': '006B', 'name': 'B', 'score': 0.4}
+    }
+
+
+def test_parse_handles_fences_single_objects_and_bad_items():
+    fenced = '```json\n{"id": "006A", "name": "A", "score": "0.7"}\n```'
+    assert parse_ranked_opportunities(fenced, IDS) == {'006A': {'id': '006A', 'name': 'A', 'score': 0.7}}
+
+    response = json.dumps([
+        {'id': '006A', 'score': 1.8},
+        {'id': '006B', 'score': 'high'},
+        {'id': '006X', 'score': 0.5},
+        ['006C', 0.5]
+    ])
+    assert parse_ranked_opportunities(response, IDS) == {'006A': {'id': '006A', 'name': None, 'score': 1.0}}
+
+    assert parse_ranked_opportunities('', IDS) == {}
+    assert parse_ranked_opportunities('not json at all', IDS) == {}
+
+
+def rank_batch(monkeypatch, responses):
+    service, model = fake_service(responses)
+    monkeypatch.setattr(langchain_service, 'service', service)
+    opportunities = [{'Id': opportunity_id, 'Name': opportunity_id[-1]} for opportunity_id in IDS]
+
+    async def run():
+        return await SalesforceRank()._rank_llm_batch(opportunities, ['Vault'], 'transcript', asyncio.Semaphore(1))
+
+    return asyncio.run(run()), model
+
+
+def test_rank_llm_batch_retries_opportunities_missing_from_a_partial_response(monkeypatch):
+    ranked, model = rank_batch(monkeypatch, [
+        '[{"id": "006A", "name": "A", "score": 0.9}, {"id": "006B", "na',
+        '[{"id": "006B", "name": "B", "score": 0.3}, {"id": "006C", "name": "C", "score": 0.1}]'
+    ])
+
+    assert model.calls == 2
+    assert ranked == [
+        {'id': '006A', 'name': 'A', 'score': 0.9},
+        {'id': '006B', 'name': 'B', 'score': 0.3},
+        {'id': '006C', 'name': 'C', 'score': 0.1}
+    ]
+
+
+def test_rank_llm_batch_zero_scores_what_the_retry_still_misses(monkeypatch):
+    ranked, model = rank_batch(monkeypatch, [
+        '[{"id": "006A", "name": "A", "score": 0.9}',
+        '[{"id": "006B", "name": "B", "sc'
+    ])
+
+    assert model.calls == 2
+    assert ranked[0] == {'id': '006A', 'name': 'A', 'score': 0.9}
+    assert ranked[1:] == [
+        {'id': '006B', 'name': 'B', 'score': 0.0, 'error': 'missing from LLM response'},
+        {'id': '006C', 'name': 'C', 'score': 0.0, 'error': 'missing from LLM response'}
+    ]
+
+
+def test_rank_llm_batch_does_not_retry_an_unusable_response(monkeypatch):
+    ranked, model = rank_batch(monkeypatch, ['Sorry, I cannot help with that.'])
+
+    assert model.calls == 1
+    assert [item['score'] for item in ranked] == [0.0, 0.0, 0.0]
@@ -0,0 +1,153 @@
+import random
+
+import pytest
+
+from rank_services import PivotalRank, SalesforceRank
+from records import OpportunityRecord
+from transcript_matching import INDEX_BUILD_THRESHOLD, MIN_PRODUCT_WORD_LENGTH, ProductMatcher, get_transcript_features
+
+
+WORDS = ['cloud', 'suite', 'analytics', 'edge', 'mobile', 'sync', 'vault', 'insight', 'premium', 'api', 'hub']
+
+TRANSCRIPT = 'We talked about the Analytics rollout and whether the vault pricing covers the premium tier.'
+
+USER_IDS = ['005A', '005B']
+
+
+def random_opportunities(rank_service, rng, count):
+    """Raw opportunities with their products, as the scalar path takes them"""
+    stages = list(rank_service.STAGE_WEIGHTS) + ['Unknown stage', None]
+    opportunities = []
+    for index in range(count):
+        products = [
+            {'product_id': f'01t{index}-{n}', 'product_name': ' '.join(rng.sample(WORDS, rng.randint(1, 3)))}
+            for n in range(rng.choice([0, 0, 1, 2, 4]))
+        ]
+        opportunity = {
+            'Id': f'006{index}',
+            'Name': f'Opportunity {index}',
+            'StageName': rng.choice(stages),
+            'OwnerId': rng.choice(USER_IDS + ['005C', None])
+        }
+        opportunities.append((opportunity, products))
+    return opportunities
+
+
+def to_record(opportunity, products):
+    return OpportunityRecord(
+        opportunity['Id'],
+        opportunity['Name'],
+        opportunity['StageName'],
+        opportunity['OwnerId'],
+        tuple(product['product_id'] for product in products),
+        tuple(product['product_name'] for product in products)
+    )
+
+
+def scalar_score(rank_service, opportunity, products):
+    # A missing stage is looked up as '', as the batch path does
+    if opportunity['StageName'] is None:
+        opportunity = {**opportunity, 'StageName': ''}
+    return rank_service.rank_opportunity_score(opportunity, products, TRANSCRIPT, USER_IDS)
+
+
+@pytest.mark.parametrize('rank_class', [PivotalRank, SalesforceRank])
+def test_batch_scores_match_scalar_scores(rank_class):
+    rank_service = rank_class()
+    opportunities = random_opportunities(rank_service, random.Random(7), 300)
+
+    scores = rank_service.score_opportunities_batch(
+        [to_record(opportunity, products) for opportunity, products in opportunities],
+        TRANSCRIPT,
+        USER_IDS,
+        features=get_transcript_features(TRANSCRIPT)
+    )
+
+    expected = [scalar_score(rank_service, opportunity, products) for opportunity, products in opportunities]
+    assert scores.tolist() == pytest.approx(expected, abs=1e-12)
+
+
+@pytest.mark.parametrize('rank_class', [PivotalRank, SalesforceRank])
+@pytest.mark.parametrize('min_score', [0.5, 0.6, 0.7, 0.8])
+def test_pruned_batch_scores_keep_everything_above_min_score(rank_class, min_score):
+    rank_service = rank_class()
+    opportunities = random_opportunities(rank_service, random.Random(11), 300)
+
+    scores = rank_service.score_opportunities_batch(
+        [to_record(opportunity, products) for opportunity, products in opportunities],
+        TRANSCRIPT,
+        USER_IDS,
+        min_score=min_score
+    )
+
+    for score, (opportunity, products) in zip(scores.tolist(), opportunities):
+        expected = scalar_score(rank_service, opportunity, products)
+        if expected >= min_score:
+            assert score == pytest.approx(expected, abs=1e-12)
+        else:
+            assert score < min_score
+
+
+@pytest.mark.parametrize('rank_class', [PivotalRank, SalesforceRank])
+def test_batch_ranking_matches_scalar_ranking(rank_class):
+    rank_service = rank_class()
+    opportunities = random_opportunities(rank_service, random.Random(3), 60)
+    rank_threshold = 0.5
+
+    kept = []
+    for opportunity, products in opportunities:
+        score = scalar_score(rank_service, opportunity, products)
+        if score >= rank_threshold:
+            kept.append({
+                'id': opportunity['Id'],
+                'name': opportunity['Name'],
+                'stage_name': opportunity['StageName'],
+                'owner_id': opportunity['OwnerId'],
+                'rank': score
+            })
+    kept.sort(key=lambda result: result['rank'], reverse=True)
+    # Only SalesforceRank has the scalar normalization and suggestion steps
+    expected = SalesforceRank().determine_suggestion(SalesforceRank().normalize_scores(kept))
+
+    ranked = rank_service.rank_opportunities_batch(
+        [to_record(opportunity, products) for opportunity, products in opportunities],
+        TRANSCRIPT,
+        USER_IDS,
+        rank_threshold=rank_threshold
+    )
+
+    assert expected
+    assert ranked == expected
+
+
+def plain_is_mentioned(transcript, product_name):
+    text = transcript.lower()
+    return any(word in text for word in (product_name or '').lower().split() if len(word) > MIN_PRODUCT_WORD_LENGTH)
+
+
+def random_word(rng):
+    return ''.join(rng.choice('abcdefgh') for _ in range(rng.randint(2, 7)))
+
+
+@pytest.mark.parametrize('lookups', [20, INDEX_BUILD_THRESHOLD * 4])
+def test_product_matcher_matches_substring_checks(lookups):
+    rng = random.Random(lookups)
+    transcript = ' '.join(random_word(rng) for _ in range(400)).title()
+    matcher = ProductMatcher(transcript)
+
+    # Enough lookups to build the position index, with names repeated to hit the memos
+    names = [' '.join(random_word(rng) for _ in range(rng.randint(1, 3))).upper() for _ in range(lookups)]
+    for name in names + names[:lookups // 4] + ['', None]:
+        assert matcher.is_mentioned(name) == plain_is_mentioned(transcript, name), name
+
+    if lookups > INDEX_BUILD_THRESHOLD:
+        assert matcher._positions is not None
+
+
+def test_product_matcher_finds_words_at_the_transcript_edges():
+    matcher = ProductMatcher('Vault at the start, analytics at the end')
+
+    assert matcher.is_mentioned('Vault Premium')
+    assert matcher.is_mentioned('analytics')
+    assert not matcher.is_mentioned('api hub')
+    assert not matcher.is_mentioned('edge')
@@ -0,0 +1,187 @@
+import asyncio
+import itertools
+
+import httpx
+import pytest
+
+import metrics
+import resilience
+from resilience import CallPolicy, CircuitBreaker, CircuitOpenError
+
+
+_tenants = itertools.count()
+
+
+class Clock:
+    """Stands in for time.monotonic so circuits reset without waiting"""
+
+    def __init__(self, now=1000.0):
+        self.now = now
+
+    def __call__(self):
+        return self.now
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(resilience.time, 'monotonic', clock)
+    return clock
+
+
+def new_policy(latency=None, **config):
+    """A policy of a tenant no other test shares, with latency recorded for every sample if given"""
+    policy = CallPolicy(('test', next(_tenants)), config)
+    if latency is not None:
+        for _ in range(resilience.MIN_LATENCY_SAMPLES):
+            policy.health.latencies('query').record(latency)
+    return policy
+
+
+def test_breaker_opens_after_threshold_failures_in_a_row(clock):
+    breaker = CircuitBreaker(failure_threshold=3, reset_timeout=30)
+
+    breaker.record_failure()
+    breaker.record_failure()
+    breaker.record_success()
+    breaker.record_failure()
+    breaker.record_failure()
+    assert breaker.state == 'closed' and breaker.allow()
+
+    breaker.record_failure()
+    assert breaker.state == 'open' and not breaker.allow()
+    assert breaker.times_opened == 1
+
+
+def test_half_open_breaker_lets_one_trial_through_and_closes_on_success(clock):
+    breaker = CircuitBreaker(failure_threshold=1, reset_timeout=30)
+    breaker.record_failure()
+
+    clock.now += 30
+    assert breaker.state == 'half_open'
+    assert breaker.allow()
+    assert not breaker.allow()
+
+    breaker.record_success()
+    assert breaker.state == 'closed' and breaker.allow()
+
+
+def test_failed_trial_opens_the_breaker_for_another_reset_timeout(clock):
+    breaker = CircuitBreaker(failure_threshold=1, reset_timeout=30)
+    breaker.record_failure()
+    clock.now += 30
+    assert breaker.allow()
+
+    breaker.record_failure()
+    assert breaker.state == 'open' and breaker.times_opened == 2
+
+    clock.now += 29
+    assert not breaker.allow()
+    clock.now += 1
+    assert breaker.allow()
+
+
+def test_released_trial_lets_another_call_try(clock):
+    breaker = CircuitBreaker(failure_threshold=1, reset_timeout=30)
+    breaker.record_failure()
+    clock.now += 30
+    assert breaker.allow()
+
+    breaker.release_trial()
+    assert breaker.state == 'half_open' and breaker.allow()
+
+
+def test_open_circuit_fails_fast_without_calling():
+    policy = new_policy()
+    for _ in range(resilience.BREAKER_FAILURE_THRESHOLD):
+        policy.health.breaker.record_failure()
+    calls = []
+
+    async def send(timeout):
+        calls.append(timeout)
+        return httpx.Response(200)
+
+    request_metrics = metrics.start_request()
+    with pytest.raises(CircuitOpenError):
+        asyncio.run(policy.acall('query', send, idempotent=True))
+
+    assert calls == []
+    assert request_metrics.to_dict()['counts']['crm_circuit_open'] == 1
+
+
+def test_hedge_wins_over_a_slow_request_and_cancels_it():
+    policy = new_policy(latency=0.01)
+    started, cancelled = [], []
+
+    async def send(timeout):
+        attempt = len(started)
+        started.append(attempt)
+        if attempt == 0:
+            try:
+                await asyncio.sleep(5)
+            except asyncio.CancelledError:
+                cancelled.append(attempt)
+                raise
+        return httpx.Response(200, json={'attempt': attempt})
+
+    request_metrics = metrics.start_request()
+    response = asyncio.run(policy.acall('query', send, idempotent=True))
+
+    assert response.json() == {'attempt': 1}
+    assert cancelled == [0]
+    counts = request_metrics.to_dict()['counts']
+    assert counts['crm_hedges'] == 1 and counts['crm_hedge_wins'] == 1
+
+
+def test_no_hedge_without_known_latencies_or_when_turned_off():
+    calls = []
+
+    async def send(timeout):
+        calls.append(timeout)
+        await asyncio.sleep(0.05)
+        return httpx.Response(200)
+
+    for policy in (new_policy(), new_policy(latency=0.01, crm_hedging=False)):
+        asyncio.run(policy.acall('query', send, idempotent=True))
+
+    assert len(calls) == 2
+
+
+@pytest.mark.parametrize('status', sorted(resilience.RETRY_STATUSES))
+def test_idempotent_calls_are_retried_on_retry_statuses(status):
+    policy = new_policy()
+    statuses = iter([status, 200])
+
+    async def send(timeout):
+        return httpx.Response(next(statuses))
+
+    request_metrics = metrics.start_request()
+    response = asyncio.run(policy.acall('query', send, idempotent=True))
+
+    assert response.status_code == 200
+    assert request_metrics.to_dict()['counts']['crm_retries'] == 1
+    assert policy.health.breaker.state == 'closed'
+
+
+def test_other_statuses_and_non_idempotent_calls_are_not_retried():
+    calls = []
+
+    async def send(timeout):
+        calls.append(timeout)
+        return httpx.Response(503 if len(calls) > 1 else 404)
+
+    assert asyncio.run(new_policy().acall('query', send, idempotent=True)).status_code == 404
+    assert asyncio.run(new_policy().acall('query', send)).status_code == 503
+    assert len(calls) == 2
+
+
+def test_last_retry_status_is_returned_once_attempts_run_out():
+    policy = new_policy(crm_max_attempts=2)
+    calls = []
+
+    async def send(timeout):
+        calls.append(timeout)
+        return httpx.Response(503)
+
+    assert asyncio.run(policy.acall('query', send, idempotent=True)).status_code == 503
+    assert len(calls) == 2
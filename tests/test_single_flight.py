@@ -0,0 +1,102 @@
+import asyncio
+import threading
+import time
+
+import pytest
+
+import metrics
+from single_flight import SingleFlight
+
+
+def test_concurrent_threads_share_one_call():
+    flight = SingleFlight()
+    release = threading.Event()
+    calls, results = [], []
+
+    def fetch():
+        calls.append(1)
+        release.wait(5)
+        return 'records'
+
+    threads = [threading.Thread(target=lambda: results.append(flight.do('key', fetch))) for _ in range(4)]
+    threads[0].start()
+    while flight.stats()['in_flight'] == 0:
+        time.sleep(0.001)
+    for thread in threads[1:]:
+        thread.start()
+    while flight.stats()['coalesced'] < 3:
+        time.sleep(0.001)
+    release.set()
+    for thread in threads:
+        thread.join()
+
+    assert calls == [1] and results == ['records'] * 4
+    assert flight.stats() == {'calls': 1, 'coalesced': 3, 'in_flight': 0}
+
+
+def test_concurrent_tasks_share_one_call_per_key():
+    flight = SingleFlight()
+    calls = []
+
+    async def fetch(key):
+        calls.append(key)
+        await asyncio.sleep(0.01)
+        return [key]
+
+    async def run():
+        return await asyncio.gather(*[flight.ado(key, lambda key=key: fetch(key)) for key in ('a', 'b', 'a', 'a')])
+
+    request_metrics = metrics.start_request()
+    a, b, a_again, a_last = asyncio.run(run())
+
+    assert sorted(calls) == ['a', 'b']
+    assert a == ['a'] and b == ['b'] and a_again is a and a_last is a
+    assert request_metrics.to_dict()['counts']['crm_coalesced'] == 2
+
+
+def test_completed_calls_are_not_kept():
+    flight = SingleFlight()
+    calls = []
+
+    async def fetch():
+        calls.append(1)
+        return len(calls)
+
+    assert asyncio.run(flight.ado('key', fetch)) == 1
+    assert asyncio.run(flight.ado('key', fetch)) == 2
+    assert flight.do('key', lambda: 3) == 3
+    assert flight.stats()['in_flight'] == 0
+
+
+def test_every_caller_gets_the_exception():
+    flight = SingleFlight()
+
+    async def fetch():
+        await asyncio.sleep(0.01)
+        raise ConnectionError('reset')
+
+    async def run():
+        return await asyncio.gather(flight.ado('key', fetch), flight.ado('key', fetch), return_exceptions=True)
+
+    errors = asyncio.run(run())
+
+    assert all(isinstance(error, ConnectionError) for error in errors)
+    assert errors[0] is errors[1]
+
+
+def test_a_cancelled_caller_does_not_cancel_the_call_for_the_others():
+    flight = SingleFlight()
+
+    async def fetch():
+        await asyncio.sleep(0.05)
+        return 'records'
+
+    async def run():
+        impatient = asyncio.ensure_future(asyncio.wait_for(flight.ado('key', fetch), timeout=0.01))
+        patient = asyncio.ensure_future(flight.ado('key', fetch))
+        with pytest.raises(asyncio.TimeoutError):
+            await impatient
+        return await patient
+
+    assert asyncio.run(run()) == 'records'
+    assert flight.stats() == {'calls': 1, 'coalesced': 1, 'in_flight': 0}
@@ -0,0 +1,155 @@
+import hashlib
+import threading
+from collections import Counter, OrderedDict
+from typing import Dict, FrozenSet, List, Mapping, Tuple
+from types import MappingProxyType
+
+
+# Only product name words longer than this are checked against the transcript
+MIN_PRODUCT_WORD_LENGTH = 3
+
+# Length of the transcript substrings the position index is keyed by. Every
+# checked word is longer than MIN_PRODUCT_WORD_LENGTH, so it always has a full key.
+INDEX_KEY_LENGTH = MIN_PRODUCT_WORD_LENGTH + 1
+
+# Transcript features kept per warm container, keyed by transcript hash
+FEATURES_CACHE_SIZE = 32
+
+# Distinct word lookups answered by plain substring scans before the matcher
+# builds its position index. Building the index costs roughly as much as a few
+# hundred scans, so small accounts never pay for it.
+INDEX_BUILD_THRESHOLD = 256
+
+
+class ProductMatcher:
+    """
+    Answers whether product names are mentioned in a transcript, built once per
+    request and shared by every opportunity being ranked.
+
+    A product counts as mentioned if any word of its name longer than
+    MIN_PRODUCT_WORD_LENGTH characters appears anywhere in the lower-cased
+    transcript, as a plain substring. Results are memoized per word and per
+    product name. Once enough distinct words have been looked up, the matcher
+    indexes every transcript position by the characters starting there in a
+    single pass, so each further lookup only compares against the positions
+    that share the word's prefix instead of scanning the whole transcript.
+    """
+
+    def __init__(self, transcript: str):
+        self.text = (transcript or '').lower()
+        self._positions: Dict[str, List[int]] | None = None
+        self._words: Dict[str, bool] = {}
+        self._products: Dict[str, bool] = {}
+
+    def _build_index(self) -> Dict[str, List[int]]:
+        positions = {}
+        text = self.text
+        for i in range(len(text) - INDEX_KEY_LENGTH + 1):
+            key = text[i:i + INDEX_KEY_LENGTH]
+            if key in positions:
+                positions[key].append(i)
+            else:
+                positions[key] = [i]
+        return positions
+
+    def contains(self, word: str) -> bool:
+        """Check whether a lower-cased word is a substring of the transcript"""
+        found = self._words.get(word)
+        if found is not None:
+            return found
+
+        if self._positions is None and len(self._words) >= INDEX_BUILD_THRESHOLD:
+            self._positions = self._build_index()
+
+        if self._positions is None or len(word) < INDEX_KEY_LENGTH:
+            found = word in self.text
+        else:
+            text = self.text
+            found = any(text.startswith(word, i) for i in self._positions.get(word[:INDEX_KEY_LENGTH], ()))
+
+        self._words[word] = found
+        return found
+
+    def is_mentioned(self, product_name: str) -> bool:
+        """Check whether any word of the product name longer than MIN_PRODUCT_WORD_LENGTH is in the transcript"""
+        if not product_name:
+            return False
+
+        mentioned = self._products.get(product_name)
+        if mentioned is None:
+            mentioned = any(
+                self.contains(word)
+                for word in product_name.lower().split()
+                if len(word) > MIN_PRODUCT_WORD_LENGTH
+            )
+            self._products[product_name] = mentioned
+
+        return mentioned
+
+
+class TranscriptFeatures:
+    """
+    Precomputed, read-only view of a transcript shared by every scorer in a request.
+
+    Holds the normalized (lower-cased) text, its whitespace token set and token
+    counts, and the ProductMatcher for product mentions. Word n-grams are built
+    on first use of ngrams().
+    """
+
+    def __init__(self, transcript: str):
+        text = (transcript or '').lower()
+        words = text.split()
+
+        self._text = text
+        self._words = tuple(words)
+        self._tokens = frozenset(words)
+        self._token_counts = MappingProxyType(Counter(words))
+        self._ngrams: Dict[int, FrozenSet[Tuple[str, ...]]] = {}
+        self.matcher = ProductMatcher(text)
+
+    @property
+    def text(self) -> str:
+        return self._text
+
+    @property
+    def tokens(self) -> FrozenSet[str]:
+        return self._tokens
+
+    @property
+    def token_counts(self) -> Mapping[str, int]:
+        return self._token_counts
+
+    def ngrams(self, n: int) -> FrozenSet[Tuple[str, ...]]:
+        """Get the set of word n-grams in the transcript"""
+        ngrams = self._ngrams.get(n)
+        if ngrams is None:
+            ngrams = frozenset(zip(*(self._words[i:] for i in range(n))))
+            self._ngrams[n] = ngrams
+        return ngrams
+
+
+_features_cache = OrderedDict()
+_features_lock = threading.Lock()
+
+
+def get_transcript_features(transcript: str) -> TranscriptFeatures:
+    """
+    Get the features for a transcript, memoized by its hash so repeated requests
+    for the same call in a warm container skip tokenization entirely.
+    """
+    key = hashlib.sha256((transcript or '').encode('utf-8')).digest()
+
+    with _features_lock:
+        features = _features_cache.get(key)
+        if features is not None:
+            _features_cache.move_to_end(key)
+            return features
+
+    features = TranscriptFeatures(transcript)
+
+    with _features_lock:
+        _features_cache[key] = features
+        while len(_features_cache) > FEATURES_CACHE_SIZE:
+            _features_cache.popitem(last=False)
+
+    return features
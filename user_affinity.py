@@ -0,0 +1,70 @@
+import csv
+import os
+import threading
+from typing import AbstractSet, Dict, FrozenSet, Iterable, Sequence
+
+
+USERS_PRODUCTS_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'data', 'users_products.csv')
+
+
+class UserProductAffinity:
+    """
+    Sparse user x product matrix of which users sell which products, stored as
+    one frozenset of Product2Ids per user so every lookup is constant time.
+
+    Loaded once per container from data/users_products.csv.
+    """
+
+    def __init__(self, products_by_user: Dict[str, FrozenSet[str]] | None = None):
+        self._products_by_user = products_by_user or {}
+
+    @classmethod
+    def from_csv(cls, path: str = USERS_PRODUCTS_PATH) -> 'UserProductAffinity':
+        products_by_user = {}
+        with open(path, newline='', encoding='utf-8') as f:
+            for row in csv.DictReader(f):
+                user_id = row.get('UserId')
+                product_id = row.get('Product2Id')
+                if not user_id or not product_id:
+                    continue
+                if user_id not in products_by_user:
+                    products_by_user[user_id] = set()
+                products_by_user[user_id].add(product_id)
+
+        return cls({user_id: frozenset(products) for user_id, products in products_by_user.items()})
+
+    def __len__(self) -> int:
+        return len(self._products_by_user)
+
+    def products_for(self, user_ids: Iterable[str] | None) -> FrozenSet[str]:
+        """Get every product sold by any of the given users"""
+        products = set()
+        for user_id in user_ids or []:
+            products.update(self._products_by_user.get(user_id, ()))
+        return frozenset(products)
+
+    def sells(self, user_id: str, product_id: str) -> bool:
+        return product_id in self._products_by_user.get(user_id, ())
+
+
+def calculate_affinity(product_ids: Sequence[str], participant_products: AbstractSet[str]) -> float:
+    """Fraction of an opportunity's products, by id, that the users on the call sell"""
+    if not product_ids or not participant_products:
+        return 0.0
+
+    sold = sum(1 for product_id in product_ids if product_id in participant_products)
+    return sold / len(product_ids)
+
+
+_affinity = None
+_affinity_lock = threading.Lock()
+
+
+def get_affinity() -> UserProductAffinity:
+    """Get the container-wide affinity matrix, loading data/users_products.csv on first use"""
+    global _affinity
+    if _affinity is None:
+        with _affinity_lock:
+            if _affinity is None:
+                _affinity = UserProductAffinity.from_csv()
+    return _affinity